@@ -25,6 +25,7 @@ import sys
 import os.path
 
 from . import __version__
+from .flbulk import FORMATS, export_rows, import_rows
 from .flcore import GitFireSet, Users
 
 #   commands
@@ -32,7 +33,7 @@ from .flcore import GitFireSet, Users
 #   save <desc>
 #   reset
 #   version
-#       list
+#       list [<limit> [<offset>]]
 #       rollback <version>
 #   check
 #   deploy
@@ -52,6 +53,10 @@ from .flcore import GitFireSet, Users
 #       add <...>
 #       del <num>
 #       list
+#   host | hostgroup | network | service
+#       import <file> [<message>]
+#   rule | host | hostgroup | network | service
+#       export [csv | json]
 #
 
 def cli_args(mockargs=None):
@@ -95,16 +100,21 @@ def give_help():    # pragma: no cover
     save    - save the current configuration
     reset   - revert the configuration to the last saved state
     version
+        list [<limit> [<offset>]]
+        rollback <n> | <commit ID>
     save_needed
     check
     deploy
     rule| host | hostgroup | service
         list
-        del <id>
+        del <id> | <name>
+        export [csv | json]
+    host | hostgroup | network | service
+        import <file.csv | file.json | -> [<message>]
     rule
         add
-        enable <id>
-        disable <id>
+        enable <id> | <name>
+        disable <id> | <name>
     host
         add
     hostgroup
@@ -135,6 +145,24 @@ def to_int(s):
             help("Unable to convert '%s' to int" % s)
         help("Missing argument")
 
+def to_rid(fs, table, s):
+    """Convert a row number or an item name to a row number, exit on failure.
+    Hosts are named as <hostname>:<interface>
+    """
+    try:
+        return int(s)
+    except (TypeError, ValueError):
+        pass
+
+    t = fs.__dict__[table]
+    index = t.index('iface' if table == 'hosts' else 'name')
+    if s in index:
+        item = index[s]
+        return [i for i, x in enumerate(t) if x is item][0]
+    if s:
+        help("Unknown %s '%s'" % (table[:-1], s))
+    help("Missing argument")
+
 def deletion(table):
     if not a3:
         help()
@@ -227,7 +255,10 @@ def main(mockargs=None):    # pragma: no cover
 
     elif a1 == 'version':
         if a2 == 'list' or None:
-            for user, date, msg, commit_id in fs.version_list():
+            limit = to_int(a3) if a3 else None
+            offset = to_int(a4) if a4 else 0
+            for user, date, msg, commit_id in fs.version_list(offset=offset,
+                    limit=limit):
                 s = '%s | %s | %s | %s |' % (commit_id, date, user, msg[0])
                 say(s)
         elif a2 == 'rollback':
@@ -270,21 +301,43 @@ def main(mockargs=None):    # pragma: no cover
         table = "%ss" % a1
         prettyprint(fs.__dict__[table])
 
+    # bulk import and export
+    elif a1 in ('host', 'hostgroup', 'network', 'service') and a2 == 'import':
+        if not a3:
+            help("Missing file name.")
+        table = "%ss" % a1
+        fmt = 'json' if a3.endswith('.json') else 'csv'
+        f = sys.stdin if a3 == '-' else open(a3)
+        n, errors = import_rows(fs, table, f, fmt=fmt, msg=a4)
+        for lineno, e in errors:
+            say("Line %d: %s" % (lineno, e))
+        if errors:
+            say("Nothing imported.")
+            sys.exit(1)
+        say("%d %s imported." % (n, table))
+
+    elif a1 in ('rule', 'host', 'hostgroup', 'network', 'service') and a2 == 'export':
+        fmt = a3 or 'csv'
+        if fmt not in FORMATS:
+            help("Unknown format '%s'" % fmt)
+        for line in export_rows(fs, "%ss" % a1, fmt):
+            say(line[:-1])
+
     # generic deletion
     elif a1 in ('rule', 'host', 'hostgroup', 'network', 'service') and a2 == 'del':
         table = "%ss" % a1
-        fs.delete(table, to_int(a3))
+        fs.delete(table, to_rid(fs, table, a3))
 
     elif a1 == 'rule':
         if a2 == 'add':
             raise NotImplementedError   #TODO
 
         elif a2 == 'enable':
-            i = to_int(a3)
+            i = to_rid(fs, 'rules', a3)
             fs.rules.enable(i)
             say('Rule %d enabled.' %i)
         elif a2 == 'disable':
-            i = to_int(a3)
+            i = to_rid(fs, 'rules', a3)
             fs.rules.disable(i)
             say('Rule %d disabled.' %i)
         else:
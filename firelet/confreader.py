@@ -34,10 +34,19 @@ class ConfReader(object):
             'stop_on_extra_interfaces': False,
             'ssh_username': 'firelet',
             'ssh_key_autoadd': True,
+            'rollback_timeout': 10,
+            'deploy_canary': '',
+            'deploy_batch_size': 0,
+            'diff_cache_dir': '',
+            'write_behind': False,
+            'server': 'auto',
+            'event_stream': False,
+            'concurrent_server': False,
         }
 
         self.__slots__ = defaults.keys()
-        config = SafeConfigParser(defaults)
+        config = SafeConfigParser(dict((k, str(v))
+            for k, v in defaults.iteritems()))
         config.read(fn)
 
         for name, default in defaults.iteritems():
@@ -20,18 +20,32 @@ from argparse import ArgumentParser
 from bottle import HTTPResponse, HTTPError
 from bottle import abort, static_file, view, request
 from datetime import datetime, timedelta
+from functools import wraps
+from hashlib import sha1
 from os import urandom
 from setproctitle import setproctitle
+import atexit
 import bottle
 import logging
 import logging.handlers
+import threading
 import time
 import sys
 
+try:
+    import json
+except ImportError: # pragma: no cover
+    import simplejson as json
+
 from firelet.confreader import ConfReader
+from firelet.flbulk import FORMATS, export_rows, import_rows
+from firelet.fldeploy import RollingDeployment
+from firelet.flevents import EventBus, format_sse
+from firelet.fljobs import JobQueue
 from firelet.flcore import Alert, GitFireSet, DemoGitFireSet, Users, clean
-from firelet.flmap import draw_png_map, draw_svg_map
-from firelet.flutils import encrypt_cookie, decrypt_cookie
+from firelet.flmap import draw_png_map, draw_svg_map, graphviz_available, \
+    map_cache
+from firelet.flutils import Bunch, encrypt_cookie, decrypt_cookie
 from firelet.flutils import flag, get_rss_channels
 from firelet.mailer import Mailer
 
@@ -45,14 +59,15 @@ log.success = log.info
 
 # TODO: new rule creation
 
-# TODO: Reset not working, temporily disabled - FireSet files must be read on
-# each client request
 # TODO: localhost and local networks autosetup
 
 app = bottle.app()
 
 session_random_key = urandom(32)
 
+# Part of every ETag: the table versions restart from zero with the process
+etag_salt = urandom(8).encode('hex')
+
 SESSION_DURATION = timedelta(days=1).total_seconds()
 
 class AuthAlert(Alert):
@@ -85,6 +100,72 @@ conf = None
 fs = None
 mailer = None
 users = None
+rollout = None
+events = EventBus()
+jobs = JobQueue(on_change=lambda job: events.publish('job',
+    job.to_dict(logs=False)))
+_last_save_needed = None
+
+# Number of commits in each page of the version list
+VERSION_LIST_PAGE_SIZE = 20
+
+# Number of rows in each page of the table views, and maximum number of rows
+# returned by the table API
+TABLE_PAGE_SIZE = 100
+TABLE_PAGE_MAX = 1000
+
+# Maximum long polling time. Server-sent events streams keep a server worker
+# busy: they are enabled by the event_stream option, for threaded or
+# asynchronous server adapters, and are short-lived and limited in number.
+EVENT_POLL_TIMEOUT = 30
+# Delay between polls when the server adapter handles one request at a time
+EVENT_POLL_DELAY = 2
+EVENT_STREAM_DURATION = 60
+EVENT_STREAMS_MAX = 4
+_event_streams = 0
+_event_streams_lock = threading.Lock()
+
+# Bottle server adapters serving requests concurrently and the module each
+# one needs. The "auto" adapter uses the first one available among waitress,
+# paste, twisted and cherrypy, then falls back to the single-threaded wsgiref.
+CONCURRENT_SERVERS = {
+    'waitress': 'waitress',
+    'paste': 'paste',
+    'twisted': 'twisted.web',
+    'cherrypy': 'cherrypy',
+    'rocket': 'rocket',
+    'gevent': 'gevent',
+    'eventlet': 'eventlet',
+    'tornado': 'tornado',
+}
+AUTO_SERVERS = ('waitress', 'paste', 'twisted', 'cherrypy')
+
+# True if requests can wait for events without blocking the others, see
+# main()
+concurrent_server = False
+
+
+def fireset_lock(callback):
+    """Bottle plugin: serve GET requests holding the FireSet read lock and
+    the other requests holding its write lock, so that threaded servers
+    never change the tables while they are being read.
+    Routes working on fs.snapshot() skip it: the snapshot is taken holding
+    the read lock, then slow compiles and map layouts do not block edits.
+    """
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        if fs is None:
+            return callback(*args, **kwargs)
+        if request.method in ('GET', 'HEAD'):
+            lock = fs.reading()
+        else:
+            lock = fs.writing()
+        with lock:
+            return callback(*args, **kwargs)
+
+    return wrapper
+
+app.install(fireset_lock)
 
 
 def success(s, *args, **kwargs):
@@ -118,7 +199,7 @@ class WebLogHandler(logging.Handler):
         elif getattr(record, 'web_log_level', None) == 'success':
             lvl = 'success'
 
-        text = "%s" % record.message
+        text = record.getMessage()
 
         if len(text) > 200:
             text = "%s [...see logfile]" % text[:200]
@@ -129,6 +210,7 @@ class WebLogHandler(logging.Handler):
         self._msg_buffer.append(msg)
         if len(self._msg_buffer) > 20:
             self._msg_buffer.pop(0)
+        events.publish('message', msg)
 
     def get_msgs(self):
         """Get buffered messages"""
@@ -194,6 +276,22 @@ def int_pg(name, default=None):
             v)
 
 
+def pg_rid(table):
+    """Retrieve the position of the target item from a POST request.
+    The item is identified by the "row_id" element, optionally checking
+    its "row_version", or by its position in "rid".
+    """
+    row_id = int_pg('row_id', '')
+    if row_id is None:
+        return int_pg('rid')
+
+    try:
+        return fs.__dict__[table].position(row_id,
+            version=int_pg('row_version', ''))
+    except Alert as e:
+        abort(409, str(e))
+
+
 def pcheckbox(name):
     """Retrieve a checkbox status from a POST request generated
     by serializeArray() and returns '0' or '1'
@@ -203,6 +301,48 @@ def pcheckbox(name):
 
     return '0'
 
+def check_etag(*parts):
+    """Tag the response with an ETag based on parts, e.g. table versions.
+    If the client already has it, as told by If-None-Match, reply with 304
+    Not Modified without building the response.
+    """
+    etag = '"%s"' % sha1(repr((etag_salt,) + parts)).hexdigest()
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    for k, v in headers.iteritems():
+        bottle.response.set_header(k, v)
+    tags = request.headers.get('If-None-Match', '').split(',')
+    tags = [t.strip() for t in tags]
+    if etag in tags or '*' in tags:
+        raise HTTPResponse(status=304, headers=headers)
+
+
+def table_page(name):
+    """Select a page of a table from a snapshot, as requested in the query
+    string: offset, limit, sort (field name, "-" for descending order),
+    q (text search) and the filters of the table, e.g. name or address
+    """
+    table = fs.snapshot().__dict__[name]
+    check_etag(request.path, request.query_string, table.version)
+    try:
+        offset = int(request.query.get('offset') or 0)
+        limit = int(request.query.get('limit') or TABLE_PAGE_SIZE)
+        assert offset >= 0 and 0 < limit <= TABLE_PAGE_MAX
+    except (ValueError, AssertionError):
+        abort(400, 'Invalid offset or limit')
+
+    filters = dict((f, request.query[f]) for f in table._filters
+        if request.query.get(f))
+    q = request.query.get('q', '')
+    sort = request.query.get('sort', '')
+    try:
+        total, rows = table.query(filters=filters, search=q, sort=sort,
+            offset=offset, limit=limit)
+    except Alert as e:
+        abort(400, str(e))
+
+    return Bunch(table=table, rows=rows, total=total, offset=offset,
+        limit=limit, q=q, sort=sort, filters=filters)
+
 # session management
 
 def setup_session_cookie(username, role):
@@ -315,10 +455,13 @@ def serve_index():
     """Serve main page"""
     try:
         title = conf.title
+        event_stream = conf.event_stream and concurrent_server
     except Exception:
         title = 'test'
+        event_stream = False
 
-    return dict(msg=None, title=title, logged_in=user_is_logged_in())
+    return dict(msg=None, title=title, logged_in=user_is_logged_in(),
+        event_stream=event_stream)
 
 # #  tables interaction  # #
 #
@@ -332,12 +475,13 @@ def serve_index():
 #             a new one
 
 
-@bottle.route('/ruleset')
+@bottle.route('/ruleset', skip=[fireset_lock])
 @view('ruleset')
 def serve_ruleset():
     """Serve ruleset tab"""
     _require()
-    return dict(rules=enumerate(fs.rules))
+    page = table_page('rules')
+    return dict(rules=page.rows, page=page)
 
 def update_ruleset(action, rid):
     """Update ruleset"""
@@ -370,17 +514,19 @@ def update_ruleset(action, rid):
         d['enabled'] = flag(pg('enabled'))
         d['action'] = pg('rule_action')
         d['log_level'] = pg('log')
-        fs.rules.update(d, rid=pg('rid'), token=pg('token'))
+        fs.rules.update(d, rid=rid, token=pg('token'))
 
     elif action == "newabove":
         action = "create new rule above"
         d = {}
         fs.rules.add(d, rid=rid)
+        return dict(ok=True, row_id=fs.rules[rid].row_id)
 
     elif action == "newbelow":
         action = "create new rule below"
         d = {}
         fs.rules.add(d, rid=rid+1)
+        return dict(ok=True, row_id=fs.rules[rid + 1].row_id)
     else:
         log.error("Unknown action requested: %r", action)
         abort(500)
@@ -390,7 +536,7 @@ def serve_ruleset_post():
     """Make changes on a rule."""
     _require('editor')
     action = pg('action', '')
-    rid = int_pg('rid')
+    rid = pg_rid('rules')
     assert rid is not None, "Item number not provided"
     try:
         return update_ruleset(action, rid)
@@ -405,12 +551,12 @@ def serve_ruleset_post():
 def serve_ruleset_form():
     """Generate an inline editing form for a rule"""
     _require()
-    rid = int_pg('rid')
+    rid = pg_rid('rules')
     rule = fs.rules[rid]
-    services_list = ['*'] + [s.name for s in fs.services]
-    objs = ["%s:%s" % (h.hostname, h.iface) for h in fs.hosts] + \
-        [hg.name for hg in fs.hostgroups] + \
-        [n.name for n in fs.networks]
+    services_list = ['*'] + sorted(fs.services.index('name'))
+    objs = sorted(fs.hosts.index('iface')) + \
+        sorted(fs.hostgroups.index('name')) + \
+        sorted(fs.networks.index('name'))
     return dict(rule=rule, rid=rid, services=services_list, objs=objs)
 
 
@@ -424,12 +570,13 @@ def serve_sib_names():
     return dict(sib_names=sib_names_list)
 
 
-@bottle.route('/hostgroups')
+@bottle.route('/hostgroups', skip=[fireset_lock])
 @view('hostgroups')
 def serve_hostgroups():
     """Generate the HTML hostgroups table"""
     _require()
-    return dict(hostgroups=enumerate(fs.hostgroups))
+    page = table_page('hostgroups')
+    return dict(hostgroups=page.rows, page=page)
 
 
 @bottle.route('/hostgroups', method='POST')
@@ -437,7 +584,7 @@ def serve_hostgroups_post():
     """Add/edit/delete a hostgroup"""
     _require('editor')
     action = pg('action', '')
-    rid = int_pg('rid')
+    rid = pg_rid('hostgroups')
     try:
         if action == 'delete':
             item = fs.fetch('hostgroups', rid)
@@ -470,12 +617,13 @@ def serve_hostgroups_post():
         abort(500)
 
 
-@bottle.route('/hosts')
+@bottle.route('/hosts', skip=[fireset_lock])
 @view('hosts')
 def serve_hosts():
     """Serve hosts tab"""
     _require()
-    return dict(hosts=enumerate(fs.hosts))
+    page = table_page('hosts')
+    return dict(hosts=page.rows, page=page)
 
 
 @bottle.route('/hosts', method='POST')
@@ -483,7 +631,7 @@ def serve_hosts_post():
     """Add/edit/delete a host"""
     _require('editor')
     action = pg('action', '')
-    rid = int_pg('rid')
+    rid = pg_rid('hosts')
     try:
         if action == 'delete':
             h = fs.fetch('hosts', rid)
@@ -529,16 +677,17 @@ def serve_hosts_post():
 def serve_net_names():
     """Serve networks names"""
     _require()
-    nn = [n.name for n in fs.networks]
+    nn = sorted(fs.networks.index('name'))
     return dict(net_names=nn)
 
 
-@bottle.route('/networks')
+@bottle.route('/networks', skip=[fireset_lock])
 @view('networks')
 def serve_networks():
     """Generate the HTML networks table"""
     _require()
-    return dict(networks=enumerate(fs.networks))
+    page = table_page('networks')
+    return dict(networks=page.rows, page=page)
 
 
 @bottle.route('/networks', method='POST')
@@ -546,7 +695,7 @@ def serve_networks_post():
     """Add/edit/delete a network"""
     _require('editor')
     action = pg('action', '')
-    rid = int_pg('rid')
+    rid = pg_rid('networks')
     try:
         if action == 'delete':
             item = fs.fetch('networks', rid)
@@ -580,12 +729,13 @@ def serve_networks_post():
         abort(500)
 
 
-@bottle.route('/services')
+@bottle.route('/services', skip=[fireset_lock])
 @view('services')
 def serve_services():
     """Generate the HTML services table"""
     _require()
-    return dict(services=enumerate(fs.services))
+    page = table_page('services')
+    return dict(services=page.rows, page=page)
 
 
 @bottle.route('/services', method='POST')
@@ -593,7 +743,7 @@ def serve_services_post():
     """Add/edit/delete a service"""
     _require('editor')
     action = pg('action', '')
-    rid = int_pg('rid')
+    rid = pg_rid('services')
     try:
         if action == 'delete':
             item = fs.fetch('services', rid)
@@ -646,6 +796,114 @@ def serve_manage():
     return dict(can_deploy=cd)
 
 
+@bottle.hook('before_request')
+def refresh_fireset():
+    """Reload the tables changed by other processes, e.g. the CLI or
+    other workers"""
+    if fs is None:
+        return
+
+    try:
+        fs.refresh()
+    except Exception as e:
+        log.debug("Unable to refresh the tables: %s" % e)
+
+
+@bottle.hook('after_request')
+def publish_save_needed():
+    """Publish a save_needed event when a POST request changes it"""
+    global _last_save_needed
+    if request.method != 'POST' or fs is None:
+        return
+
+    try:
+        sn = fs.save_needed()
+    except Exception as e:
+        log.debug("Unable to check if save is needed: %s" % e)
+        return
+
+    if sn != _last_save_needed:
+        _last_save_needed = sn
+        events.publish('save_needed', {'sn': sn})
+
+
+@bottle.hook('after_request')
+def rebuild_map():
+    """Render the map in the background when a POST request changes the
+    hosts or the networks, see MapCache"""
+    if request.method == 'POST' and fs is not None and graphviz_available:
+        map_cache.refresh(fs.snapshot())
+
+
+@bottle.route('/api/1/events', skip=[fireset_lock])
+def serve_events():
+    """Long polling: serve the events newer than "since", waiting for new
+    ones if needed. A single-threaded server answers immediately instead:
+    the client polls again after "delay" seconds.
+    """
+    _require()
+    try:
+        since = int(request.query.get('since', events.last_id))
+        timeout = min(float(request.query.get('timeout', EVENT_POLL_TIMEOUT)),
+            EVENT_POLL_TIMEOUT)
+    except ValueError:
+        abort(400, 'Invalid parameter')
+
+    if concurrent_server:
+        delay = 0
+    else:
+        timeout = 0
+        delay = EVENT_POLL_DELAY
+
+    evs = events.wait(since, timeout)
+    return dict(last_id=events.last_id, delay=delay,
+        events=[dict(id=i, kind=k, data=d) for i, k, d in evs])
+
+
+@bottle.route('/api/1/events/stream', skip=[fireset_lock])
+def serve_event_stream():
+    """Server-sent events stream, if enabled by the event_stream option.
+    The stream is closed after EVENT_STREAM_DURATION seconds and the browser
+    reconnects using the Last-Event-ID header. At most EVENT_STREAMS_MAX
+    streams are served at once: the browser falls back to long polling.
+    """
+    global _event_streams
+    _require()
+    if not (conf.event_stream and concurrent_server):
+        abort(404, 'Event streams are disabled')
+    try:
+        since = int(request.get_header('Last-Event-ID',
+            request.query.get('since', events.last_id)))
+    except ValueError:
+        abort(400, 'Invalid event ID')
+
+    with _event_streams_lock:
+        if _event_streams >= EVENT_STREAMS_MAX:
+            abort(503, 'Too many event streams')
+        _event_streams += 1
+
+    bottle.response.content_type = 'text/event-stream'
+    bottle.response.set_header('Cache-Control', 'no-cache')
+
+    def stream(event_id):
+        global _event_streams
+        try:
+            deadline = time.time() + EVENT_STREAM_DURATION
+            yield "retry: 2000\n\n"
+            while time.time() < deadline:
+                evs = events.wait(event_id, min(15, deadline - time.time()))
+                if not evs:
+                    yield ": keepalive\n\n"
+                for e in evs:
+                    event_id = e[0]
+                    yield format_sse(e)
+        finally:
+            with _event_streams_lock:
+                _event_streams -= 1
+
+    return stream(since)
+
+
 @bottle.route('/save_needed')
 def serve_save_needed():
     """Serve fs.save_needed() output"""
@@ -683,48 +941,221 @@ def serve_resetbtn():
     return ack('Configuration reset.')
 
 
+def _run_check(job):
+    """Check configuration - run by the job queue"""
+    log.info('Configuration check started...')
+    snap = fs.snapshot()
+    diff_dict = snap.check(
+        stop_on_extra_interfaces=conf.stop_on_extra_interfaces)
+    for h in snap._get_firewalls():
+        if h.hostname in diff_dict:
+            job.hosts[h.hostname] = 'differs'
+        else:
+            job.hosts[h.hostname] = 'up to date'
+    log.success('Configuration check successful.')
+    return diff_dict
+
+
 @bottle.route('/api/1/check', method='POST')
-@view('rules_diff_table')
 def serve_checkbtn():
-    """Check configuration"""
+    """Queue a configuration check. Concurrent checks are merged in one job."""
     _require()
-    log.info('Configuration check started...')
-    try:
-        diff_dict = fs.check(
-            stop_on_extra_interfaces=conf.
-            stop_on_extra_interfaces)
-        log.success('Configuration check successful.')
-        return dict(diff_dict=diff_dict, error=None)
+    job = jobs.submit('check', _run_check, key='check')
+    return dict(ok=True, job_id=job.id)
 
-    except (Alert, AssertionError) as e:
-        log.error("Check failed: %s", e)
-        return dict(diff_dict={}, error="Check failed: %s" % e)
+
+def _run_deploy(job, username):
+    """Deploy configuration - run by the job queue"""
+    global rollout
+    log.info('Configuration deployment started...')
+    canary = [hn.strip() for hn in conf.deploy_canary.split(',') if hn.strip()]
+    rollout = RollingDeployment(
+        fs.snapshot(),
+        canary=canary,
+        batch_size=conf.deploy_batch_size,
+        stop_on_extra_interfaces=conf.stop_on_extra_interfaces,
+        rollback_timeout=conf.rollback_timeout,
+        status=job.hosts,
+    )
+    progress = rollout.run()
+    if progress.state != 'completed':
+        raise Alert(progress.error)
+
+    log.success('Configuration deployed.')
+    mailer.send_msg(
+        sbj="Configuration deployed by %s" % username,
+        body_txt="Configuration deployed by %s" % username
+    )
+    return progress.to_dict()
 
 
 @bottle.route('/api/1/deploy', method='POST')
 def serve_deploybtn():
-    """Deploy configuration"""
+    """Queue a configuration deployment"""
     s = _require('admin')
-    log.info('Configuration deployment started...')
+    username = s.get('username', None)
+    job = jobs.submit('deploy', lambda job: _run_deploy(job, username))
+    return dict(ok=True, job_id=job.id)
+
+
+@bottle.route('/api/1/jobs')
+def serve_jobs():
+    """List check and deployment jobs"""
+    _require()
+    return dict(jobs=[j.to_dict() for j in jobs.list()])
+
+
+@bottle.route('/api/1/jobs/<job_id:int>')
+def serve_job(job_id):
+    """Serve the status of a check or deployment job"""
+    _require()
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404, 'Job not found')
+
+    return job.to_dict()
+
+
+@bottle.route('/api/1/jobs/<job_id:int>/diff')
+@view('rules_diff_table')
+def serve_job_diff(job_id):
+    """Render the diff generated by a check job"""
+    _require()
+    job = jobs.get(job_id)
+    if job is None or job.kind != 'check':
+        abort(404, 'Check job not found')
+
+    if job.state == 'failed':
+        return dict(diff_dict={}, error="Check failed: %s" % job.error)
+
+    return dict(diff_dict=job.result or {}, error=None)
+
+
+@bottle.route('/api/1/deploy_progress')
+def serve_deploy_progress():
+    """Serve the progress of the last deployment"""
+    _require()
+    if rollout is None:
+        return dict(progress=None)
+
+    return dict(progress=rollout.progress.to_dict())
+
+
+@bottle.route('/api/1/references/<name>')
+def serve_references(name):
+    """List the rules, host groups and hosts using an object.
+    The optional "table" query parameter restricts the references to the
+    ones valid for the object kind, e.g. services.
+    """
+    _require()
+    table = bottle.request.query.get('table') or None
+    if table is not None and table not in fs._table_names:
+        return ret_alert("Unknown table: %s" % table)
+
+    refs = fs.references(name, table=table)
+    return dict(
+        name=name,
+        rules=[r.name for r in refs['rules']],
+        hostgroups=[hg.name for hg in refs['hostgroups']],
+        hosts=["%s:%s" % (h.hostname, h.iface) for h in refs['hosts']],
+    )
+
+
+@bottle.route('/api/1/import/<table>', method='POST')
+def serve_import(table):
+    """Bulk import: add the rows sent as CSV or JSON in the request body.
+    Nothing is added if any row is invalid. The configuration is saved if
+    a "msg" is given in the query string.
+    """
+    _require('editor')
+    fmt = request.query.get('format') or \
+        ('json' if request.content_type.startswith('application/json')
+            else 'csv')
+    if fmt not in FORMATS:
+        abort(400, 'Unknown format')
+
     try:
-        fs.deploy(stop_on_extra_interfaces=conf.stop_on_extra_interfaces)
-        ack('Configuration deployed.')
-        username = s.get('username', None)
-        mailer.send_msg(
-            sbj="Configuration deployed by %s" % username,
-            body_txt="Configuration deployed by %s" % username
-        )
-    except (Alert, AssertionError) as e:
-        ret_alert("Deployment failed: %s" % e)
+        n, errors = import_rows(fs, table, request.body, fmt=fmt,
+            msg=request.query.get('msg'))
+    except Alert as e:
+        return ret_alert("Import failed: %s" % e)
+
+    if errors:
+        log.error("Import failed: %d errors" % len(errors))
+        return dict(ok=False, imported=0,
+            errors=[dict(line=ln, error=e) for ln, e in errors])
 
+    log.success("%d rows imported in %s" % (n, table))
+    return dict(ok=True, imported=n, errors=[])
+
+
+@bottle.route('/api/1/batch', method='POST')
+def serve_batch():
+    """Apply a JSON list of operations in one transaction, see
+    FireSet.batch. The body is {"ops": [...], "atomic": true}
+    """
+    _require('editor')
+    try:
+        data = json.load(request.body)
+        ops = data['ops']
+        assert isinstance(ops, list)
+    except Exception:
+        abort(400, 'Invalid batch')
+
+    results = fs.batch(ops, atomic=data.get('atomic', True) is not False)
+    ok = all(r['ok'] for r in results)
+    if ok:
+        log.success("%d operations applied" % len(results))
+    else:
+        log.error("Batch: %d of %d operations not applied" % (
+            len([r for r in results if not r['ok']]), len(results)))
+    return dict(ok=ok, results=results)
 
-@bottle.route('/api/1/get_compiled_rules')
+
+@bottle.route('/api/1/table/<table>', skip=[fireset_lock])
+def serve_table(table):
+    """Serve a page of a table as JSON, see table_page. Each row has its
+    position (rid), row ID, row version and fields.
+    """
+    _require()
+    if table not in fs._table_names:
+        abort(404)
+
+    page = table_page(table)
+    fields = page.table._fields
+    rows = []
+    for rid, item in page.rows:
+        d = dict((f, getattr(item, f)) for f in fields)
+        d.update(rid=rid, row_id=item.row_id, row_version=item.row_version)
+        rows.append(d)
+    return dict(total=page.total, offset=page.offset, limit=page.limit,
+        rows=rows)
+
+
+@bottle.route('/api/1/export/<table>', skip=[fireset_lock])
+def serve_export(table):
+    """Bulk export: stream the rows of a table as CSV or JSON"""
+    _require()
+    fmt = request.query.get('format', 'csv')
+    if fmt not in FORMATS or table not in fs._table_names:
+        abort(404)
+
+    bottle.response.content_type = 'application/json' if fmt == 'json' \
+        else 'text/csv'
+    bottle.response.set_header('Content-Disposition',
+        'attachment; filename=%s.%s' % (table, fmt))
+    return export_rows(fs, table, fmt)
+
+
+@bottle.route('/api/1/get_compiled_rules', skip=[fireset_lock])
 def serve_get_compiled_rules():
     """Compile rules and return them to the requester"""
     _require('admin')
     log.info('Compiling firewall rules...')
+    snap = fs.snapshot()
+    check_etag(snap.version)
     try:
-        comp_rules = fs.get_compiled_rules()
+        comp_rules = snap.get_compiled_rules()
         ack('Rules compiled')
         return dict(rules=comp_rules, ok=True)
 
@@ -735,10 +1166,29 @@ def serve_get_compiled_rules():
 @bottle.route('/api/1/version_list')
 @view('version_list')
 def serve_version_list():
-    """Serve version list"""
+    """Serve a page of the version list. Pages requested using a cursor
+    contain only old, immutable commits and can be cached by the browser.
+    """
     _require()
-    li = fs.version_list()
-    return dict(version_list=li)
+    cursor = request.query.get('cursor', None)
+    try:
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', VERSION_LIST_PAGE_SIZE))
+        assert offset >= 0 and limit > 0
+    except (ValueError, AssertionError):
+        abort(400, 'Invalid offset or limit')
+
+    try:
+        li = fs.version_list(offset=offset, limit=limit + 1, cursor=cursor)
+    except Alert as e:
+        abort(404, str(e))
+
+    check_etag(li)
+    if cursor:
+        bottle.response.headers['Cache-Control'] = 'private, max-age=31536000'
+
+    next_cursor = li[limit - 1][3] if len(li) > limit else None
+    return dict(version_list=li[:limit], next_cursor=next_cursor)
 
 
 @bottle.route('/api/1/version_diff', method='POST')
@@ -746,14 +1196,29 @@ def serve_version_list():
 def serve_version_diff():
     """Serve version diff"""
     _require()
-    cid = pg('commit_id')  # TODO validate cid?
-    li = fs.version_diff(cid)
+    cid = pg('commit_id')
+    try:
+        li = fs.version_diff(cid)
+    except Alert as e:
+        abort(400, str(e))
+
     if li:
         return dict(li=li)
 
     return dict(li=(('(No changes.)', 'title')))
 
 
+@bottle.route('/api/1/version_diff_tables', method='POST')
+def serve_version_diff_tables():
+    """Serve a row by row diff of the tables"""
+    _require()
+    cid = pg('commit_id')
+    try:
+        return dict(ok=True, tables=fs.version_diff_tables(cid))
+    except Alert as e:
+        return ret_alert("Unable to compare versions: %s" % e)
+
+
 @bottle.route('/api/1/rollback', method='POST')
 def serve_rollback():
     """Rollback configuration"""
@@ -766,7 +1231,7 @@ def serve_rollback():
 # serving static files
 
 
-@bottle.route('/static/:filename#[a-zA-Z0-9_\.?\/?]+#')
+@bottle.route('/static/:filename#[a-zA-Z0-9_\.?\/?]+#', skip=[fireset_lock])
 def serve_static(filename):
     """Serve static content"""
     bottle.response.headers['Cache-Control'] = 'max-age=3600, public'
@@ -801,16 +1266,20 @@ def serve_flmap():
     return """<img src="map.png" width="700px" style="margin: 10px">"""
 
 
-@bottle.route('/map.png')
+@bottle.route('/map.png', skip=[fireset_lock])
 def serve_flmap_png():
+    snap = fs.snapshot()
+    check_etag('png', snap.hosts.version, snap.networks.version)
     bottle.response.content_type = 'image/png'
-    return draw_png_map(fs)
+    return draw_png_map(snap)
 
 
-@bottle.route('/svgmap')
+@bottle.route('/svgmap', skip=[fireset_lock])
 def serve_flmap_svg():
+    snap = fs.snapshot()
+    check_etag('svg', snap.hosts.version, snap.networks.version)
     bottle.response.content_type = 'image/svg+xml'
-    return draw_svg_map(fs)
+    return draw_svg_map(snap)
 
 # TODO: provide PNG fallback for browser without SVG support?
 # TODO: html links in the SVG map
@@ -891,6 +1360,8 @@ def setup_logging(args, conf):
         format='%(asctime)s [%(process)d] %(levelname)s %(name)s (%(funcName)s) %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'  # %z for timezone
     )
+    # basicConfig does nothing if the root logger already has handlers
+    log.setLevel(logging.DEBUG)
     log.addHandler(web_log_handler)
     if args.debug:
         log.debug("Debug mode")
@@ -914,8 +1385,32 @@ def setup_logging(args, conf):
         log.addHandler(fh)
 
 
+def is_concurrent_server(server):
+    """Tell if a Bottle server adapter serves requests concurrently
+
+    :param server: adapter name, as in the "server" option
+    :type server: str
+    :rtype: bool
+    """
+    if server == 'auto':
+        names = AUTO_SERVERS
+    elif server in CONCURRENT_SERVERS:
+        return True
+    else:
+        return False
+
+    for name in names:
+        try:
+            __import__(CONCURRENT_SERVERS[name])
+            return True
+        except ImportError:
+            pass
+    return False
+
+
 def main():
     global app
+    global concurrent_server
     global conf
     global fs
     global mailer
@@ -950,13 +1445,22 @@ def main():
         log.info("Configuration loaded. Demo mode.")
 
     else:
-        fs = GitFireSet(conf.data_dir)
+        fs = GitFireSet(conf.data_dir,
+            diff_cache_dir=conf.diff_cache_dir or None,
+            write_behind=conf.write_behind)
+        atexit.register(fs.flush)
         log.info("Configuration loaded.")
 
     log.info("%d users, %d hosts, %d rules, %d networks loaded.",
              *map(len, (users, fs.hosts, fs.rules, fs.networks))
              )
 
+    concurrent_server = conf.concurrent_server or \
+        is_concurrent_server(conf.server)
+    if not concurrent_server:
+        log.info("The %r server adapter serves one request at a time: "
+            "long polling and event streams are disabled." % conf.server)
+
     logging.getLogger('paste.httpserver.ThreadPool').setLevel(logging.WARN)
     try:
         bottle.run(
@@ -965,7 +1469,7 @@ def main():
             port=conf.listen_port,
             quiet=not args.debug,
             reloader=args.debug,
-            server='auto'
+            server=conf.server
         )
     except:
         logging.error("Unhandled exception", exc_info=True)
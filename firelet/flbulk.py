@@ -0,0 +1,186 @@
+# Firelet - Distributed firewall management.
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Bulk import and export
+#
+# Rows are read and written as CSV, using the same columns as the table
+# files, or as JSON: a list of objects, or one object per line, having the
+# fields used by the add() method of the tables.
+# An import is checked as a whole: if any row is invalid or duplicated
+# nothing is added and every error is reported with its line number.
+
+from cStringIO import StringIO
+from logging import getLogger
+import csv
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from firelet.flutils import Alert
+
+log = getLogger(__name__)
+
+FORMATS = ('csv', 'json')
+IMPORT_TABLES = ('hosts', 'hostgroups', 'networks', 'services')
+
+
+def _str(v):
+    """Convert the strings decoded from JSON to str, like the CSV values"""
+    if isinstance(v, list):
+        return [_str(x) for x in v]
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    if isinstance(v, (int, long)) and not isinstance(v, bool):
+        return str(v)
+    return v
+
+
+def read_rows(table, f, fmt='csv'):
+    """Read the rows to be imported in a table
+
+    :param table: SmartTable instance
+    :param f: file-like object
+    :param fmt: 'csv' or 'json'
+    :type fmt: str
+    :returns: list of (line number, dict of fields or Alert)
+    """
+    assert fmt in FORMATS, "Unknown format %r" % fmt
+    if fmt == 'json':
+        return _read_json(f)
+
+    rows = []
+    for n, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('#'):
+            continue
+        try:
+            row = next(csv.reader([line], delimiter=' '))
+            rows.append((n, table._row_dict(row)))
+        except csv.Error as e:
+            rows.append((n, Alert("Invalid CSV: %s" % e)))
+    return rows
+
+
+def _read_json(f):
+    """Read a JSON list of objects or one JSON object per line"""
+    data = f.read()
+    if data.lstrip().startswith('['):
+        try:
+            objs = json.loads(data)
+        except ValueError as e:
+            raise Alert("Invalid JSON: %s" % e)
+        lines = [(n, o) for n, o in enumerate(objs, 1)]
+    else:
+        lines = []
+        for n, line in enumerate(data.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                lines.append((n, json.loads(line)))
+            except ValueError as e:
+                lines.append((n, Alert("Invalid JSON: %s" % e)))
+
+    rows = []
+    for n, o in lines:
+        if isinstance(o, dict):
+            o = dict((str(k), _str(v)) for k, v in o.iteritems())
+        elif not isinstance(o, Alert):
+            o = Alert("Expected an object")
+        rows.append((n, o))
+    return rows
+
+
+def import_rows(fs, name, f, fmt='csv', msg=None):
+    """Add the rows read from a file-like object to a table. The rows are
+    checked in one pass and added at once, writing the table once. If a
+    message is given, the configuration is then saved.
+
+    :param fs: FireSet instance
+    :param name: table name, see IMPORT_TABLES
+    :type name: str
+    :param f: file-like object
+    :param fmt: 'csv' or 'json'
+    :type fmt: str
+    :param msg: commit message (optional)
+    :type msg: str
+    :returns: (number of rows added, list of (line number, error message))
+    """
+    if name not in IMPORT_TABLES:
+        raise Alert("Rows cannot be imported in %s" % name)
+
+    table = fs.__dict__[name]
+    with fs.writing():
+        parsed = read_rows(table, f, fmt)
+        numbers = [n for n, d in parsed if not isinstance(d, Alert)]
+        rows = [d for n, d in parsed if not isinstance(d, Alert)]
+        errors = [(n, str(d)) for n, d in parsed if isinstance(d, Alert)]
+        known = fs._member_names() if name == 'hostgroups' else None
+        row_errors = table._check_new(rows, known)[1]
+        if not errors and not row_errors:
+            row_errors = table.add_many(rows)
+        errors.extend((numbers[i], e) for i, e in row_errors)
+        if errors:
+            return 0, sorted(errors)
+
+        if msg and rows:
+            fs.save(msg)
+    log.info("%d rows imported in %s" % (len(rows), name))
+    return len(rows), []
+
+
+def export_rows(fs, name, fmt='csv'):
+    """Export the rows of a table from a snapshot, one line at a time
+
+    :param fs: FireSet instance
+    :param name: table name
+    :type name: str
+    :param fmt: 'csv' or 'json'
+    :type fmt: str
+    :returns: generator of strings
+    """
+    assert fmt in FORMATS, "Unknown format %r" % fmt
+    if name not in fs._table_names:
+        raise Alert("Unknown table %s" % name)
+
+    table = fs.snapshot().__dict__[name]
+    if fmt == 'json':
+        return _export_json(table)
+    return _export_csv(table)
+
+
+def _export_csv(table):
+    yield "# %s\n" % ' '.join(table._fields)
+    buf = StringIO()
+    writer = csv.writer(buf, delimiter=' ', lineterminator='\n')
+    for row in table._rows():
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def _export_json(table):
+    yield '[\n'
+    line = None
+    for d in table.dicts():
+        if line is not None:
+            yield line + ',\n'
+        line = json.dumps(d, sort_keys=True)
+    if line is not None:
+        yield line + '\n'
+    yield ']\n'
@@ -14,20 +14,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
-from hashlib import sha512
+from collections import defaultdict, Mapping
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from functools import wraps
+from hashlib import sha1, sha512
 from itertools import product
 from logging import getLogger
 from netaddr import IPNetwork
+from operator import attrgetter
 from random import choice
-from subprocess import Popen, PIPE
 from time import time
 import csv
 import logging
+import marshal
 import os
 
-from firelet.flssh import SSHConnector, MockSSHConnector
-from firelet.flutils import Alert, Bunch, extract_all
+from firelet.flgit import open_repository
+from firelet.flssh import SSHConnector, MockSSHConnector, ROLLBACK_TIMEOUT
+from firelet.flutils import Alert, Bunch, FileLock, LRUCache, RWLock, \
+    extract_all, flag
 
 log = getLogger(__name__)
 
@@ -45,6 +51,26 @@ try:
 except ImportError: # pragma: no cover
     import simplejson as json
 
+# Number of version diffs kept in memory and in diff_cache_dir
+DIFF_CACHE_SIZE = 64
+DIFF_DISK_CACHE_SIZE = 1024
+
+# Journal of the edits done in a transaction, in the repository directory
+JOURNAL_FILENAME = '.firelet-journal'
+
+# Prepared tables, in the repository directory, see write_snapshot
+SNAPSHOT_FILENAME = '.firelet-snapshot'
+SNAPSHOT_FORMAT = 1
+
+# Lock and write counter shared by the processes using a repository,
+# see RepositoryState
+LOCK_FILENAME = '.firelet-lock'
+STATE_FILENAME = '.firelet-state'
+LOCK_TIMEOUT = 30
+
+# Operations accepted by FireSet.batch
+BATCH_OPS = ('move', 'enable', 'disable', 'update', 'add', 'delete')
+
 PROTOCOLS = ['AH', 'ESP', 'ICMP', 'IP', 'TCP', 'UDP']
 # protocols unsupported by iptables: 'IGMP','','OSPF', 'EIGRP','IPIP','VRRP',
 #  'IS-IS', 'SCTP', 'AH', 'ESP'
@@ -114,7 +140,24 @@ def clean(s):
 
 # Network objects
 
-class Rule(Bunch):
+class Row(Bunch):
+    """A table row. Its ID and version are kept in slots, apart from the
+    attributes: they are not part of the token and they are not saved.
+    The row ID is stable while the row is moved or updated, the version is
+    incremented every time the row changes.
+    """
+    __slots__ = ('row_id', 'row_version')
+
+    def attr_dict(self):
+        """Provide a copy of the internal dict, with a token, the row ID and
+        its version"""
+        d = super(Row, self).attr_dict()
+        d['row_id'] = getattr(self, 'row_id', None)
+        d['row_version'] = getattr(self, 'row_version', None)
+        return d
+
+
+class Rule(Row):
     """Firewall rule"""
 
     def enable(self):
@@ -126,7 +169,7 @@ class Rule(Bunch):
         self.enabled = '0'
 
 
-class Host(Bunch):
+class Host(Row):
     def __init__(self, r):
         """Creates a Host object
 
@@ -163,7 +206,7 @@ class Host(Bunch):
         return Network(['', self.ip_addr, self.masklen])
 
 
-class Network(Bunch):
+class Network(Row):
     def __init__(self, r):
         """Creates a Host object
 
@@ -205,7 +248,7 @@ class Network(Bunch):
             return addr_ok and net_ok
 
 
-class HostGroup(Bunch):
+class HostGroup(Row):
     """A Host Group contains hosts, networks, and other host groups"""
 
     def __init__(self, li):
@@ -221,20 +264,22 @@ class HostGroup(Bunch):
             childs = li[1:]
         self.childs = childs
 
-    def _flatten(self, i):
+    def _flatten(self, i, hg_by_name):
         """Flatten the host groups hierarchy
 
         :return: list of strings
         """
+        flatten = lambda x: self._flatten(x, hg_by_name)
         if hasattr(i, 'childs'):  # "i" is a hostgroup _object_!
             childs = i.childs
-            leaves = sum(map(self._flatten, childs), [])
+            leaves = sum(map(flatten, childs), [])
             for x in leaves:
                 assert isinstance(x, str)
             return leaves
-        if i in self._hbn:  # if "i" is a host group, fetch its childs:
-            childs = self._hbn[i]
-            leaves = sum(map(self._flatten, childs), [])
+        if i in hg_by_name:  # if "i" is a host group, fetch its childs:
+            childs = hg_by_name[i]
+            childs = getattr(childs, 'childs', childs)
+            leaves = sum(map(flatten, childs), [])
             for x in leaves:
                 assert isinstance(x, str)
             return leaves
@@ -248,13 +293,11 @@ class HostGroup(Bunch):
         :type host_by_name: dict
         :arg net_by_name: netname -> net
         :type net_by_name: dict
-        :arg hg_by_name: hgname -> hg
+        :arg hg_by_name: hgname -> hg or its child names
         :type hg_by_name: dict
         :returns: :class:`Host` or :class:`Network` instances
         """
-        self._hbn = hg_by_name
-        li = self._flatten(self)
-        del(self._hbn)
+        li = self._flatten(self, hg_by_name)
         def res(o):
             assert isinstance(o, str), repr(o)
             if o in host_by_name:
@@ -276,7 +319,7 @@ class HostGroup(Bunch):
 #        return filter(lambda i: type(i) == Host, self._flatten(self)) # better?
 #        return [n for n in self._flatten(self) if isinstance(n, Host)]
 
-class Service(Bunch):
+class Service(Row):
     """A network service using one protocol and one, many or no ports"""
     def __init__(self, **kw):
         super(Service, self).__init__(**kw)
@@ -333,11 +376,504 @@ class Table(list):
     def len(self):
         return len(self)
 
+def journaled(method):
+    """Record a successful call in the edit journal, if any, so that it can
+    be replayed after a crash"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._frozen:
+            raise Alert("Snapshots are read-only.")
+        out = method(self, *args, **kwargs)
+        journal = self._journal
+        if journal is not None and not journal.replaying:
+            journal.append([getattr(self, '_name', None), method.__name__,
+                args, kwargs])
+        return out
+    return wrapper
+
+
+def _json_str(v):
+    """Convert the unicode strings decoded from JSON to str"""
+    if isinstance(v, dict):
+        return dict((_json_str(k), _json_str(x)) for k, x in v.iteritems())
+    if isinstance(v, list):
+        return [_json_str(x) for x in v]
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    return v
+
+
+class Journal(object):
+    """Append-only journal of the edits kept in memory during a transaction.
+    Each record is a JSON line: [table name or None, method, args, kwargs]
+    A final ["commit", table names] record marks a flush in progress.
+    """
+
+    def __init__(self, fname):
+        self._fname = fname
+        self.replaying = False
+        # records kept in memory, see hold()
+        self._held = None
+
+    def append(self, record):
+        """Append a record and sync it to disk"""
+        if self._held is not None:
+            self._held.append(record)
+            return
+        self._write([record])
+
+    def _write(self, records):
+        with open(self._fname, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def hold(self):
+        """Keep the following records in memory until release()"""
+        self._held = []
+
+    def release(self, discard=False):
+        """Write the records kept since hold(), or discard them"""
+        held, self._held = self._held, None
+        if held and not discard:
+            self._write(held)
+
+    def records(self):
+        """Read the records. A truncated last record is ignored."""
+        try:
+            with open(self._fname) as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                log.warn("Ignoring truncated journal record")
+                break
+        return records
+
+    def clear(self):
+        """Remove the journal"""
+        if os.path.exists(self._fname):
+            os.unlink(self._fname)
+
+
+def _iface_key(host):
+    return "%s:%s" % (host.hostname, host.iface)
+
+
+class IndexView(Mapping):
+    """Read-only view of a hash index: key -> last item with the key"""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._index[key][-1]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
 class SmartTable(object):
-    """A list of Bunch instances. Each subclass is responsible to load and save files."""
-    def __init__(self, d):
+    """A list of Bunch instances. Each subclass is responsible to load and save files.
+
+    The list and its items are copied on write: changes rebind _list to a
+    new list and replace the items instead of modifying them, so that
+    readers iterating over the previous list are not affected.
+    """
+    # Incremented every time the table is changed
+    generation = 0
+    # Incremented every time the content changes, including reloads
+    version = 0
+    # True for the read-only copies returned by frozen()
+    _frozen = False
+    # Hash indexes: {index name: function returning the key of an item}
+    # They are updated on add, update, pop and reload.
+    _index_keys = {}
+    # Indexes whose function returns a list of keys
+    _multi_keys = ()
+    # Filters accepted by query(): {filter name: index names}
+    _filters = {'name': ('name',)}
+    # Index identifying the rows across reloads, see _assign_ids
+    _row_key = 'name'
+    _next_row_id = 1
+    # Field names, in the order of the CSV columns. The field named by
+    # _list_field is a list taking the remaining columns.
+    _fields = ()
+    _list_field = None
+    # Set by the FireSet when the directory is shared with other processes
+    _shared = None
+    # (inode, mtime, size) of the CSV file when last read or written
+    _sig = None
+    # Set during edit transactions: changes are journaled and written later
+    _journal = None
+    _pending = False
+
+    def __init__(self, d, items=None):
+        raise NotImplementedError
+
+    def _load(self, items=None):
+        """Load the table from the CSV file or from prepared items, as
+        provided by prepared()"""
+        if items is None:
+            self.reload()
+            return
+
+        cls = self._item_class
+        self._list = []
+        for d in items:
+            item = cls.__new__(cls)
+            item.__dict__ = d
+            self._list.append(item)
+        self._loaded()
+
+    def _file_sig(self):
+        """Signature of the CSV file: it changes every time the file is
+        replaced"""
+        try:
+            st = os.stat("%s/%s.csv" % (self._dir, self._name))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _loaded(self):
+        """Called when the table has been loaded from disk"""
+        self.version += 1
+        self._assign_ids()
+        self._reindex()
+        self._sig = self._file_sig()
+
+    def _new_row_id(self):
+        row_id = self._next_row_id
+        self._next_row_id = row_id + 1
+        return row_id
+
+    def _assign_ids(self):
+        """Give each loaded item the ID of the previous item having the
+        same key, incrementing its version if the item differs, or a new
+        ID. The indexes still refer to the previous items.
+        """
+        key = self._index_keys[self._row_key]
+        previous = {}
+        for items in self.__dict__.get('_index', {}).get('id', {}).values():
+            for item in items:
+                previous.setdefault(key(item), item)
+
+        for item in self._list:
+            prev = previous.pop(key(item), None)
+            if prev is None:
+                item.row_id = self._new_row_id()
+                item.row_version = 1
+            else:
+                item.row_id = prev.row_id
+                item.row_version = prev.row_version + \
+                    (prev.__dict__ != item.__dict__)
+
+    def frozen(self):
+        """Read-only copy of the table sharing the list and the items with
+        it: they are never changed in place, so later changes do not affect
+        the copy. The copy is reused until the table changes and builds its
+        indexes when first used.
+
+        :rtype: same class as the table
+        """
+        if self._frozen:
+            return self
+        t = self.__dict__.get('_frozen_copy')
+        if t is None or t.version != self.version:
+            t = self.__class__.__new__(self.__class__)
+            t.__dict__.update(_list=self._list, _dir=self._dir,
+                generation=self.generation, version=self.version,
+                _frozen=True)
+            self._frozen_copy = t
+        return t
+
+    def __getattr__(self, name):
+        if name == '_index' and self._frozen:
+            self._reindex()
+            return self._index
+        if name == '_positions' and self._frozen:
+            self._positions = dict((x.row_id, n)
+                for n, x in enumerate(self._list))
+            return self._positions
+        raise AttributeError(name)
+
+    def _position_map(self):
+        """Position of each row: {row ID: position}. Frozen copies keep it
+        as _positions"""
+        if self._frozen:
+            return self._positions
+        return dict((x.row_id, n) for n, x in enumerate(self._list))
+
+    def _reindex(self):
+        """Rebuild the hash indexes"""
+        self._index = dict((n, {}) for n in self._index_keys)
+        for item in self._list:
+            self._index_add(item)
+
+    def _keys(self, n, item):
+        """Keys of an item in an index"""
+        if n in self._multi_keys:
+            return set(self._index_keys[n](item))
+        return (self._index_keys[n](item),)
+
+    def _index_add(self, item):
+        if getattr(item, 'row_id', None) is None:
+            item.row_id = self._new_row_id()
+            item.row_version = 1
+        for n in self._index_keys:
+            for k in self._keys(n, item):
+                self._index[n].setdefault(k, []).append(item)
+
+    def _index_remove(self, item):
+        for n in self._index_keys:
+            for k in self._keys(n, item):
+                items = self._index[n].get(k, [])
+                if item in items:
+                    items.remove(item)
+                if not items:
+                    self._index[n].pop(k, None)
+
+    def index(self, name):
+        """Hash index as a read-only mapping: key -> item
+
+        :param name: index name, e.g. 'name'
+        :type name: str
+        :rtype: IndexView
+        """
+        return IndexView(self._index[name])
+
+    def lookup(self, name, key):
+        """Find the items having a key in a hash index
+
+        :param name: index name, e.g. 'name'
+        :type name: str
+        :returns: list of items
+        """
+        return list(self._index[name].get(key, ()))
+
+    def by_name(self, name):
+        """Find the items having a name
+
+        :returns: list of items
+        """
+        return self.lookup('name', name)
+
+    def by_id(self, row_id):
+        """Find an item by row ID
+
+        :returns: item or None
+        """
+        found = self._index['id'].get(row_id)
+        return found[-1] if found else None
+
+    def position(self, row_id, version=None):
+        """Position of a row in the table, to be used as rid
+
+        :param row_id: row ID
+        :type row_id: int
+        :param version: expected row version (optional)
+        :type version: int
+        :returns: int
+        """
+        item = self.by_id(row_id)
+        if item is None:
+            raise Alert("Item %s not found: it has been deleted in the "
+                "meantime." % row_id)
+        if version is not None and version != item.row_version:
+            raise Alert("Unable to update: item %s has been modified in the "
+                "meantime." % row_id)
+        return self._list.index(item)
+
+    def query(self, filters=None, search=None, sort=None, offset=0,
+            limit=None):
+        """Select, sort and slice the rows, e.g. to show a page of the table.
+        Filters are looked up in the hash indexes.
+
+        :param filters: {filter name: value}, see _filters
+        :type filters: dict
+        :param search: text to be found in any field, case insensitive
+        :type search: str
+        :param sort: field name, prefixed by "-" for descending order
+        :type sort: str
+        :param offset: number of rows skipped
+        :type offset: int
+        :param limit: maximum number of rows (optional)
+        :type limit: int
+        :returns: (number of rows selected, list of (position, item))
+        """
+        items = self._list
+        if filters:
+            ids = None
+            for f, key in filters.iteritems():
+                if f not in self._filters:
+                    raise Alert("Unknown filter '%s' for %s" % (f, self._name))
+                found = set(x.row_id for n in self._filters[f]
+                    for x in self._index[n].get(key, ()))
+                ids = found if ids is None else ids & found
+            positions = self._position_map()
+            selected = sorted(positions[i] for i in ids)
+        else:
+            selected = range(len(items))
+
+        if search:
+            search = search.lower()
+            rows = self._rows()
+            selected = [n for n in selected
+                if search in ' '.join(map(str, rows[n])).lower()]
+
+        if sort:
+            field = sort.lstrip('-')
+            if field not in self._fields:
+                raise Alert("Unknown field '%s' for %s" % (field, self._name))
+            if field == 'ip_addr':
+                key = lambda n: IPNetwork(items[n].ip_addr)
+            else:
+                key = lambda n: getattr(items[n], field)
+            selected.sort(key=key, reverse=sort.startswith('-'))
+
+        end = None if limit is None else offset + limit
+        return len(selected), [(n, items[n]) for n in selected[offset:end]]
+
+    def prepared(self):
+        """Copy of the attributes of each item, without validation or
+        parsing needed to load them again
+
+        :returns: list of dicts
+        """
+        return [dict(x.__dict__) for x in self._list]
+
+    def _rows(self):
+        """Rows to be written in the CSV file"""
         raise NotImplementedError
 
+    def _row_dict(self, row):
+        """Fields of a CSV row
+
+        :param row: column values
+        :type row: list
+        :rtype: dict
+        """
+        if self._list_field is None:
+            return dict(zip(self._fields, row))
+        d = dict(zip(self._fields[:-1], row))
+        d[self._list_field] = list(row[len(self._fields) - 1:])
+        return d
+
+    def dicts(self):
+        """Fields of each item, as used by add()
+
+        :returns: generator of dicts
+        """
+        return (self._row_dict(row) for row in self._rows())
+
+    def _new_item(self, f):
+        """Create an item from a dict of fields"""
+        raise NotImplementedError
+
+    def _checked(self, item):
+        """Validate and normalize an item to be imported"""
+        return item
+
+    def _check_new(self, rows, known=None):
+        """Create the items for new rows, validating them and looking for
+        duplicates in the table and among the rows
+
+        :param rows: dicts of fields
+        :type rows: list
+        :param known: names that the rows can refer to, see _check_items
+            (optional)
+        :type known: set
+        :returns: (items, errors) - errors is a list of (row number, message)
+        """
+        key = self._index_keys[self._row_key]
+        index = self._index[self._row_key]
+        items, numbers, errors, seen = [], [], [], set()
+        for n, f in enumerate(rows):
+            try:
+                missing = [x for x in self._fields if x not in f]
+                assert not missing, "Missing field: %s" % ', '.join(missing)
+                item = self._checked(self._new_item(f))
+            except Exception as e:
+                errors.append((n, str(e) or e.__class__.__name__))
+                continue
+            k = key(item)
+            if k in index or k in seen:
+                errors.append((n, "'%s' already defined" % k))
+                continue
+            seen.add(k)
+            items.append(item)
+            numbers.append(n)
+
+        bad = set()
+        for i, msg in self._check_items(items, known):
+            errors.append((numbers[i], msg))
+            bad.add(i)
+        items = [item for i, item in enumerate(items) if i not in bad]
+        return items, sorted(errors)
+
+    def _check_items(self, items, known):
+        """Check the new items together, e.g. for references among them
+
+        :returns: list of (item index, error message)
+        """
+        return []
+
+    @journaled
+    def add_many(self, rows):
+        """Add many items at once, checking all of them first: nothing is
+        added if any is invalid. The table is written once.
+
+        :param rows: dicts of fields, as taken by add()
+        :type rows: list
+        :returns: list of (row number, error message)
+        """
+        items, errors = self._check_new(rows)
+        if errors or not items:
+            return errors
+        self._list = self._list + items
+        for item in items:
+            self._index_add(item)
+        self.save()
+        return errors
+
+    def save(self):
+        """Save the table, or mark it to be saved at the end of the
+        current transaction"""
+        self.generation += 1
+        self.version += 1
+        if self._journal is not None:
+            self._pending = True
+        elif self._shared is None:
+            savecsv(self._name, self._rows(), self._dir)
+        else:
+            with self._shared.lock:
+                if self._sig != self._file_sig():
+                    # written by another process since it was loaded
+                    self.reload()
+                    raise Alert("The %s table has been changed in the "
+                        "meantime, please retry." % self._name)
+                savecsv(self._name, self._rows(), self._dir)
+                self._sig = self._file_sig()
+                self._shared.changed(saved=False)
+
+    def _write_pending(self):
+        """Write a table changed during a transaction to a temporary file
+
+        :returns: temporary file name or None
+        """
+        if not self._pending:
+            return None
+        return writecsv(self._name, self._rows(), self._dir)
+
     def __repr__(self):
         return repr(self._list)
 
@@ -351,8 +887,30 @@ class SmartTable(object):
         return self._list.__getitem__(i)
 
     def pop(self, i):
-        return self._list.pop(i)
-
+        li = list(self._list)
+        item = li.pop(i)
+        self._list = li
+        self._index_remove(item)
+        return item
+
+    def _copy(self, item):
+        """Copy an item, to be changed and then replace the original one"""
+        new = item.__class__.__new__(item.__class__)
+        new.__dict__ = dict(item.__dict__)
+        return new
+
+    def _replace(self, i, item):
+        """Replace the item at position i, keeping its row ID"""
+        li = list(self._list)
+        old = li[i]
+        item.row_id = old.row_id
+        item.row_version = old.row_version + 1
+        li[i] = item
+        self._list = li
+        self._index_remove(old)
+        self._index_add(item)
+
+    @journaled
     def update(self, d, rid=None, token=None):
         """Update internal dictionary based on d
 
@@ -374,74 +932,125 @@ class SmartTable(object):
             assert token == item._token(), "Unable to update: one " \
                 "or more items has been modified in the meantime."
 
+        item = self._copy(item)
         item.update(d)
+        self._replace(int(rid), item)
+        self.save()
+
+    @journaled
+    def move(self, rid, to):
+        """Move an item to another position
+
+        :param rid: position of the item
+        :type rid: int.
+        :param to: new position
+        :type to: int.
+        """
+        li = list(self._list)
+        if not (0 <= rid < len(li) and 0 <= to < len(li)):
+            raise Alert("Cannot move item %d to %d." % (rid, to))
+        li.insert(to, li.pop(rid))
+        self._list = li
         self.save()
 
 
 class Rules(SmartTable):
     """A list of Bunch instances"""
-    def __init__(self, d):
+    _name = 'rules'
+    _item_class = Rule
+    _index_keys = {
+        'id': attrgetter('row_id'),
+        'name': attrgetter('name'),
+        'src': attrgetter('src'),
+        'dst': attrgetter('dst'),
+        'src_serv': attrgetter('src_serv'),
+        'dst_serv': attrgetter('dst_serv'),
+    }
+    _filters = {
+        'name': ('name',),
+        'object': ('src', 'dst'),
+        'service': ('src_serv', 'dst_serv'),
+    }
+
+    def __init__(self, d, items=None):
         """Creates a Rules object
 
         Args:
             d (string): data directory
+            items (list): prepared rules (optional)
         """
         self._dir = d
-        self.reload()
+        self._load(items)
 
     def reload(self):
         """Load ruleset from file
         """
         li = readcsv('rules', self._dir)
-        self._list = []
+        rules = []
         for r in li:
             desc = r[8] if len(r) > 8 else ''
             rule = Rule(enabled=r[0], name=r[1], src=r[2],
                 src_serv=r[3], dst=r[4], dst_serv=r[5], action=r[6],
                 log_level=r[7], desc=desc)
-            self._list.append(rule)
+            rules.append(rule)
+        self._list = rules
+        self._loaded()
 
-    def save(self):
-        """Save the ruleset"""
-        li = [[x.enabled, x.name, x.src, x.src_serv, x.dst, x.dst_serv,
+    _fields = ('enabled', 'name', 'src', 'src_serv', 'dst', 'dst_serv',
+        'action', 'log_level', 'desc')
+
+    def _rows(self):
+        """Rows of the ruleset"""
+        return [[x.enabled, x.name, x.src, x.src_serv, x.dst, x.dst_serv,
                     x.action, x.log_level, x.desc] for x in self._list]
-        savecsv('rules', li, self._dir)
 
+    @journaled
     def moveup(self, rid):
         """Move a rule up"""
         try:
             assert rid >= 1
             b = rid - 1
-            self._list[rid], self._list[b] = self._list[b], self._list[rid]
+            li = list(self._list)
+            li[rid], li[b] = li[b], li[rid]
+            self._list = li
             self.save()
         except Exception as e:
             raise Alert("Cannot move rule %d up." % rid)
 
+    @journaled
     def movedown(self, rid):
         """Move a rule down"""
         try:
             b = rid + 1
-            self._list[rid], self._list[b] = self._list[b], self._list[rid]
+            li = list(self._list)
+            li[rid], li[b] = li[b], li[rid]
+            self._list = li
             self.save()
         except Exception as e:
             raise Alert("Cannot move rule %d down." % rid)
 
+    @journaled
     def disable(self, rid):
         """Disable a rule
 
         :param rid: Rule ID
         :type rid: int.
         """
-        self._list[rid].disable()
+        rule = self._copy(self._list[rid])
+        rule.disable()
+        self._replace(rid, rule)
         self.save()
 
+    @journaled
     def enable(self, rid):
         """Enable a rule
 
         :param rid: Rule ID
         :type rid: int.
         """
-        self._list[rid].enable()
+        rule = self._copy(self._list[rid])
+        rule.enable()
+        self._replace(rid, rule)
         self.save()
 
     def enabled(self, rid):
@@ -453,6 +1062,7 @@ class Rules(SmartTable):
         """
         return self._list[rid].enabled == '1'
 
+    @journaled
     def update(self, d, rid=None, token=None):
         """Update internal dictionary based on d"""
         assert rid is not None, "Malformed input row ID is missing."
@@ -465,9 +1075,12 @@ class Rules(SmartTable):
         if token:
             rule.validate_token(token)
 
+        rule = self._copy(rule)
         rule.update(d)
+        self._replace(int(rid), rule)
         self.save()
 
+    @journaled
     def add(self, d, rid=0):
         """Add a new item based on a dict of fields"""
         assert isinstance(rid, int)
@@ -476,63 +1089,172 @@ class Rules(SmartTable):
             d = dict(enabled='0', name='new', src='*', src_serv='*',
                 dst='*', dst_serv='*', action='ACCEPT', log_level=0, desc='')
 
-        if d['name'] in (rule.name for rule in self._list):
+        if self.by_name(d['name']):
             raise Alert("Another rule with the same name '%s' exists." % d['name'])
 
-        self._list.insert(rid, Rule(**d))
+        rule = Rule(**d)
+        li = list(self._list)
+        li.insert(rid, rule)
+        self._list = li
+        self._index_add(rule)
         self.save()
 
 
 class Hosts(SmartTable):
     """A list of Bunch instances"""
-    def __init__(self, d):
+    _name = 'hosts'
+    _item_class = Host
+    _index_keys = {
+        'id': attrgetter('row_id'),
+        'name': attrgetter('hostname'),
+        'iface': _iface_key,
+        'address': attrgetter('ip_addr'),
+        'routed': attrgetter('routed'),
+    }
+    _multi_keys = ('routed',)
+    _filters = {
+        'name': ('name',),
+        'address': ('address',),
+        'network': ('routed',),
+    }
+    _row_key = 'iface'
+
+    def __init__(self, d, items=None):
         self._dir = d
-        self.reload()
+        self._load(items)
 
     def reload(self):
         """Load hosts from file
         """
         li = readcsv('hosts', self._dir)
-        self._list = []
-        for r in li:
-            q = r[0:7] + [r[7:]]
-            b = Host(q)
-            self._list.append(b)
-
-    def save(self):
-        """Flatten the routed network list and save"""
-        li = [[x.hostname, x.iface, x.ip_addr, x.masklen, x.local_fw, x.network_fw, x.mng] + x.routed for x in self._list]
-        savecsv('hosts', li, self._dir)
-
+        self._list = [Host(r[0:7] + [r[7:]]) for r in li]
+        self._loaded()
+
+    _fields = ('hostname', 'iface', 'ip_addr', 'masklen', 'local_fw',
+        'network_fw', 'mng', 'routed')
+    _list_field = 'routed'
+
+    def _rows(self):
+        """Flatten the routed network list"""
+        return [[x.hostname, x.iface, x.ip_addr, x.masklen, x.local_fw, x.network_fw, x.mng] + x.routed for x in self._list]
+
+    def _new_item(self, f):
+        return Host([f[x] for x in self._fields])
+
+    def _checked(self, host):
+        assert host.hostname and host.iface, "Missing hostname or interface"
+        IPNetwork("%s/%s" % (host.ip_addr, host.masklen))
+        host.masklen = str(int(host.masklen))
+        for x in ('local_fw', 'network_fw', 'mng'):
+            host[x] = flag(host[x])
+        assert isinstance(host.routed, list), "Routed networks must be a list"
+        return host
+
+    @journaled
     def add(self, f):
         """Add a new item based on a dict of fields"""
-        names = ["%s:%s" % (x.hostname, x.iface) for x in self._list]
         me = "%s:%s" % (f['hostname'], f['iface'])
-        assert me not in names, "Host '%s' already defined" % me
-        li = [f[x] for x in ('hostname', 'iface', 'ip_addr', 'masklen', 'local_fw', 'network_fw', 'mng', 'routed')]
-        self._list.append(Host(li))
+        assert me not in self._index['iface'], "Host '%s' already defined" % me
+        host = self._new_item(f)
+        self._list = self._list + [host]
+        self._index_add(host)
         self.save()
 
+    def by_iface(self, hostname, iface):
+        """Find a host interface
+
+        :returns: :class:`Host` instance or None
+        """
+        found = self._index['iface'].get("%s:%s" % (hostname, iface))
+        return found[-1] if found else None
+
+    def by_address(self, ip_addr):
+        """Find the host interfaces having an address
+
+        :returns: list of :class:`Host` instances
+        """
+        return self.lookup('address', ip_addr)
+
 
 class HostGroups(SmartTable):
     """A list of Bunch instances"""
-    def __init__(self, d):
+    _name = 'hostgroups'
+    _item_class = HostGroup
+    _index_keys = {
+        'id': attrgetter('row_id'),
+        'name': attrgetter('name'),
+        'childs': attrgetter('childs'),
+    }
+    _multi_keys = ('childs',)
+    _filters = {
+        'name': ('name',),
+        'member': ('childs',),
+    }
+
+    def __init__(self, d, items=None):
         """
         .. automethod:: _simpleflatten
         """
         self._dir = d
-        self.reload()
+        self._load(items)
 
     def reload(self):
         """Load hostgroups from file
         """
         li = readcsv('hostgroups', self._dir)
         self._list = [HostGroup(r) for r in li]
+        self._loaded()
 
-    def save(self):
-        li = [[x.name] + x.childs for x in self._list]
-        savecsv('hostgroups', li, self._dir)
+    _fields = ('name', 'childs')
+    _list_field = 'childs'
+
+    def _rows(self):
+        return [[x.name] + x.childs for x in self._list]
+
+    def _new_item(self, f):
+        return HostGroup([f['name']] + f['childs'])
 
+    def _checked(self, hg):
+        assert hg.name, "Missing name"
+        return hg
+
+    def _check_items(self, hgs, known):
+        """Look for unknown children, if the known names are given, and for
+        loops among the host groups and the new ones
+        """
+        childs = dict((hg.name, hg.childs) for hg in self._list)
+        childs.update((hg.name, hg.childs) for hg in hgs)
+        errors = []
+        for i, hg in enumerate(hgs):
+            if known is not None:
+                unknown = [c for c in hg.childs
+                    if c not in known and c not in childs]
+                if unknown:
+                    errors.append((i, "Unknown member: %s" %
+                        ', '.join(unknown)))
+                    continue
+            if self._has_loop(hg.name, childs):
+                errors.append((i, "Loop detected in '%s'" % hg.name))
+        return errors
+
+    def _has_loop(self, name, childs):
+        """Check if a host group contains itself
+
+        :param childs: {host group name: children}
+        :type childs: dict
+        """
+        stack, visited = list(childs[name]), set()
+        while stack:
+            c = stack.pop()
+            if c == name:
+                return True
+            if c in visited or c not in childs:
+                continue
+            visited.add(c)
+            stack.extend(childs[c])
+        return False
+
+    @journaled
     def add(self, f):
         """Add a new hostgroup based and saves to disk.
 
@@ -541,10 +1263,10 @@ class HostGroups(SmartTable):
         """
         assert 'name' in f, '"name" field missing'
         assert 'childs' in f, '"childs" field missing'
-        names = [x.name for x in self._list]
-        assert f['name'] not in names, "Hostgroup '%s' already defined" % f['name']
-        li = [f['name']] + f['childs']
-        self._list.append(HostGroup(li))
+        assert not self.by_name(f['name']), "Hostgroup '%s' already defined" % f['name']
+        hg = self._new_item(f)
+        self._list = self._list + [hg]
+        self._index_add(hg)
         self.save()
 
     def _simpleflatten(self, node):
@@ -554,13 +1276,13 @@ class HostGroups(SmartTable):
         :type node:  str.
 
         """
-        for root_hg in self._list:
-            if node == root_hg.name:
-                m = map(self._simpleflatten, root_hg.childs)
-                return sum(m, [])
+        for root_hg in self.by_name(node)[:1]:
+            m = map(self._simpleflatten, root_hg.childs)
+            return sum(m, [])
         return [node]
 
 
+    @journaled
     def update(self, d, rid=None, token=None):
         """Perform loop checking before running the original "update" method.
         A loop happens when a HostGroup contains itself in one of its
@@ -588,7 +1310,9 @@ class HostGroups(SmartTable):
             flat = self._simpleflatten(child)
             assert item.name not in flat, "Loop "
 
+        item = self._copy(item)
         item.update(d)
+        self._replace(int(rid), item)
         self.save()
 
 #        super(HostGroups, self).update(d, rid, token)
@@ -596,51 +1320,117 @@ class HostGroups(SmartTable):
 
 class Networks(SmartTable):
     """A list of Bunch instances"""
-    def __init__(self, d):
+    _name = 'networks'
+    _item_class = Network
+    _index_keys = {
+        'id': attrgetter('row_id'),
+        'name': attrgetter('name'),
+        'address': attrgetter('ip_addr'),
+        # prefix index, see containing()
+        'prefix': attrgetter('ip_addr', 'masklen'),
+        'masklen': attrgetter('masklen'),
+    }
+    _filters = {
+        'name': ('name',),
+        'address': ('address',),
+    }
+
+    def __init__(self, d, items=None):
         self._dir = d
-        self.reload()
+        self._load(items)
 
     def reload(self):
         """Load networks from file
         """
         li = readcsv('networks', self._dir)
         self._list = [Network(r) for r in li]
+        self._loaded()
 
-    def save(self):
-        li = [[x.name, x.ip_addr, x.masklen] for x in self._list]
-        savecsv('networks', li, self._dir)
+    _fields = ('name', 'ip_addr', 'masklen')
+
+    def _rows(self):
+        return [[x.name, x.ip_addr, x.masklen] for x in self._list]
+
+    def _new_item(self, f):
+        return Network([f[x] for x in self._fields])
+
+    def _checked(self, net):
+        assert net.name, "Missing name"
+        return net
 
+    @journaled
     def add(self, f):
         """Add a new item based on a dict of fields"""
-        names = [x.name for x in self._list]
-        assert f['name'] not in names, "Network '%s' already defined" % f['name']
-        li = [f[x] for x in ('name', 'ip_addr', 'masklen')]
-        self._list.append(Network(li))
+        assert not self.by_name(f['name']), "Network '%s' already defined" % f['name']
+        net = self._new_item(f)
+        self._list = self._list + [net]
+        self._index_add(net)
         self.save()
 
+    def by_address(self, ip_addr):
+        """Find the networks having a network address
+
+        :returns: list of :class:`Network` instances
+        """
+        return self.lookup('address', ip_addr)
+
+    def containing(self, ip_addr):
+        """Find the networks containing an address by looking up its prefix
+        for each netmask length in use, instead of scanning the table.
+        Like Network.__contains__, the Internet network contains nothing.
+
+        :returns: list of :class:`Network` instances, longest prefix first
+        """
+        found = []
+        for masklen in sorted(self._index['masklen'], reverse=True):
+            try:
+                key = (net_addr(ip_addr, masklen), masklen)
+            except Exception:
+                continue    # e.g. an IPv4 address and an IPv6 netmask length
+            found.extend(net for net in self._index['prefix'].get(key, ())
+                if net.name != 'Internet')
+        return found
+
 
 class Services(SmartTable):
     """A list of Bunch instances"""
-    def __init__(self, d):
+    _name = 'services'
+    _item_class = Service
+    _index_keys = {
+        'id': attrgetter('row_id'),
+        'name': attrgetter('name'),
+    }
+
+    def __init__(self, d, items=None):
         self._dir = d
-        self.reload()
+        self._load(items)
 
     def reload(self):
         """Load service from file
         """
         li = readcsv('services', self._dir)
         self._list = [ Service(name=r[0], protocol=r[1], ports=r[2]) for r in li ]
+        self._loaded()
 
-    def save(self):
-        li = [[x.name, x.protocol, x.ports] for x in self._list]
-        savecsv('services', li, self._dir)
+    _fields = ('name', 'protocol', 'ports')
 
+    def _rows(self):
+        return [[x.name, x.protocol, x.ports] for x in self._list]
+
+    def _new_item(self, f):
+        return Service(**extract_all(f, self._fields))
+
+    def _checked(self, service):
+        assert service.name, "Missing name"
+        return service
+
+    @journaled
     def add(self, f):
         """Add a new item based on a dict of fields"""
-        d = extract_all(f, ('name', 'protocol', 'ports'))
-        names = [x.name for x in self._list]
-        assert d['name'] not in names, "Service '%s' already defined" % d['name']
-        self._list.append(Service(**d))
+        assert not self.by_name(f['name']), "Service '%s' already defined" % f['name']
+        service = self._new_item(f)
+        self._list = self._list + [service]
+        self._index_add(service)
         self.save()
 
 
@@ -657,9 +1447,18 @@ def readcsv(fn, d):
     with open("%s/%s.csv" % (d, fn)) as f:
         lines = map(str.rstrip, f)
 
-    if lines[0] != '# Format 0.1 - Do not edit this line':
-        raise Exception("Data format not supported in %s/%s.csv" \
-            % (d, fn))
+    return parsecsv(lines, "%s/%s.csv" % (d, fn))
+
+def parsecsv(lines, name):
+    """Parse the lines of a CSV file, ignore comments
+    :param lines: lines without line terminators
+    :type lines: list
+    :param name: file name used in error messages
+    :type name: str
+    :returns: list
+    """
+    if not lines or lines[0] != '# Format 0.1 - Do not edit this line':
+        raise Exception("Data format not supported in %s" % name)
 
     li = [x for x in lines if not x.startswith('#') and x]
     return csv.reader(li, delimiter=' ')
@@ -667,6 +1466,14 @@ def readcsv(fn, d):
 def savecsv(n, stuff, d):
     """Save CSV file safely, preserving comments"""
     fullname = "%s/%s.csv" % (d, n)
+    os.rename(writecsv(n, stuff, d), fullname)
+
+def writecsv(n, stuff, d):
+    """Write a CSV file to a temporary file, preserving comments
+
+    :returns: temporary file name
+    """
+    fullname = "%s/%s.csv" % (d, n)
     log.debug('Saving "%s" in "%s"...' % (n, d))
     try:
         f = open(fullname)
@@ -683,7 +1490,7 @@ def savecsv(n, stuff, d):
     f.flush()
     os.fsync(f.fileno())
     f.close()
-    os.rename(fullname + ".tmp", fullname)
+    return fullname + ".tmp"
 
 def loadjson(fn, d):
     """Load a JSON file
@@ -715,6 +1522,84 @@ def savejson(n, obj, d):
     f.close()
 
 
+# Snapshot of the prepared tables
+#
+# Parsing the CSV files and validating every item is the slowest part of
+# loading a FireSet. The prepared tables are stored with marshal beside the
+# CSV files, together with the mtime, size and SHA1 of every CSV and JSON
+# file. The CSV files remain the source of truth: the snapshot is used only
+# when all the files match it.
+
+def file_signatures(d):
+    """Get mtime, size and SHA1 of the CSV and JSON files in a directory
+
+    :param d: directory name
+    :type d: str
+    :returns: {filename: (mtime, size, sha1), ... }
+    :rtype: dict
+    """
+    sigs = {}
+    for fn in os.listdir(d):
+        if fn.startswith('.') or not fn.endswith(('.csv', '.json')):
+            continue
+        fullname = os.path.join(d, fn)
+        st = os.stat(fullname)
+        with open(fullname, 'rb') as f:
+            digest = sha1(f.read()).hexdigest()
+        sigs[fn] = (st.st_mtime, st.st_size, digest)
+    return sigs
+
+def write_snapshot(d, tables, head=None, clean=False):
+    """Write a snapshot of the prepared tables
+
+    :param d: directory name
+    :type d: str
+    :param tables: {table name: prepared items, ... }
+    :type tables: dict
+    :param head: Git HEAD matching the tables (optional)
+    :type head: str
+    :param clean: True if the tables have no uncommitted changes
+    :type clean: bool
+    """
+    snapshot = dict(
+        format=SNAPSHOT_FORMAT,
+        files=file_signatures(d),
+        tables=tables,
+        head=head,
+        clean=clean,
+    )
+    fullname = os.path.join(d, SNAPSHOT_FILENAME)
+    try:
+        with open(fullname + '.tmp', 'wb') as f:
+            marshal.dump(snapshot, f)
+        os.rename(fullname + '.tmp', fullname)
+    except (IOError, OSError, ValueError) as e:
+        log.warn("Unable to write snapshot: %s" % e)
+
+def read_snapshot(d):
+    """Read the snapshot of the prepared tables
+
+    :param d: directory name
+    :type d: str
+    :returns: snapshot dict or None if missing or stale
+    """
+    try:
+        with open(os.path.join(d, SNAPSHOT_FILENAME), 'rb') as f:
+            snapshot = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('format') != SNAPSHOT_FORMAT:
+        return None
+
+    if snapshot['files'] != file_signatures(d):
+        log.debug("Snapshot is stale")
+        return None
+
+    return snapshot
+
+
 # IP address parsing
 
 def net_addr(a, n):
@@ -722,14 +1607,92 @@ def net_addr(a, n):
     return str(q)
 
 
+class RepositoryState(object):
+    """Lock and write counter shared by the processes using a repository
+    directory, e.g. WSGI workers and the CLI. Every write increments the
+    counter: a process compares it with the last value it has seen to find
+    out when its tables may be stale.
+    """
+
+    def __init__(self, d):
+        self.lock = FileLock(os.path.join(d, LOCK_FILENAME),
+            timeout=LOCK_TIMEOUT)
+        self._fname = os.path.join(d, STATE_FILENAME)
+        self.seen = self.read()
+
+    def read(self):
+        """Read the state
+
+        :returns: {'generation': int, 'saved': True, False or None}
+        :rtype: dict
+        """
+        try:
+            with open(self._fname) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict(generation=0, saved=None)
+
+    def changed(self, saved):
+        """Increment the write counter. The lock must be held.
+
+        :param saved: True if the tables match the Git HEAD
+        :type saved: bool
+        """
+        state = self.read()
+        new = dict(generation=state['generation'] + 1, saved=saved)
+        with open(self._fname + '.tmp', 'w') as f:
+            json.dump(new, f)
+        os.rename(self._fname + '.tmp', self._fname)
+        # writes from other processes not seen yet are still to be checked
+        if state == self.seen:
+            self.seen = new
+
+
 class FireSet(object):
     """A container for the network objects.
     Upon instancing the objects are loaded.
     """
+    # True for snapshots, see FireSetSnapshot
+    _frozen = False
+
     def __init__(self):
         """Initialize FireSet"""
         self.SSHConnector = SSHConnector
         self._table_names = ('rules', 'hosts', 'hostgroups', 'services', 'networks')
+        # Interfaces rarely change: they are cached between checks
+        self._ifaces_cache = {}
+        # Edit transactions, see transaction()
+        self._journal = None
+        self._journal_fname = None
+        self._txn_depth = 0
+        self._txn_generations = {}
+        self._write_behind = False
+        # Shared with other processes, see RepositoryState
+        self._shared = None
+        # Shared by threads, see reading() and writing()
+        self._rwlock = RWLock()
+
+    def _generation(self):
+        """Sum of the generation counters of the tables: it changes every time
+        a table is written to disk"""
+        return sum(self.__dict__[t].generation for t in self._table_names)
+
+    @property
+    def version(self):
+        """Version of the tables: it increases every time they change,
+        including reloads. It can be used to tag cached output."""
+        return sum(self.__dict__[t].version for t in self._table_names)
+
+    def snapshot(self):
+        """Read-only view of the tables as they are now. It shares the items
+        with the tables, so taking it is cheap, and later changes do not
+        affect it: compiles, checks and map rendering can run on it while
+        the tables are being edited.
+
+        :rtype: :class:`FireSetSnapshot`
+        """
+        with self.reading():
+            return FireSetSnapshot(self)
 
     # FireSet management methods
     # They are redefined in each FireSet subclass
@@ -752,6 +1715,192 @@ class FireSet(object):
     def version_list(self):
         raise NotImplementedError
 
+    def refresh(self):
+        """Reload the tables changed by other processes
+
+        :returns: names of the reloaded tables
+        """
+        return []
+
+    def reading(self):
+        """Context manager: read the tables while other threads can only
+        read them. Multithreaded servers hold it while serving a request
+        that does not change the tables.
+        """
+        return self._rwlock.reading()
+
+    def writing(self):
+        """Context manager: change the tables while other threads wait.
+        Multithreaded servers hold it while serving a request that changes
+        the tables.
+        """
+        return self._rwlock.writing()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the write lock and the lock shared with other processes, if
+        any"""
+        with self.writing():
+            if self._shared is None:
+                yield
+            else:
+                with self._shared.lock:
+                    yield
+
+    def _changed(self, saved):
+        """Tell other processes that the tables have been written"""
+        if self._shared is not None:
+            self._shared.changed(saved)
+
+    # edit transactions
+
+    @contextmanager
+    def transaction(self):
+        """Edit transaction: the changes are kept in memory and recorded in
+        a journal, then each modified table is written once at the end.
+        Transactions can be nested. If the outermost one fails the changes
+        are discarded and the modified tables are reloaded.
+        """
+        self._begin()
+        try:
+            yield self
+        except:
+            self._txn_depth -= 1
+            if self._txn_depth == 0 and not self._write_behind:
+                try:
+                    self._abort()
+                finally:
+                    self._end()
+            raise
+        else:
+            self._txn_depth -= 1
+            if self._txn_depth == 0 and not self._write_behind:
+                try:
+                    self.flush()
+                finally:
+                    self._end()
+
+    def _begin(self):
+        """Start a transaction. The lock shared with other processes is held
+        until the end of the transaction and the stale tables are reloaded.
+        In write-behind mode the lock is held by GitFireSet.__init__
+        instead.
+        """
+        if self._journal is None:
+            if self._shared is not None and not self._write_behind:
+                if not self._shared.lock.acquire():
+                    raise Alert("The configuration is locked by another "
+                        "process.")
+                self.refresh()
+            self._set_journal(Journal(self._journal_fname))
+            self._txn_generations = dict((t, self.__dict__[t].generation)
+                for t in self._table_names)
+        self._txn_depth += 1
+
+    def _end(self):
+        """End the outermost transaction, releasing the lock shared with
+        other processes"""
+        self._set_journal(None)
+        if self._shared is not None:
+            self._shared.lock.release()
+
+    def _abort(self):
+        """Discard the changes of a failed transaction and reload the
+        tables it modified from disk"""
+        stale = [t for t in self._table_names if self.__dict__[t]._pending]
+        self._discard_pending()
+        for t in stale:
+            table = self.__dict__[t]
+            table.reload()
+            table.generation = self._txn_generations[t]
+        if stale:
+            log.warn("Transaction failed: %s reloaded" % ', '.join(stale))
+
+    def _set_journal(self, journal):
+        self._journal = journal
+        for t in self._table_names:
+            self.__dict__[t]._journal = journal
+
+    def flush(self):
+        """Write the tables modified in the current transaction.
+        The new files are written first, then a commit record is added to
+        the journal before replacing the tables.
+        """
+        if self._journal is None:
+            return
+
+        tables = [self.__dict__[t] for t in self._table_names]
+        written = [(t, t._write_pending()) for t in tables]
+        written = [(t, tmp_fn) for t, tmp_fn in written if tmp_fn]
+        if written:
+            self._journal.append(['commit', [t._name for t, fn in written]])
+            for t, tmp_fn in written:
+                os.rename(tmp_fn, tmp_fn[:-4])
+                t._pending = False
+                t._sig = t._file_sig()
+            self._changed(saved=False)
+        self._journal.clear()
+
+    def _discard_pending(self):
+        """Forget the changes not flushed yet, e.g. before a reset"""
+        if self._journal is not None:
+            self._journal.clear()
+        for t in self._table_names:
+            self.__dict__[t]._pending = False
+
+    def _recover(self):
+        """Complete an interrupted flush or replay the edits recorded in the
+        journal by an interrupted transaction. A journal in use by another
+        process is left alone.
+
+        :returns: True if the tables have been changed
+        """
+        if self._shared is None:
+            return self._replay_journal()
+
+        if not self._shared.lock.acquire(blocking=False):
+            log.debug("The journal is in use by another process")
+            return False
+        try:
+            return self._replay_journal()
+        finally:
+            self._shared.lock.release()
+
+    def _replay_journal(self):
+        journal = Journal(self._journal_fname)
+        records = journal.records()
+        tmp_fnames = ["%s/%s.csv.tmp" % (self.__dict__[t]._dir, t)
+            for t in self._table_names]
+        if records and records[-1][0] == 'commit':
+            log.warn("Completing interrupted write of %s" %
+                ', '.join(records[-1][1]))
+            for fn in tmp_fnames:
+                if os.path.exists(fn):
+                    os.rename(fn, fn[:-4])
+            for t in self._table_names:
+                self.__dict__[t].reload()
+            self._changed(saved=False)
+            journal.clear()
+            return True
+
+        for fn in tmp_fnames:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+        if not records:
+            journal.clear()
+            return False
+
+        log.warn("Replaying %d edits from the journal" % len(records))
+        with self.transaction():
+            self._journal.replaying = True
+            for target, method, args, kwargs in records:
+                obj = self if target is None else self.__dict__[target]
+                getattr(obj, method)(*args, **kwargs)
+            self._journal.replaying = False
+        self.flush()
+        return True
+
     # editing methods
 
     def fetch(self, table, rid):
@@ -764,10 +1913,92 @@ class FireSet(object):
             Alert( "Unable to fetch item %d in table %s: %s" % (rid, table, e))
 
 
-    def delete(self, table, rid):
+    def references(self, name, table=None):
+        """Find the rules, host groups and hosts referencing an object
+
+        :param name: object name. Hosts are named as <hostname>:<interface>
+        :type name: str
+        :param table: table containing the object (optional): only the
+            references valid for its kind of object are returned
+        :type table: str
+        :returns: {'rules': [...], 'hostgroups': [...], 'hosts': [...]}
+        :rtype: dict
+        """
+        if table == 'services':
+            fields = ('src_serv', 'dst_serv')
+        elif table is None:
+            fields = ('src', 'dst', 'src_serv', 'dst_serv')
+        else:
+            fields = ('src', 'dst')
+
+        rules = []
+        for f in fields:
+            for rule in self.rules.lookup(f, name):
+                if rule not in rules:
+                    rules.append(rule)
+
+        refs = dict(rules=rules, hostgroups=[], hosts=[])
+        if table != 'services':
+            refs['hostgroups'] = self.hostgroups.lookup('childs', name)
+        if table in (None, 'networks'):
+            refs['hosts'] = self.hosts.lookup('routed', name)
+        return refs
+
+    def _item_name(self, table, item):
+        """Name used to reference an item"""
+        if table == 'hosts':
+            return "%s:%s" % (item.hostname, item.iface)
+        return item.name
+
+    def _cascade(self, name, refs):
+        """Delete the rules referencing an object and remove the object from
+        host groups and routed networks"""
+        for hg in refs['hostgroups']:
+            new = self.hostgroups._copy(hg)
+            new.childs = [c for c in hg.childs if c != name]
+            self.hostgroups._replace(self.hostgroups.position(hg.row_id), new)
+        for h in refs['hosts']:
+            new = self.hosts._copy(h)
+            new.routed = [r for r in h.routed if r != name]
+            self.hosts._replace(self.hosts.position(h.row_id), new)
+        rids = [n for n, rule in enumerate(self.rules) if rule in refs['rules']]
+        for n in reversed(rids):
+            self.rules.pop(n)
+        log.info("Deleted %d rules referencing '%s'" % (len(rids), name))
+
+    @journaled
+    def delete(self, table, rid, on_reference='warn'):
         """Delete item from table
+
+        :param on_reference: what to do if rules, host groups or hosts
+            reference the item: 'warn' logs a warning, 'block' raises Alert,
+            'cascade' deletes the rules and removes the item from the host
+            groups and routed networks
+        :type on_reference: str
         """
         assert table in self._table_names, "Wrong table name for deletion: %s" % table
+        assert on_reference in ('warn', 'block', 'cascade'), \
+            "Unknown on_reference value: %s" % on_reference
+        try:
+            item = self.__dict__[table][rid]
+        except IndexError as e:
+            raise Alert("The element n. %d is not present in table '%s'" % \
+                (rid, table))
+
+        refs = {}
+        if table != 'rules':
+            name = self._item_name(table, item)
+            refs = self.references(name, table=table)
+        if any(refs.values()):
+            used_by = '; '.join("%s: %s" % (t, ', '.join(
+                self._item_name(t, i) for i in refs[t]))
+                for t in ('rules', 'hostgroups', 'hosts') if refs[t])
+            if on_reference == 'block':
+                raise Alert("'%s' cannot be deleted, it is used by %s" %
+                    (name, used_by))
+            elif on_reference == 'warn':
+                log.warn("Deleted '%s' is still used by %s" % (name, used_by))
+
         try:
             self.__dict__[table].pop(rid)
 
@@ -778,18 +2009,140 @@ class FireSet(object):
         except Exception as e:
             Alert("Unable to delete item %d in table %s: %s" % (rid, table, e))
 
+        changed = set([table])
+        if on_reference == 'cascade' and any(refs.values()):
+            self._cascade(name, refs)
+            changed.update(t for t in refs if refs[t])
+
+        # each changed table is saved once
+        for t in self._table_names:
+            if t in changed:
+                self.__dict__[t].save()
+
+    def batch(self, ops, atomic=True):
+        """Apply a list of operations in one transaction: each changed table
+        is written once. Rows are addressed by row ID and, optionally, row
+        version. If atomic is True the first failure undoes the operations
+        already applied and the following ones are skipped.
+        Row IDs are not stored on disk: each operation is journaled by
+        position, and the records of an undone batch are discarded.
+
+        Operations are dicts having "op" (see BATCH_OPS) and "table" keys:
+            move: row_id, to (new position)
+            enable, disable: row_id (rules only)
+            update: row_id, fields
+            add: fields, position (rules only, default 0)
+            delete: row_id, on_reference (default 'warn')
+
+        :param ops: operations
+        :type ops: list
+        :param atomic: all or nothing
+        :type atomic: bool
+        :returns: list of dicts, one for each operation, with "ok" and
+            "row_id", "row_version" or "error"
+        """
+        results = []
+        with self.writing():
+            with self.transaction():
+                tables = [self.__dict__[t] for t in self._table_names]
+                before = [(t, t._list, t.generation) for t in tables]
+                journal = self._journal
+                if journal is not None:
+                    journal.hold()
+                rolled_back = False
+                try:
+                    for op in ops:
+                        try:
+                            results.append(self._batch_op(_json_str(op)))
+                        except Exception as e:
+                            results.append(dict(ok=False,
+                                error=str(e) or e.__class__.__name__))
+                            if atomic:
+                                break
+
+                    if atomic and not all(r['ok'] for r in results):
+                        rolled_back = True
+                        for t, li, generation in before:
+                            if t._list is not li:
+                                t._list = li
+                                t._reindex()
+                                t.save()
+                                t.generation = generation
+                        results = [r if not r['ok'] else
+                            dict(ok=False, error="Rolled back")
+                            for r in results]
+                        results.extend(dict(ok=False, error="Skipped")
+                            for op in ops[len(results):])
+                finally:
+                    if journal is not None:
+                        journal.release(discard=rolled_back)
+
+        log.debug("Batch of %d operations: %d applied" % (len(ops),
+            sum(r['ok'] for r in results)))
+        return results
+
+    def _batch_op(self, op):
+        """Apply an operation of a batch"""
+        kind, name = op.get('op'), op.get('table')
+        assert kind in BATCH_OPS, "Unknown operation %r" % kind
+        assert name in self._table_names, "Unknown table %r" % name
+        table = self.__dict__[name]
+
+        if kind == 'add':
+            fields = op.get('fields') or {}
+            assert isinstance(fields, dict), "Fields must be an object"
+            if name == 'rules':
+                rid = int(op.get('position', 0))
+                table.add(fields, rid=rid)
+            else:
+                table.add(fields)
+                rid = len(table) - 1
+            item = table[rid]
+            return dict(ok=True, row_id=item.row_id,
+                row_version=item.row_version)
+
+        assert 'row_id' in op, "Missing row_id"
+        row_id = int(op['row_id'])
+        rid = table.position(row_id, op.get('row_version'))
+
+        if kind == 'delete':
+            self.delete(name, rid,
+                on_reference=op.get('on_reference', 'warn'))
+            return dict(ok=True, row_id=row_id)
+
+        if kind == 'move':
+            table.move(rid, int(op['to']))
+        elif kind in ('enable', 'disable'):
+            assert name == 'rules', "Only rules can be enabled or disabled"
+            getattr(table, kind)(rid)
+        else:
+            fields = op.get('fields')
+            assert isinstance(fields, dict), "Fields must be an object"
+            table.update(fields, rid=rid)
+
+        item = table.by_id(row_id)
+        return dict(ok=True, row_id=row_id, row_version=item.row_version)
+
+
+    def _member_names(self):
+        """Names that host groups can contain: host interfaces, networks and
+        host groups
+
+        :rtype: set
+        """
+        names = set(self.hostgroups.index('name'))
+        names.update(self.hosts.index('iface'))
+        names.update(self.networks.index('name'))
+        return names
 
     def list_sibling_names(self):
         """Return a list of all the possible siblings for a hostgroup
         being created or edited.
         """
-        items = set()
+        items = set(self.hostgroups.index('name'))
         for hg in self.hostgroups:
-            items.add(hg.name)
-            for c in hg.childs:
-                items.add(c)
-        for h in self.hosts:
-            items.add("%s:%s" % (h.hostname, h.iface))
+            items.update(hg.childs)
+        items.update(self.hosts.index('iface'))
         return sorted(items)
 
 
@@ -814,26 +2167,32 @@ class FireSet(object):
         if not items: return None
         return map(flatten1, items)
 
-    def _get_firewalls(self):
+    def _get_firewalls(self, hostnames=None):
         """Returns only the hosts that can be managed by Firelet
+
+        :param hostnames: restrict to the given firewall names (optional)
+        :type hostnames: list
         """
         # List host names that have *at least one* management interface
         firewall_names = set(h.hostname for h in self.hosts if int(h.mng))
+        if hostnames is not None:
+            firewall_names &= set(hostnames)
         return [h for h in self.hosts if h.hostname in firewall_names]
 
     def _get_confs(self, keep_sessions=False, username='firelet',
-            ssh_key_autoadd=True):
+            ssh_key_autoadd=True, hostnames=None):
         """Connect to the firewalls and fetch the existing configuration
         Return the SSHConnector instance if keep_sessions is True
         """
         self._remote_confs = None
         d = defaultdict(list) # {hostname: [management ip address list ], ... }
-        for h in self._get_firewalls():
+        for h in self._get_firewalls(hostnames=hostnames):
             d[h.hostname].append(h.ip_addr)
         sx = self.SSHConnector(
             targets=d,
             username=username,
-            ssh_key_autoadd=ssh_key_autoadd
+            ssh_key_autoadd=ssh_key_autoadd,
+            ifaces_cache=self._ifaces_cache,
         )
         log.debug("Running SSH.")
         self._remote_confs = sx.get_confs(logger=log)
@@ -843,9 +2202,33 @@ class FireSet(object):
         sx._disconnect()
         del(sx)
 
-    def _check_ifaces(self, stop_on_extra_interfaces=False):
+    def invalidate_ifaces_cache(self, hostnames=None):
+        """Drop the cached interfaces of the given firewalls, or of all of
+        them
+
+        :param hostnames: firewall names (optional)
+        :type hostnames: list
+        """
+        if hostnames is None:
+            self._ifaces_cache.clear()
+        else:
+            for hn in hostnames:
+                self._ifaces_cache.pop(hn, None)
+
+    def _check_ifaces(self, stop_on_extra_interfaces=False, hostnames=None):
         """Ensure that the interfaces configured on the hosts match
-            the contents of the host table"""
+            the contents of the host table. The cached interfaces are
+            dropped if they do not."""
+        try:
+            self._compare_ifaces(stop_on_extra_interfaces=
+                stop_on_extra_interfaces, hostnames=hostnames)
+        except (Alert, AssertionError):
+            self.invalidate_ifaces_cache(hostnames)
+            raise
+
+    def _compare_ifaces(self, stop_on_extra_interfaces=False, hostnames=None):
+        """Compare the interfaces configured on the hosts with the
+            contents of the host table, see _check_ifaces"""
         log.debug("Checking interfaces...")
         confs = self._remote_confs
         assert isinstance(confs, dict), "_remote_confs not populated " \
@@ -857,7 +2240,7 @@ class FireSet(object):
         # hostname -> interfaces_list
         ifaces = defaultdict(set)
 
-        for h in self._get_firewalls():
+        for h in self._get_firewalls(hostnames=hostnames):
             if not h.hostname in confs:
                 raise Alert("Host %s not available." % h.hostname)
 
@@ -874,7 +2257,13 @@ class FireSet(object):
                 raise Alert("Unable to parse IPv4 addr from '%s' on '%s'" % \
                     (ip_a_s, h.hostname))
 
-            if h.ip_addr not in (ip_addr_v6,  ip_addr_v4.split('/')[0] ):
+            # every address is available when ip_a_s contains Interface
+            # instances, otherwise only the primary ones
+            if hasattr(ip_a_s[h.iface], 'addresses'):
+                addrs = ip_a_s[h.iface].addresses()
+            else:
+                addrs = (ip_addr_v6,  ip_addr_v4.split('/')[0])
+            if h.ip_addr not in addrs:
                 msg = "Wrong address on %s on interface %s: %s and %s" \
                     "(should be %s)" % (h.hostname, h.iface, ip_addr_v4,
                     ip_addr_v6, h.ip_addr)
@@ -924,28 +2313,32 @@ class FireSet(object):
         { 'firewall_name': {'INPUT',[rules...]},{'OUTPUT',[rules...]},{'FORWARD',[rules...]}, ... }
 
         During the compilation many checks are performed."""
+        with self.reading():
+            return self._compile_rules()
+
+    def _compile_rules(self):
         assert not self.save_needed(), "Configuration must be saved before deployment."
 
         for rule in self.rules:
             assert rule.enabled in ('1', '0'), 'First field must be "1" or "0" in %s' % repr(rule)
-        log.debug('Building dictionaries...')
-        # build dictionaries to perform resolution
-        addr = dict(((h.hostname + ":" + h.iface), h.ip_addr) for h in self.hosts) # host to ip_addr
-        net = dict((n.name, (n.ip_addr, n.masklen)) for n in self.networks) # network name to addressing
+        # the hash indexes of the tables are used to perform resolution
+        host_by_name_col_iface = self.hosts.index('iface')
+        net_by_name = self.networks.index('name')
+        hg_by_name = self.hostgroups.index('name')
+        services = self.services.index('name')
 
         for h in self.hosts:
             for routed_net in h.routed:
-                assert routed_net in net, "Unknown network '%s' routed by %s" \
+                assert routed_net in net_by_name, "Unknown network '%s' routed by %s" \
                     % (routed_net, h.hostname)
 
-        proto_port = dict((sr.name, (sr.protocol, sr.ports)) for sr in self.services) # protocol
-        proto_port['*'] = (None, '') # special case for "any"      # port format: "2:4,5:10,10:33,40,50"
-
-        host_by_name_col_iface = dict((h.hostname + ":" + h.iface, h) for h in self.hosts)
-        host_by_name = dict((h.hostname, h) for h in self.hosts)
-        net_by_name = dict((n.name, n) for n in self.networks)
-
-        hg_by_name = dict((hg.name, hg.childs) for hg in self.hostgroups)  # hg name  to its child names
+        def proto_port(name):
+            """Protocol and ports of a service
+            port format: "2:4,5:10,10:33,40,50" """
+            if name == '*': # special case for "any"
+                return None, ''
+            sr = services[name]
+            return sr.protocol, sr.ports
 
         flat_hg = dict((hg.name, hg.flat(host_by_name_col_iface, net_by_name, hg_by_name)) for hg in self.hostgroups)
 
@@ -979,8 +2372,8 @@ class FireSet(object):
             srcs = res(rule.src)
             dsts = res(rule.dst)    # list of Host and Network instances
 
-            sproto, sports = proto_port[rule.src_serv]
-            dproto, dports = proto_port[rule.dst_serv]
+            sproto, sports = proto_port(rule.src_serv)
+            dproto, dports = proto_port(rule.dst_serv)
             assert sproto in PROTOCOLS + [None], """Unknown source
                 protocol: %s""" % sproto
             assert dproto in PROTOCOLS + [None], """Unknown dest
@@ -1098,11 +2491,12 @@ class FireSet(object):
                 if h.network_fw in ('0', 0, False):
                     continue
                 # resolved routed nets [[addr, masklen], [addr, masklen], ... ]
-                resolved_routed = [net[r] for r in h.routed]
+                resolved_routed = [(net_by_name[r].ip_addr,
+                    net_by_name[r].masklen) for r in h.routed]
                 nets = [IPNetwork("%s/%s" %(y, w)) for y, w in resolved_routed]
 
-                other_ifaces = [k for k in self.hosts
-                    if k.hostname == h.hostname and k.iface != h.iface]
+                other_ifaces = [k for k in self.hosts.lookup('name', h.hostname)
+                    if k.iface != h.iface]
 
                 forw = self._oo_forwarded(src, dst, h, resolved_routed,
                                           other_ifaces)
@@ -1233,44 +2627,65 @@ class FireSet(object):
         return self.compile_rules()
 
     def deploy(self, ignore_unreachables=False, replace_ruleset=False,
-        stop_on_extra_interfaces=False):
+        stop_on_extra_interfaces=False, rollback_timeout=ROLLBACK_TIMEOUT,
+        status=None, hostnames=None):
         """Check and then deploy the configuration to the firewalls.
         Some ignore flags can be set to force the deployment even in case of errors.
+
+        The configuration is deployed using a two-phase commit: each firewall
+        is confirmed as soon as it is reachable with the new ruleset and
+        rolls back by itself if not confirmed within rollback_timeout seconds.
+
+        :param status: dict updated with the progress of each firewall
+            (optional)
+        :type status: dict
+        :param hostnames: deploy only on the given firewalls (optional)
+        :type hostnames: list
+        :returns: diff between compiled and deployed rules, see check()
+        :rtype: dict
         """
         if self.save_needed():
             raise Alert("Configuration must be saved before deployment.")
 
         comp_rules = self.compile_rules()
-        log.debug('Rules compiled. Fetching configurations.')
-        sx = self._get_confs(keep_sessions=True)
+        log.debug('Rules compiled.')
+        return self._deploy(comp_rules, hostnames=hostnames,
+            stop_on_extra_interfaces=stop_on_extra_interfaces,
+            rollback_timeout=rollback_timeout, status=status)
+
+    def _deploy(self, comp_rules, hostnames=None,
+        stop_on_extra_interfaces=False, rollback_timeout=ROLLBACK_TIMEOUT,
+        status=None):
+        """Deploy compiled rules to the firewalls, then fetch the live
+        configurations and return the diff against the compiled rules
+        """
+        if hostnames is not None:
+            comp_rules = dict((hn, r) for hn, r in comp_rules.iteritems()
+                if hn in hostnames)
+        log.debug('Fetching configurations.')
+        sx = self._get_confs(keep_sessions=True, hostnames=hostnames)
         log.debug('Checking interfaces.')
-        self._check_ifaces(stop_on_extra_interfaces=stop_on_extra_interfaces)
+        self._check_ifaces(stop_on_extra_interfaces=stop_on_extra_interfaces,
+            hostnames=hostnames)
         log.debug('Interface check complete.')
         self._remote_confs = None
         m = map(self._build_ipt_restore, comp_rules.iteritems())
         c = dict(m)
-        log.debug('Delivering configurations...')
-        sx.deliver_confs(c)
-
-        log.debug('Saving existing configurations...')
-        sx.save_existing_confs()
-
-        log.debug('Setting up automatic rollback...')
-        out = sx.setup_auto_rollbacks()
-        if out:
-            raise Alert('Automated rollback enabling failed on %s' % out)
-
-        log.debug('Applying configurations...')
-        sx.apply_remote_confs()
-
+        log.debug('Committing configurations...')
+        status = sx.commit_confs(c, rollback_timeout=rollback_timeout,
+            status=status)
         sx._disconnect()
-        sx.log_ping()
 
-        log.debug('Cancelling automatic rollback...')
-        sx.cancel_auto_rollbacks()
+        failed = sorted(hn for hn, st in status.iteritems()
+            if st != 'confirmed')
+        if failed:
+            for hn in failed:
+                log.error("Deployment failed on %s: %s" % (hn, status[hn]))
+            raise Alert('Deployment failed on %s: the previous configuration '
+                'is being restored.' % ', '.join(failed))
 
         log.debug('Fetching live configurations...')
-        self._get_confs(keep_sessions=False)
+        self._get_confs(keep_sessions=False, hostnames=hostnames)
         diff = self._diff_compiled_and_remote_rules(comp_rules)
 
         if diff:
@@ -1280,6 +2695,8 @@ class FireSet(object):
         else:
             log.debug('Deployment completed.')
 
+        return diff
+
     def get_rsa_pub(self):
         """Read RSA public key from ~/.ssh/id_rsa.pub
 
@@ -1328,43 +2745,103 @@ in %s does not look valid" % id_rsa_fn
         #TODO: test assimilation process
 
 
+class FireSetSnapshot(FireSet):
+    """Read-only view of a FireSet, see FireSet.snapshot()"""
+    _frozen = True
+
+    def __init__(self, fs):
+        """Take a snapshot of a FireSet. Its read lock must be held.
+
+        :param fs: FireSet instance
+        :type fs: FireSet
+        """
+        super(FireSetSnapshot, self).__init__()
+        self.SSHConnector = fs.SSHConnector
+        self._table_names = fs._table_names
+        self._ifaces_cache = fs._ifaces_cache
+        for t in self._table_names:
+            self.__dict__[t] = fs.__dict__[t].frozen()
+        self._save_needed = fs.save_needed()
+
+    def save_needed(self):
+        return self._save_needed
+
+    def snapshot(self):
+        return self
+
+
 class GitFireSet(FireSet):
     """FireSet implementing Git to manage the configuration repository"""
-    def __init__(self, repodir):
-        self.rules = Rules(repodir)
-        self.hosts = Hosts(repodir)
-        self.hostgroups = HostGroups(repodir)
-        self.services = Services(repodir)
-        self.networks = Networks(repodir)
+    def __init__(self, repodir, diff_cache_dir=None, write_behind=False):
+        """Load the tables and open the Git repository, creating it if needed
+
+        :param repodir: configuration repository directory
+        :type repodir: str
+        :param diff_cache_dir: directory used to store version diffs
+            (optional)
+        :type diff_cache_dir: str
+        :param write_behind: keep a transaction always open: the changes are
+            journaled and the tables are written only by flush() and save()
+        :type write_behind: bool
+        """
+        super(GitFireSet, self).__init__()
         self._git_repodir = repodir
         self._locate_git_executable()
-        if 'fatal: Not a git repository' in self._git('status')[1]:
+        self._repo = open_repository(repodir, self._git_executable)
+        self._shared = RepositoryState(repodir)
+        # Use the prepared tables if the CSV files did not change
+        snapshot = read_snapshot(repodir)
+        tables = snapshot['tables'] if snapshot else {}
+        self.rules = Rules(repodir, tables.get('rules'))
+        self.hosts = Hosts(repodir, tables.get('hosts'))
+        self.hostgroups = HostGroups(repodir, tables.get('hostgroups'))
+        self.services = Services(repodir, tables.get('services'))
+        self.networks = Networks(repodir, tables.get('networks'))
+        for t in self._table_names:
+            self.__dict__[t]._shared = self._shared
+        # Commit metadata, newest first, see _update_version_index
+        self._version_index = []
+        self._version_index_pos = {}
+        self._version_index_head = None
+        self._diff_cache = LRUCache(maxsize=DIFF_CACHE_SIZE,
+            directory=diff_cache_dir, disk_maxsize=DIFF_DISK_CACHE_SIZE)
+        self._journal_fname = os.path.join(repodir, JOURNAL_FILENAME)
+        recovered = self._recover()
+        if not self._repo.is_repository():
             self._create_new_git_repository()
-
-        super(GitFireSet, self).__init__()
+            snapshot = None
+
+        # Generation of the tables when they were last known to match the
+        # Git HEAD. Uncommitted changes found at startup make it stale.
+        # The snapshot tells if the tables were committed at the same HEAD.
+        self._saved_generation = self._generation()
+        head = self._repo.head()
+        if snapshot and not recovered and snapshot['clean'] and \
+                snapshot['head'] == head:
+            log.debug("Tables loaded from snapshot")
+        elif self._git_save_needed():
+            self._saved_generation = None
+
+        clean = self._saved_generation is not None
+        if snapshot is None or recovered or \
+                (snapshot['head'], snapshot['clean']) != (head, clean):
+            self._write_snapshot(clean, head)
+
+        if write_behind:
+            # other processes are locked out until the end
+            if not self._shared.lock.hold():
+                raise Alert("The configuration is locked by another "
+                    "process.")
+            self._write_behind = True
+            self._begin()
 
     def _create_new_git_repository(self):
         """Set up new Git configuration repository
         """
         log.info('Creating new Git repository...')
-        out, err = self._git('init .')
-        assert out.startswith('Initialized empty Git repository')
-
-        out, err = self._git('config user.name Firelet')
-        assert not err, "Config error: %r" % err
-
-        out, err = self._git('add *.csv *.json')
-
-        out, err = self._git('commit -m "Configuration database created." *.csv *.json')
-        assert not err, "Commit error: %r" % err
-        assert 'files changed, ' in out
-
-        assert not self.save_needed(), self._git('status -uno')
-
-        out = self._git('rev-parse --show-toplevel')
-        git_toplevel_dir = out[0].strip()
-        assert git_toplevel_dir == self._git_repodir
-
+        self._repo.init("Configuration database created.")
+        assert not self._git_save_needed(), self._git('status -uno')
+        assert self._repo.toplevel() == self._git_repodir
         log.info('Git repository created')
 
     def _locate_git_executable(self):
@@ -1378,31 +2855,79 @@ class GitFireSet(FireSet):
 
         raise EnvironmentError("Git executable not found.")
 
-    def version_list(self):
-        """Parse git log --date=iso
+    def _update_version_index(self):
+        """Update the index of commits, newest first. Commits are immutable:
+        only the ones added since the last update are read.
+        """
+        head = self._repo.head()
+        if head == self._version_index_head:
+            return
+
+        new = []
+        pos = self._version_index_pos.get(head)
+        if pos is not None:
+            # HEAD moved back in history, e.g. after a rollback
+            index = self._version_index[pos:]
+        else:
+            connected = False
+            old_head = self._version_index_head
+            for commit, author, date, msg, parents in self._repo.log(
+                    start=head, stop=[old_head] if old_head else None):
+                if old_head in parents:
+                    connected = True
+                if parents:
+                    new.append([author, date, msg, commit])
+            index = self._version_index if connected else []
+
+        self._version_index = new + index
+        self._version_index_pos = dict((v[3], n)
+            for n, v in enumerate(self._version_index))
+        self._version_index_head = head
+
+    def version_list(self, offset=0, limit=None, cursor=None):
+        """List the commits, newest first. The initial commit creating the
+        repository is not listed.
+
+        :param offset: number of commits to skip
+        :type offset: int
+        :param limit: maximum number of commits (optional)
+        :type limit: int
+        :param cursor: list the commits older than the given commit ID
+            (optional). Unlike offset it is not affected by new commits.
+        :type cursor: str
+        :returns: a list of lists: [ [author, date, [msg lines], commit_id ], ... ]
+        """
+        self._update_version_index()
+        if cursor:
+            try:
+                offset += self._version_index_pos[cursor] + 1
+            except KeyError:
+                raise Alert("Unknown commit ID: %s" % cursor)
+
+        if limit is None:
+            return self._version_index[offset:]
+
+        return self._version_index[offset:offset + limit]
 
-        Returns:
-            a list of lists: [ [author, date, [msg lines], commit_id ], ... ]
+    def _cached_diff(self, kind, commit_id, func):
+        """Run func(commit_id, other) to diff a commit against the working
+        tree. When no save is needed the working tree matches HEAD: the diff
+        is between two immutable commits and is cached.
         """
-        o, e = self._git('log --date=iso')
-        if e:
-            Alert("Error while running 'git log --date=iso': %s" % e)
-        li = []
-        msg = []
-        author = None
-        for r in o.split('\n'):
-            if r.startswith('commit '):
-                if author:
-                    li.append([author, date, msg, commit])
-                commit = r[7:]
-                msg = []
-            elif r.startswith('Author: '):
-                author = r[8:]
-            elif r.startswith('Date: '):
-                date = r[8:]
-            elif r:
-                msg.append(r.strip())
-        return li
+        self._validate_commit_id(commit_id)
+        if self.save_needed():
+            self.flush()
+            return func(commit_id, None)
+
+        old = self._repo.resolve(commit_id)
+        if old is None:
+            raise Alert("Unknown commit ID: %s" % commit_id)
+        key = (kind, old, self._repo.head())
+        diff = self._diff_cache.get(key)
+        if diff is None:
+            diff = func(old, key[2])
+            self._diff_cache.put(key, diff)
+        return diff
 
     def version_diff(self, commit_id):
         """Parse git diff <commit_id>
@@ -1411,11 +2936,51 @@ class GitFireSet(FireSet):
 
         :returns: modified lines (list)
         """
+        li = self._cached_diff('text', commit_id, self._text_diff)
+        return map(tuple, li)
+
+    def version_diff_tables(self, commit_id):
+        """Compare the tables in a commit with the current ones row by row
+
+        :returns: {table name: {'added': [[row number, row], ... ],
+            'removed': [[row number, row], ... ]}, ... } - unchanged
+            tables are omitted
+        """
+        return self._cached_diff('tables', commit_id, self._tables_diff)
+
+    def _read_table_rows(self, table, commit_id=None):
+        """Read the rows of a table from a commit or from the working tree"""
+        if commit_id is None:
+            return map(tuple, readcsv(table, self._git_repodir))
+
+        content = self._repo.read_file(commit_id, "%s.csv" % table)
+        if content is None:
+            return []
+        lines = map(str.rstrip, content.split('\n'))
+        return map(tuple, parsecsv(lines, "%s.csv" % table))
+
+    def _tables_diff(self, commit_id, other):
+        """Row by row diff of the tables between commit_id and other (or the
+        working tree)"""
+        diff = {}
+        for table in self._table_names:
+            old = self._read_table_rows(table, commit_id)
+            new = self._read_table_rows(table, other)
+            added, removed = [], []
+            sm = SequenceMatcher(None, old, new, autojunk=False)
+            for tag, i1, i2, j1, j2 in sm.get_opcodes():
+                if tag in ('replace', 'delete'):
+                    removed.extend([n, list(old[n])] for n in xrange(i1, i2))
+                if tag in ('replace', 'insert'):
+                    added.extend([n, list(new[n])] for n in xrange(j1, j2))
+            if added or removed:
+                diff[table] = dict(added=added, removed=removed)
+        return diff
+
+    def _text_diff(self, commit_id, other):
+        """Parse the output of git diff"""
         tags = {'+': 'add', '-': 'del',  ' ': '',  '':''}
-        o, e = self._git('diff %s' % commit_id)
-        if e:
-            Alert("Error while runnig 'git diff %s': %s" % \
-                (commit_id, e))
+        o = self._repo.diff(commit_id, other)
         li = []
         for x in o.split('\n'):
             x = x.rstrip()
@@ -1435,99 +3000,136 @@ class GitFireSet(FireSet):
                 li.append((x[1:], tag))
         return li
 
+    def _validate_commit_id(self, commit_id):
+        """Ensure a commit ID cannot be mistaken for a git option"""
+        if not commit_id or commit_id.startswith('-') or \
+                not commit_id.replace('~', '').replace('^', '').isalnum():
+            raise Alert("Invalid commit ID: %r" % commit_id)
+
+    def _write_snapshot(self, clean, head=None):
+        """Write a snapshot of the prepared tables, see write_snapshot
+
+        :param clean: True if the tables match the Git HEAD
+        :type clean: bool
+        :param head: Git HEAD (optional)
+        :type head: str
+        """
+        tables = dict((t, self.__dict__[t].prepared())
+            for t in self._table_names)
+        write_snapshot(self._git_repodir, tables,
+            head=head or self._repo.head(), clean=clean)
+
     def _git(self, cmd):
-        """Run Git in a shell process
+        """Run Git, used for diagnostics
 
         :param cmd: git command
         :type cmd: str
+        :returns: (stdout, stderr)
         """
-        p = Popen("%s %s" % (self._git_executable, cmd), shell=True,
-            cwd=self._git_repodir, stdout=PIPE, stderr=PIPE)
-        p.wait()
-        return p.communicate()
+        code, out, err = self._repo.run(*cmd.split())
+        return out, err
 
     def save(self, msg):
         """Commit changes if needed."""
         if not msg:
             msg = '(no message)'
 
-        self._git("add *")
-        self._git("commit -a -m '%s'" % msg)
-
-    def reload(self):
-        """Reload all the tables from disk
+        with self._locked():
+            self.flush()
+            self._repo.commit(msg)
+            self._saved_generation = self._generation()
+            self._changed(saved=True)
+        self._write_snapshot(True)
+        if self._version_index_head:
+            self._update_version_index()
+
+    def reload(self, tables=None):
+        """Reload the tables from disk. They are expected to match the
+        Git HEAD.
+
+        :param tables: names of the tables to be reloaded (default: all)
+        :type tables: list
         """
         msg = ''
         for table_name in self._table_names:
+            if tables is not None and table_name not in tables:
+                continue
             table = self.__dict__[table_name]
             table.reload()
             msg += "%d %s, " % (len(table), table_name)
+        self._saved_generation = self._generation()
+        self._write_snapshot(True)
         log.debug("%s reloaded" % msg)
 
+    def _reset_to(self, rev):
+        """Hard reset to a revision, then reload only the tables whose files
+        changed or that had changes not written yet"""
+        with self._locked():
+            self.refresh()
+            stale = set(t for t in self._table_names
+                if self.__dict__[t]._pending)
+            self._discard_pending()
+            for fn in self._repo.changed_files(rev):
+                if fn.endswith('.csv') and fn[:-4] in self._table_names:
+                    stale.add(fn[:-4])
+            self._repo.reset(rev)
+            self.reload(stale)
+            self._changed(saved=True)
+
     def reset(self):
         """Reset Git to last commit."""
-        o, e = self._git('reset --hard')
-        assert 'HEAD is now at' in o, \
-            "Git reset --hard output: '%s' error: '%s'" % (o, e)
-        self.reload()
+        self._reset_to('HEAD')
 
     def rollback(self, n=None, commit_id=None):
         """Rollback to n commits ago or given a specific commit_id
         """
         assert n is not None or commit_id, "n or commit_id must be specified"
-        self.reset()
         if n:
             try:
                 n = int(n)
             except ValueError:
                 raise Alert("rollback requires an integer")
+            commit_id = "HEAD~%d" % n
 
-            o, e = self._git("reset --hard HEAD~%d" % n)
-            assert 'HEAD is now at' in o, \
-                "Git reset --hard HEAD~%d output: '%s' error: '%s'" % (n, o, e)
-            self.reload()
-        else:
-            o, e = self._git("reset --hard %s" % commit_id)
-            assert 'HEAD is now at' in o, "Git reset --hard " \
-                "%s output: '%s' error: '%s'" % (commit_id, o, e)
-            self.reload()
+        self._validate_commit_id(commit_id)
+        self._reset_to(commit_id)
 
     def save_needed(self):
-        """True if commit is required: files has been changed"""
-        self._git("add *.csv *.json")
-        o, e = self._git('status -uno')
-        #log.debug("Git status: %r" % o)
-        if 'nothing to commit ' in o:
-            return False
-
-        elif 'Changes to be committed' in o:
-            return True
-
-        else:
-            raise Alert("Git status output: '%s' error: '%s'" % (o, e))
-
-    # GitFireSet editing
+        """True if commit is required: the tables have been written since
+        the last save, reset or rollback
+        """
+        return self._generation() != self._saved_generation
 
-    def _write(self, table):
-        """Write the changes to disk without committing on Git"""
-        if table == 'hosts':
-            self.hosts.save()
-        elif table == 'networks':
-            self.networks.save()
-        elif table == 'services':
-            self.services.save()
-        elif table == 'rules':
-            self.rules.save()
-        elif table == 'hostgroups':
-            self.hostgroups.save()
-        else:
-            raise Exception("Table %s not existing" % table)
+    def refresh(self):
+        """Reload the tables written by other processes since the last
+        check. When nothing has been written only the shared write counter
+        is read.
 
-    def delete(self, table, rid):
-        """Delete item from table
+        :returns: names of the reloaded tables
         """
-        super(GitFireSet, self).delete(table, rid)
-        self._write(table)
+        state = self._shared.read()
+        if state == self._shared.seen:
+            return []
+
+        stale = []
+        with self.writing():
+            for t in self._table_names:
+                table = self.__dict__[t]
+                if not table._pending and table._sig != table._file_sig():
+                    table.reload()
+                    stale.append(t)
+            self._shared.seen = state
+            if state['saved'] is not None:
+                self._saved_generation = self._generation() \
+                    if state['saved'] else None
+        if stale:
+            log.debug("Reloaded %s" % ', '.join(stale))
+        return stale
+
+    def _git_save_needed(self):
+        """True if Git reports uncommitted changes"""
+        self.flush()
+        return self._repo.is_dirty()
 
 
 class DemoGitFireSet(GitFireSet):
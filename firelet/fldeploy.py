@@ -0,0 +1,199 @@
+# Firelet - Distributed firewall management.
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rolling deployments
+#
+# The firewalls are deployed in waves: a set of canary firewalls first,
+# then batches of at most "batch_size" firewalls. Each wave is gated on the
+# diff between the compiled rules and the rules running on the firewalls of
+# that wave: the rollout stops at the first failing wave.
+
+from logging import getLogger
+from time import time
+
+from firelet.flssh import ROLLBACK_TIMEOUT
+from firelet.flutils import Alert
+
+log = getLogger(__name__)
+
+
+def plan_waves(hostnames, canary=None, batch_size=0):
+    """Split firewall names in deployment waves
+
+    :param hostnames: firewall names
+    :type hostnames: list
+    :param canary: canary firewall names, or the number of firewalls to be
+        used as canaries (optional)
+    :type canary: list or int
+    :param batch_size: maximum number of firewalls deployed at the same
+        time after the canaries. 0 means no limit.
+    :type batch_size: int
+    :returns: list of lists of firewall names
+    """
+    remaining = sorted(set(hostnames))
+    waves = []
+    if isinstance(canary, int):
+        canary = remaining[:canary]
+
+    if canary:
+        unknown = set(canary) - set(remaining)
+        if unknown:
+            raise Alert("Unknown canary firewalls: %s" %
+                ', '.join(sorted(unknown)))
+        waves.append(sorted(canary))
+        remaining = [hn for hn in remaining if hn not in canary]
+
+    if not batch_size:
+        batch_size = len(remaining)
+
+    for i in xrange(0, len(remaining), batch_size):
+        waves.append(remaining[i:i + batch_size])
+
+    return waves
+
+
+class DeploymentProgress(object):
+    """Progress of a rolling deployment.
+    Updated by RollingDeployment and polled by the daemon.
+    """
+
+    def __init__(self, waves, hosts=None):
+        """Setup progress
+
+        :param waves: deployment waves
+        :type waves: list
+        :param hosts: dict to be updated with the status of each firewall
+            (optional)
+        :type hosts: dict
+        """
+        self.waves = waves
+        self.current_wave = None
+        self.state = 'pending' # pending, running, completed, failed
+        self.error = None
+        self.started = None
+        self.ended = None
+        # {hostname: status, ... }
+        self.hosts = {} if hosts is None else hosts
+        for w in waves:
+            for hn in w:
+                self.hosts[hn] = 'pending'
+
+    def done(self):
+        """True if the deployment is not running anymore"""
+        return self.state in ('completed', 'failed')
+
+    def to_dict(self):
+        """Provide a JSON-serializable copy of the progress"""
+        return dict(
+            waves=[list(w) for w in self.waves],
+            current_wave=self.current_wave,
+            state=self.state,
+            error=self.error,
+            started=self.started,
+            ended=self.ended,
+            hosts=dict(self.hosts),
+        )
+
+
+class RollingDeployment(object):
+    """Deploy the configuration in waves: canaries first, then batches of
+    firewalls.
+    """
+
+    def __init__(self, fs, canary=None, batch_size=0,
+            stop_on_extra_interfaces=False,
+            rollback_timeout=ROLLBACK_TIMEOUT, status=None):
+        """Plan the deployment waves
+
+        :param fs: FireSet instance
+        :param canary: canary firewall names or number of canaries
+        :type canary: list or int
+        :param batch_size: max number of firewalls deployed at the same time
+        :type batch_size: int
+        :param status: dict updated with the status of each firewall
+            (optional)
+        :type status: dict
+        """
+        self._fs = fs
+        self._stop_on_extra_interfaces = stop_on_extra_interfaces
+        self._rollback_timeout = rollback_timeout
+        hostnames = set(h.hostname for h in fs._get_firewalls())
+        waves = plan_waves(hostnames, canary=canary, batch_size=batch_size)
+        self.progress = DeploymentProgress(waves, hosts=status)
+
+    def _fail(self, msg, hostnames):
+        """Mark the deployment as failed and skip the remaining firewalls"""
+        p = self.progress
+        p.state = 'failed'
+        p.error = msg
+        for hn in hostnames:
+            if p.hosts[hn] == 'confirmed':
+                p.hosts[hn] = 'deployed'
+            elif not p.hosts[hn].startswith('failed'):
+                p.hosts[hn] = 'failed'
+        for hn, st in p.hosts.iteritems():
+            if st == 'pending':
+                p.hosts[hn] = 'skipped'
+        log.error(msg)
+
+    def run(self):
+        """Run the deployment waves, stopping at the first failure
+
+        :returns: progress
+        :rtype: DeploymentProgress
+        """
+        p = self.progress
+        p.state = 'running'
+        p.started = time()
+        try:
+            if self._fs.save_needed():
+                raise Alert("Configuration must be saved before deployment.")
+            comp_rules = self._fs.compile_rules()
+        except (Alert, AssertionError) as e:
+            self._fail("Deployment failed: %s" % e, ())
+            p.ended = time()
+            return p
+
+        for n, wave in enumerate(p.waves):
+            p.current_wave = n
+            log.info("Deploying wave %d of %d: %s" % (n + 1, len(p.waves),
+                ', '.join(wave)))
+            try:
+                diff = self._fs._deploy(comp_rules, hostnames=wave,
+                    stop_on_extra_interfaces=self._stop_on_extra_interfaces,
+                    rollback_timeout=self._rollback_timeout, status=p.hosts)
+            except Exception as e:
+                self._fail("Deployment stopped at wave %d: %s" % (n + 1, e),
+                    wave)
+                break
+
+            if diff:
+                for hn in wave:
+                    if hn in diff:
+                        p.hosts[hn] = 'failed: running rules differ'
+                self._fail("Deployment stopped at wave %d: rules differ on %s"
+                    % (n + 1, ', '.join(sorted(diff))), wave)
+                break
+
+            for hn in wave:
+                p.hosts[hn] = 'deployed'
+
+        else:
+            p.state = 'completed'
+            log.info("Deployment completed in %d waves." % len(p.waves))
+
+        p.ended = time()
+        return p
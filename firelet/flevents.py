@@ -0,0 +1,90 @@
+# Firelet - Distributed firewall management.
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Event bus
+#
+# Log messages and job progress are published as numbered events. Clients
+# receive the events newer than the last one they have seen, either as a
+# server-sent events stream or by long polling.
+
+from collections import deque
+from threading import Condition
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class EventBus(object):
+    """Keep the most recent events and wake up waiting clients"""
+
+    def __init__(self, size=200):
+        """Setup the bus
+
+        :param size: number of events kept in memory
+        :type size: int
+        """
+        self._events = deque(maxlen=size)
+        self._last_id = 0
+        self._cond = Condition()
+
+    @property
+    def last_id(self):
+        """ID of the last published event"""
+        return self._last_id
+
+    def publish(self, kind, data):
+        """Publish an event
+
+        :param kind: event type, e.g. 'message' or 'job'
+        :type kind: str
+        :param data: JSON-serializable event payload
+        :returns: event ID
+        :rtype: int
+        """
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, kind, data))
+            self._cond.notify_all()
+            return self._last_id
+
+    def since(self, event_id):
+        """Get the events newer than event_id
+
+        :returns: [(event_id, kind, data), ... ]
+        :rtype: list
+        """
+        with self._cond:
+            return [e for e in self._events if e[0] > event_id]
+
+    def wait(self, event_id, timeout):
+        """Wait up to timeout seconds for events newer than event_id
+
+        :returns: [(event_id, kind, data), ... ]
+        :rtype: list
+        """
+        with self._cond:
+            if self._last_id <= event_id:
+                self._cond.wait(timeout)
+            return [e for e in self._events if e[0] > event_id]
+
+
+def format_sse(event):
+    """Format an event for a text/event-stream response"""
+    event_id, kind, data = event
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (event_id, kind,
+        json.dumps(data))
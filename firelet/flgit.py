@@ -0,0 +1,312 @@
+# Firelet - Distributed firewall management.
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Git repository access
+#
+# GitRepository runs the git executable without a shell and reads commit
+# objects through a long-lived "git cat-file --batch" process.
+# DulwichRepository reads objects, checks the status and commits in-process
+# when Dulwich is installed.
+
+from fnmatch import fnmatch
+from heapq import heappop, heappush
+from logging import getLogger
+from subprocess import Popen, PIPE
+from threading import Lock
+from time import gmtime, strftime
+import os
+
+try:
+    from dulwich.repo import Repo as DulwichRepo
+    from dulwich import porcelain
+    dulwich_available = True
+except ImportError:
+    dulwich_available = False
+
+from firelet.flutils import Alert
+
+log = getLogger(__name__)
+
+
+def format_date(timestamp, tz_offset):
+    """Format a commit date like "git log --date=iso"
+
+    :param timestamp: seconds since the epoch
+    :type timestamp: int
+    :param tz_offset: timezone offset in seconds
+    :type tz_offset: int
+    :returns: str
+    """
+    sign = '-' if tz_offset < 0 else '+'
+    h, m = divmod(abs(tz_offset) // 60, 60)
+    t = strftime('%Y-%m-%d %H:%M:%S', gmtime(timestamp + tz_offset))
+    return "%s %s%02d%02d" % (t, sign, h, m)
+
+
+def parse_commit(raw):
+    """Parse a raw commit object
+
+    :returns: (author, date, [msg lines], [parent ids], timestamp)
+    """
+    headers, _, msg = raw.partition('\n\n')
+    parents = []
+    author = date = None
+    timestamp = 0
+    for line in headers.split('\n'):
+        if line.startswith('parent '):
+            parents.append(line[7:])
+        elif line.startswith('author '):
+            author, ts, tz = line[7:].rsplit(' ', 2)
+            timestamp = int(ts)
+            tz_offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+            if tz.startswith('-'):
+                tz_offset = -tz_offset
+            date = format_date(timestamp, tz_offset)
+
+    msg = [r.strip() for r in msg.split('\n') if r.strip()]
+    return author, date, msg, parents, timestamp
+
+
+class GitRepository(object):
+    """Access a Git repository by running the git executable"""
+
+    def __init__(self, repodir, git_executable='git'):
+        self._repodir = repodir
+        self._git_executable = git_executable
+        self._batch = None
+        self._batch_lock = Lock()
+
+    def run(self, *args):
+        """Run a git command, without a shell
+
+        :returns: (return code, stdout, stderr)
+        """
+        p = Popen((self._git_executable,) + args, cwd=self._repodir,
+            stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        return p.returncode, out, err
+
+    def _check(self, *args):
+        """Run a git command and raise Alert on failure
+
+        :returns: stdout
+        """
+        code, out, err = self.run(*args)
+        if code:
+            raise Alert("Error while running 'git %s': %s" %
+                (' '.join(args), err.strip()))
+        return out
+
+    def _files(self, *patterns):
+        """List the non-hidden files in the repository directory that match
+        any of the patterns"""
+        return sorted(fn for fn in os.listdir(self._repodir)
+            if not fn.startswith('.') and
+            any(fnmatch(fn, p) for p in patterns))
+
+    def close(self):
+        """Terminate the cat-file process"""
+        with self._batch_lock:
+            if self._batch is not None:
+                self._batch.stdin.close()
+                self._batch.wait()
+                self._batch = None
+
+    def is_repository(self):
+        """True if the directory is part of a Git repository"""
+        return self.run('rev-parse', '--git-dir')[0] == 0
+
+    def init(self, msg):
+        """Create a repository and commit the tables"""
+        self._check('init', '.')
+        self._check('config', 'user.name', 'Firelet')
+        self._check('config', 'user.email', 'firelet@localhost')
+        self._check('add', '--', *self._files('*.csv', '*.json'))
+        self._check('commit', '-m', msg)
+
+    def toplevel(self):
+        """Repository top level directory"""
+        return self._check('rev-parse', '--show-toplevel').strip()
+
+    def read_object(self, name):
+        """Read an object using the cat-file process
+
+        :param name: object name, e.g. a commit ID
+        :returns: (type, content) or None if the object is missing
+        """
+        with self._batch_lock:
+            if self._batch is None:
+                self._batch = Popen((self._git_executable, 'cat-file',
+                    '--batch'), cwd=self._repodir, stdin=PIPE, stdout=PIPE)
+            self._batch.stdin.write(name + '\n')
+            self._batch.stdin.flush()
+            header = self._batch.stdout.readline().split()
+            if len(header) != 3:
+                return None
+            content = self._batch.stdout.read(int(header[2]) + 1)[:-1]
+            return header[1], content
+
+    def head(self):
+        """Commit ID of HEAD or None"""
+        code, out, err = self.run('rev-parse', '--verify', '-q', 'HEAD')
+        return out.strip() if code == 0 else None
+
+    def read_commit(self, commit_id):
+        """Read and parse a commit
+
+        :returns: (author, date, [msg lines], [parent ids], timestamp)
+        """
+        obj = self.read_object(commit_id)
+        if obj is None or obj[0] != 'commit':
+            raise Alert("Commit %s not found" % commit_id)
+        return parse_commit(obj[1])
+
+    def log(self, start=None, stop=None):
+        """Walk the history from start (default: HEAD) newest first, like
+        "git log". Stop at the commit IDs in stop.
+
+        :returns: generator of (commit_id, author, date, [msg lines],
+            [parent ids])
+        """
+        start = start or self.head()
+        if start is None:
+            return
+        stop = set(stop or ())
+        seen = set([start])
+        commit = self.read_commit(start)
+        queue = [(-commit[4], start, commit)]
+        while queue:
+            _, cid, (author, date, msg, parents, ts) = heappop(queue)
+            if cid in stop:
+                continue
+            yield cid, author, date, msg, parents
+            for p in parents:
+                if p not in seen:
+                    seen.add(p)
+                    c = self.read_commit(p)
+                    heappush(queue, (-c[4], p, c))
+
+    def is_dirty(self):
+        """Stage the tables and tell if they differ from HEAD"""
+        self._check('add', '--', *self._files('*.csv', '*.json'))
+        out = self._check('status', '--porcelain', '-uno')
+        return any(r[:1] not in (' ', '?', '') for r in out.split('\n'))
+
+    def commit(self, msg):
+        """Commit every file in the repository directory"""
+        self._check('add', '--', *self._files('*'))
+        code, out, err = self.run('commit', '-a', '-m', msg)
+        if code and 'nothing to commit' not in out:
+            raise Alert("Error while committing: %s" % err.strip())
+
+    def resolve(self, rev):
+        """Resolve a revision, e.g. HEAD~1, to a commit ID
+
+        :returns: commit ID or None
+        """
+        code, out, err = self.run('rev-parse', '--verify', '-q',
+            rev + '^{commit}')
+        return out.strip() if code == 0 else None
+
+    def read_file(self, commit_id, path):
+        """Read a file as stored in a commit
+
+        :returns: file contents or None if missing
+        """
+        obj = self.read_object("%s:%s" % (commit_id, path))
+        if obj is None or obj[0] != 'blob':
+            return None
+        return obj[1]
+
+    def diff(self, commit_id, other=None):
+        """Diff between a commit and another commit or the working tree
+
+        :returns: unified diff (str)
+        """
+        if other:
+            return self._check('diff', commit_id, other, '--')
+        return self._check('diff', commit_id, '--')
+
+    def changed_files(self, rev='HEAD'):
+        """List the files that differ between a revision and the working
+        tree
+
+        :returns: list of file names
+        """
+        out = self._check('diff', '--name-only', rev, '--')
+        return [os.path.basename(fn) for fn in out.split('\n') if fn]
+
+    def reset(self, rev='HEAD'):
+        """Hard reset to the given revision"""
+        self._check('reset', '--hard', rev, '--')
+
+
+class DulwichRepository(GitRepository):
+    """Access a Git repository in-process using Dulwich. The working tree
+    diff and hard reset still use the git executable.
+    """
+
+    def __init__(self, repodir, git_executable='git'):
+        super(DulwichRepository, self).__init__(repodir, git_executable)
+        self._repo = None
+
+    def _r(self):
+        if self._repo is None:
+            self._repo = DulwichRepo(self._repodir)
+        return self._repo
+
+    def read_object(self, name):
+        r = self._r()
+        commit_id, _, path = name.partition(':')
+        try:
+            obj = r[commit_id]
+            if path:
+                tree = r[obj.tree]
+                mode, sha = tree.lookup_path(r.get_object, path)
+                obj = r[sha]
+        except KeyError:
+            return None
+        return obj.type_name, obj.as_raw_string()
+
+    def head(self):
+        try:
+            return self._r().head()
+        except KeyError:
+            return None
+
+    def _paths(self, *patterns):
+        return [os.path.join(self._repodir, fn)
+            for fn in self._files(*patterns)]
+
+    def is_dirty(self):
+        porcelain.add(self._r(), self._paths('*.csv', '*.json'))
+        staged = porcelain.status(self._r()).staged
+        return any(staged.values())
+
+    def commit(self, msg):
+        r = self._r()
+        # stage deletions of tracked files as well, like "git commit -a"
+        tracked = [os.path.join(self._repodir, p) for p in r.open_index()]
+        porcelain.add(r, sorted(set(tracked + self._paths('*'))))
+        if any(porcelain.status(r).staged.values()):
+            porcelain.commit(r, msg)
+
+
+def open_repository(repodir, git_executable='git'):
+    """Open a repository using Dulwich if available"""
+    if dulwich_available:
+        return DulwichRepository(repodir, git_executable)
+    return GitRepository(repodir, git_executable)
@@ -0,0 +1,252 @@
+# Firelet - Distributed firewall management.
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Background jobs
+#
+# Checks and deployments can take minutes on large installations: the daemon
+# runs them in a background worker thread and the clients poll their status.
+# Jobs are run one at a time as the FireSet is not thread-safe.
+
+from itertools import count
+from logging import getLogger
+from Queue import Queue
+from threading import Event, Lock, Thread, current_thread
+from time import gmtime, strftime, time
+import logging
+
+log = getLogger(__name__)
+
+MAX_FINISHED_JOBS = 50
+MAX_JOB_LOG_LINES = 500
+
+
+class StatusDict(dict):
+    """Dict calling a function every time an item is set"""
+
+    def __init__(self, on_change):
+        dict.__init__(self)
+        self._on_change = on_change
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._on_change()
+
+
+class Job(object):
+    """A background check or deployment"""
+
+    def __init__(self, job_id, kind, func, key=None, on_change=None):
+        """Create a job
+
+        :param job_id: job ID
+        :type job_id: int
+        :param kind: job type, e.g. 'check' or 'deploy'
+        :type kind: str
+        :param func: function run by the worker, receives the job as argument
+        :param key: deduplication key (optional)
+        :param on_change: function called with the job as argument when its
+            state or the status of a host changes (optional)
+        """
+        self.id = job_id
+        self.kind = kind
+        self.key = key
+        self._func = func
+        self._on_change = on_change
+        self.state = 'queued' # queued, running, completed, failed
+        self.created = time()
+        self.started = None
+        self.ended = None
+        self.error = None
+        self.result = None
+        # {hostname: status, ... } - updated by the job function
+        self.hosts = StatusDict(self._changed)
+        self.logs = []
+        self._done = Event()
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def done(self):
+        """True if the job is not queued or running anymore"""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the job to complete
+
+        :returns: True if the job is done
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def run(self):
+        """Run the job function and record its outcome"""
+        self.state = 'running'
+        self.started = time()
+        self._changed()
+        try:
+            self.result = self._func(self)
+            self.state = 'completed'
+        except Exception as e:
+            log.error("%s job %d failed: %s" % (self.kind.capitalize(),
+                self.id, e))
+            self.error = str(e)
+            self.state = 'failed'
+        finally:
+            self.ended = time()
+            self._done.set()
+            self._changed()
+
+    def to_dict(self, logs=True):
+        """Provide a JSON-serializable representation of the job.
+        The result is not included.
+
+        :param logs: include the log messages
+        :type logs: bool
+        """
+        if self.started is None:
+            duration = None
+        else:
+            duration = (self.ended or time()) - self.started
+
+        d = dict(
+            id=self.id,
+            kind=self.kind,
+            state=self.state,
+            created=self.created,
+            started=self.started,
+            ended=self.ended,
+            duration=duration,
+            error=self.error,
+            hosts=dict(self.hosts),
+        )
+        if logs:
+            d['logs'] = list(self.logs)
+        return d
+
+
+class JobLogHandler(logging.Handler):
+    """Store log messages emitted by the worker thread in the running job"""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self._queue = queue
+
+    def emit(self, record):
+        job = self._queue.current
+        if job is None or record.thread != self._queue.worker_ident:
+            return
+
+        if len(job.logs) >= MAX_JOB_LOG_LINES:
+            return
+
+        tstamp = strftime("%H:%M:%S", gmtime(record.created))
+        job.logs.append((record.levelname.lower(), tstamp,
+            record.getMessage()))
+
+
+class JobQueue(object):
+    """Run jobs in a background worker thread, one at a time"""
+
+    def __init__(self, logger=None, on_change=None):
+        """Setup the job queue. The worker thread is started on the first
+        submission.
+
+        :param logger: logger whose messages are stored in the running job
+            (default: root logger)
+        :param on_change: function called with a job as argument when its
+            state or the status of a host changes (optional)
+        """
+        self._on_change = on_change
+        self._ids = count(1)
+        self._queue = Queue()
+        self._lock = Lock()
+        self._jobs = {}
+        self._finished = []
+        self._worker = None
+        self.worker_ident = None
+        self.current = None
+        self._logger = logger
+        self._log_handler = JobLogHandler(self)
+        self._log_handler.setLevel(logging.INFO)
+
+    def _start_worker(self):
+        if self._worker is None:
+            # Added here rather than on import, so that logging.basicConfig
+            # still configures the root logger
+            (self._logger or logging.getLogger()).addHandler(
+                self._log_handler)
+            self._worker = Thread(target=self._work, name='firelet-jobs')
+            self._worker.setDaemon(True)
+            self._worker.start()
+
+    def _work(self):
+        """Worker thread main loop"""
+        self.worker_ident = current_thread().ident
+        while True:
+            job = self._queue.get()
+            self.current = job
+            job.run()
+            self.current = None
+            with self._lock:
+                if job.key is not None:
+                    self._jobs.pop(('key', job.key), None)
+                self._finished.append(job.id)
+                while len(self._finished) > MAX_FINISHED_JOBS:
+                    self._jobs.pop(self._finished.pop(0), None)
+
+    def submit(self, kind, func, key=None):
+        """Enqueue a job. If a job with the same key is queued or running it
+        is returned instead of creating a new one.
+
+        :param kind: job type, e.g. 'check' or 'deploy'
+        :type kind: str
+        :param func: function receiving the job as argument
+        :param key: deduplication key (optional)
+        :returns: job
+        :rtype: Job
+        """
+        with self._lock:
+            job = self._jobs.get(('key', key))
+            if key is not None and job is not None and not job.done():
+                log.debug("Reusing %s job %d" % (kind, job.id))
+                return job
+
+            job = Job(next(self._ids), kind, func, key=key,
+                on_change=self._on_change)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._jobs[('key', key)] = job
+            self._start_worker()
+            self._queue.put(job)
+
+        log.debug("Queued %s job %d" % (kind, job.id))
+        return job
+
+    def get(self, job_id):
+        """Get a job by ID
+
+        :returns: job or None
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        """List known jobs, oldest first"""
+        with self._lock:
+            jobs = [j for k, j in self._jobs.iteritems()
+                if not isinstance(k, tuple)]
+        return sorted(jobs, key=lambda j: j.id)
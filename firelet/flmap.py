@@ -1,9 +1,20 @@
+from hashlib import sha1
+from logging import getLogger
+import threading
+
 try:
     from pygraphviz import AGraph,  Edge,  Node
     graphviz_available = True
 except ImportError:
     graphviz_available = False
 
+from firelet.flutils import LRUCache
+
+log = getLogger(__name__)
+
+# Number of rendered maps kept in memory, see MapCache
+MAP_CACHE_SIZE = 4
+
 def _drawmap(fs, rulename=None):
     """Draw a map of the firewalls and their connections based on their interfaces.
     If nulename is specified, draw also the sources and dests for a that rule.  #TODO: implement this
@@ -27,18 +38,12 @@ def _drawmap(fs, rulename=None):
 
     # Connect hosts to nets
     for host in fs.hosts:
-        on_Internet = True
-        for net in fs.networks:
-            if host in net:
-                on_Internet = False
-                A.add_edge(host.hostname, net.name)
-                e = Edge(A, host.hostname, net.name)
-                e.attr['label'] = host.iface
-                e.attr['fontsize'] = '6'
+        nets = fs.networks.containing(host.ip_addr)
         # If a host is not in any configured net, it's on the Internet
-        if on_Internet:
-            A.add_edge(host.hostname, 'Internet')
-            e = Edge(A, host.hostname, 'Internet')
+        names = [net.name for net in nets] or ['Internet']
+        for name in names:
+            A.add_edge(host.hostname, name)
+            e = Edge(A, host.hostname, name)
             e.attr['label'] = host.iface
             e.attr['fontsize'] = '6'
 
@@ -46,16 +51,120 @@ def _drawmap(fs, rulename=None):
     return A
 
 
+class MapCache(object):
+    """Rendered maps, keyed by a hash of the hosts and networks. Both
+    formats are rendered at once from a single layout. Maps can be rendered
+    in a background thread after the tables change, see refresh().
+    """
+
+    def __init__(self, maxsize=MAP_CACHE_SIZE):
+        self._cache = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        # key -> Event set when the maps have been rendered
+        self._building = {}
+        # (hosts list, networks list, key) of the last hashed tables
+        self._last = None
+        self._pending = None
+        self._worker = None
+
+    def key(self, fs):
+        """Hash of the hosts and networks. The tables replace their lists
+        when changed, so the hash of the last lists is reused.
+
+        :rtype: str
+        """
+        hosts, nets = fs.hosts._list, fs.networks._list
+        last = self._last
+        if last is not None and last[0] is hosts and last[1] is nets:
+            return last[2]
+
+        h = sha1()
+        for table in (fs.hosts, fs.networks):
+            for row in table._rows():
+                h.update(repr(row))
+            h.update('\n')
+        key = h.hexdigest()
+        self._last = (hosts, nets, key)
+        return key
+
+    def get(self, fs, fmt):
+        """Get a map, rendering it if needed
+
+        :param fmt: 'png' or 'svg'
+        :type fmt: str
+        """
+        key = self.key(fs)
+        maps = self._cache.get(key)
+        if maps is None:
+            maps = self._build(fs, key)
+        return maps[fmt]
+
+    def _build(self, fs, key):
+        """Render the maps, or wait for the thread already rendering them"""
+        with self._lock:
+            done = self._building.get(key)
+            if done is None:
+                done = self._building[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            done.wait()
+            maps = self._cache.get(key)
+            if maps is not None:
+                return maps
+
+        try:
+            A = _drawmap(fs)
+            maps = dict(png=A.draw(format='png'), svg=A.draw(format='svg'))
+            self._cache.put(key, maps)
+            return maps
+        finally:
+            if owner:
+                with self._lock:
+                    del self._building[key]
+                done.set()
+
+    def refresh(self, fs):
+        """Render the maps for a FireSet snapshot in a background thread,
+        unless they are cached. Only the latest snapshot is rendered if many
+        are queued while the thread is busy.
+
+        :returns: the rendering thread
+        """
+        with self._lock:
+            self._pending = fs
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work)
+                self._worker.daemon = True
+                self._worker.start()
+            return self._worker
+
+    def _work(self):
+        while True:
+            with self._lock:
+                fs, self._pending = self._pending, None
+                if fs is None:
+                    self._worker = None
+                    return
+            try:
+                key = self.key(fs)
+                if self._cache.get(key) is None:
+                    self._build(fs, key)
+            except Exception as e:
+                log.warn("Unable to render the map: %s" % e)
+
+
+map_cache = MapCache()
+
+
 def draw_png_map(fs, rulename=None):
     if not graphviz_available:
         return None
-    A = _drawmap(fs, rulename)
-    return A.draw(format='png')
+    return map_cache.get(fs, 'png')
 
 def draw_svg_map(fs, rulename=None):
     if not graphviz_available:
         return None
-    A = _drawmap(fs, rulename)
-    return A.draw(format='svg')
-
-
+    return map_cache.get(fs, 'svg')
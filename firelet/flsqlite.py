@@ -0,0 +1,546 @@
+# Firelet - Distributed firewall management.
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# SQLite storage
+#
+# SqliteFireSet stores the tables in a SQLite database instead of CSV files
+# in a Git repository. Each table is kept in memory as well, like the other
+# FireSets, with the same hash indexes, but saving a table writes only the
+# rows that changed.
+# Rows are ordered by a "pos" column numbered with gaps, so that moving or
+# inserting a rule does not renumber the following ones.
+# Every save creates a version storing a copy of the tables changed since the
+# previous one: reset and rollback restore the tables from the versions.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from logging import getLogger
+from time import localtime, time, timezone, altzone
+import marshal
+import os
+import sqlite3
+
+from firelet.flcore import FireSet, Rules, Hosts, HostGroups, Services, \
+    Networks, savecsv
+from firelet.flgit import format_date
+from firelet.flutils import Alert
+
+try:
+    import json
+except ImportError: # pragma: no cover
+    import simplejson as json
+
+log = getLogger(__name__)
+
+# Distance between the positions of two consecutive rows
+POS_GAP = 1024
+
+VERSION_AUTHOR = 'Firelet <firelet@localhost>'
+
+CSV_HEADER = '# Format 0.1 - Do not edit this line\n'
+
+
+def _longest_increasing(seq):
+    """Find a longest strictly increasing subsequence, ignoring None items
+
+    :returns: set of indexes
+    """
+    tails = []
+    tail_values = []
+    prev = {}
+    for i, v in enumerate(seq):
+        if v is None:
+            continue
+        k = bisect_left(tail_values, v)
+        prev[i] = tails[k - 1] if k else None
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(v)
+        else:
+            tails[k] = i
+            tail_values[k] = v
+
+    out = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        out.add(i)
+        i = prev[i]
+    return out
+
+def assign_positions(positions):
+    """Assign positions to ordered rows, changing as few of them as possible.
+    The rows in the longest increasing run keep their position, the others
+    are spread in the gaps between them.
+
+    :param positions: current positions, None for new rows
+    :type positions: list
+    :returns: list of positions
+    """
+    keep = _longest_increasing(positions)
+    out = list(positions)
+    lo = 0
+    run = []
+    for i in range(len(positions) + 1):
+        if i < len(positions) and i not in keep:
+            run.append(i)
+            continue
+
+        if run:
+            if i == len(positions):
+                step = POS_GAP
+            else:
+                step = (positions[i] - lo) // (len(run) + 1)
+            if step < 1:
+                # no room left: renumber everything
+                return [POS_GAP * (n + 1) for n in range(len(positions))]
+            for n, j in enumerate(run):
+                out[j] = lo + step * (n + 1)
+            run = []
+
+        if i < len(positions):
+            lo = positions[i]
+
+    return out
+
+def _str(v):
+    """Convert unicode strings decoded from JSON to str"""
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    return v
+
+
+class Database(object):
+    """SQLite connection shared by the tables of a SqliteFireSet.
+    Changes are committed immediately unless a transaction is in progress.
+    """
+
+    def __init__(self, fname):
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.text_factory = str
+        self.depth = 0
+
+    def execute(self, query, args=()):
+        return self.db.execute(query, args)
+
+    def changed(self, table):
+        """Record that a table has changed since the last version"""
+        self.execute("INSERT OR IGNORE INTO changes (tbl) VALUES (?)",
+            (table,))
+        self.commit()
+
+    def commit(self):
+        """Commit, unless a transaction is in progress"""
+        if self.depth == 0:
+            self.db.commit()
+
+
+class SqliteTable(object):
+    """Mixin storing a SmartTable in a SQLite table.
+    Each item maps to a row, identified by the "id" column: it is used as
+    the row ID of the item.
+    """
+    # Stored item attributes
+    _columns = ()
+    # Attributes holding lists, stored as JSON
+    _list_columns = ()
+
+    def __init__(self, db):
+        """Load the table from the database
+
+        :param db: database
+        :type db: Database
+        """
+        self._db = db
+        self._dir = None
+        self.reload()
+
+    @classmethod
+    def create(cls, db):
+        """Create the SQL table and its index on "pos", if missing.
+        The tables are searched in memory: other indexes would only slow
+        down the writes and are dropped.
+        """
+        db.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, "
+            "pos INTEGER NOT NULL, %s)" % (cls._name, cls._column_list()))
+        db.execute("CREATE INDEX IF NOT EXISTS %s_pos ON %s (pos)" % (
+            cls._name, cls._name))
+        unused = db.execute("SELECT name FROM sqlite_master WHERE "
+            "type='index' AND tbl_name=? AND name!=? AND sql IS NOT NULL",
+            (cls._name, '%s_pos' % cls._name)).fetchall()
+        for row in unused:
+            db.execute('DROP INDEX "%s"' % row[0])
+
+    @classmethod
+    def _column_list(cls):
+        """Quoted column names: "desc" is a SQL keyword"""
+        return ', '.join('"%s"' % c for c in cls._columns)
+
+    def _encode(self, item):
+        """Column values of an item
+
+        :returns: tuple
+        """
+        return tuple(json.dumps(getattr(item, c)) if c in self._list_columns
+            else getattr(item, c) for c in self._columns)
+
+    def _decode(self, values):
+        """Create an item from column values, without parsing or
+        validation"""
+        d = {}
+        for c, v in zip(self._columns, values):
+            if c in self._list_columns:
+                v = [_str(x) for x in json.loads(v)]
+            d[c] = v
+        cls = self._item_class
+        item = cls.__new__(cls)
+        item.__dict__ = d
+        return item
+
+    def reload(self):
+        """Load the table from the database"""
+        cur = self._db.execute("SELECT id, pos, %s FROM %s ORDER BY pos" %
+            (self._column_list(), self._name))
+        previous = self.__dict__.get('_stored', {})
+        items = []
+        # {row ID: (item, position, values), ... }
+        self._stored = {}
+        for row in cur:
+            item = self._decode(row[2:])
+            values = tuple(row[2:])
+            item.row_id = row[0]
+            prev = previous.get(row[0])
+            item.row_version = 1 if prev is None else \
+                prev[0].row_version + (prev[2] != values)
+            items.append(item)
+            self._stored[row[0]] = (item, row[1], values)
+        self._list = items
+        self._next_row_id = max(self._stored or [0]) + 1
+        self.version += 1
+        self._reindex()
+
+    def save(self):
+        """Write the rows changed, added or removed since the last save.
+        The tables replace the items they change with copies: the items
+        still stored under their row ID are unchanged.
+        """
+        self.generation += 1
+        self.version += 1
+        entries = [self._stored.get(item.row_id) for item in self._list]
+        positions = assign_positions([e[1] if e else None for e in entries])
+        cols = self._column_list()
+        placeholders = ', '.join('?' * (len(self._columns) + 2))
+        assignments = ', '.join('"%s"=?' % c for c in ('pos',) + self._columns)
+
+        stored = {}
+        for item, e, pos in zip(self._list, entries, positions):
+            if e is not None and e[0] is item:
+                if pos != e[1]:
+                    self._db.execute("UPDATE %s SET pos=? WHERE id=?" %
+                        self._name, (pos, item.row_id))
+                stored[item.row_id] = (item, pos, e[2])
+                continue
+
+            values = self._encode(item)
+            if e is None:
+                self._db.execute("INSERT INTO %s (id, pos, %s) VALUES (%s)"
+                    % (self._name, cols, placeholders),
+                    (item.row_id, pos) + values)
+            elif (pos, values) != (e[1], e[2]):
+                self._db.execute("UPDATE %s SET %s WHERE id=?" % (
+                    self._name, assignments), (pos,) + values + (item.row_id,))
+            stored[item.row_id] = (item, pos, values)
+
+        for row_id in self._stored:
+            if row_id not in stored:
+                self._db.execute("DELETE FROM %s WHERE id=?" % self._name,
+                    (row_id,))
+
+        self._stored = stored
+        self._db.changed(self._name)
+
+    def dump(self):
+        """Row ID and column values of every item, in order
+
+        :returns: list of tuples
+        """
+        return [(item.row_id,) + self._encode(item) for item in self._list]
+
+    def restore(self, rows):
+        """Replace the content of the table, then reload it
+
+        :param rows: list of row IDs and column values, as provided by
+            dump()
+        :type rows: list
+        """
+        self._db.execute("DELETE FROM %s" % self._name)
+        self._db.db.executemany("INSERT INTO %s (id, pos, %s) VALUES (%s)" % (
+            self._name, self._column_list(),
+            ', '.join('?' * (len(self._columns) + 2))),
+            ((r[0], POS_GAP * (n + 1)) + tuple(r[1:])
+                for n, r in enumerate(rows)))
+        self.reload()
+
+
+class SqliteRules(SqliteTable, Rules):
+    """Ruleset stored in SQLite"""
+    _columns = ('enabled', 'name', 'src', 'src_serv', 'dst', 'dst_serv',
+        'action', 'log_level', 'desc')
+
+
+class SqliteHosts(SqliteTable, Hosts):
+    """Hosts stored in SQLite"""
+    _columns = ('hostname', 'iface', 'ip_addr', 'masklen', 'local_fw',
+        'network_fw', 'mng', 'routed')
+    _list_columns = ('routed',)
+
+
+class SqliteHostGroups(SqliteTable, HostGroups):
+    """Host groups stored in SQLite"""
+    _columns = ('name', 'childs')
+    _list_columns = ('childs',)
+
+
+class SqliteServices(SqliteTable, Services):
+    """Services stored in SQLite"""
+    _columns = ('name', 'protocol', 'ports')
+
+
+class SqliteNetworks(SqliteTable, Networks):
+    """Networks stored in SQLite"""
+    _columns = ('name', 'ip_addr', 'masklen')
+
+
+# (table name, SQLite table class, CSV table class)
+TABLES = (
+    ('rules', SqliteRules, Rules),
+    ('hosts', SqliteHosts, Hosts),
+    ('hostgroups', SqliteHostGroups, HostGroups),
+    ('services', SqliteServices, Services),
+    ('networks', SqliteNetworks, Networks),
+)
+
+
+class SqliteFireSet(FireSet):
+    """FireSet storing the configuration and its versions in SQLite"""
+
+    def __init__(self, dbfile, repodir=None):
+        """Open the database, creating it if needed
+
+        :param dbfile: SQLite database file name
+        :type dbfile: str
+        :param repodir: directory containing CSV files imported when the
+            database is created (optional)
+        :type repodir: str
+        """
+        super(SqliteFireSet, self).__init__()
+        self._db = Database(dbfile)
+        self._create_schema()
+        for name, cls, csv_cls in TABLES:
+            self.__dict__[name] = cls(self._db)
+
+        if self._db.execute("SELECT COUNT(*) FROM versions").fetchone()[0]:
+            return
+
+        log.info('Creating new configuration database...')
+        if repodir:
+            self.import_csv(repodir)
+        for name in self._table_names:
+            self._db.changed(name)
+        self.save("Configuration database created.")
+
+    def _create_schema(self):
+        db = self._db
+        for name, cls, csv_cls in TABLES:
+            cls.create(db)
+        db.execute("CREATE TABLE IF NOT EXISTS versions ("
+            "id INTEGER PRIMARY KEY, author, timestamp, msg)")
+        db.execute("CREATE TABLE IF NOT EXISTS history (version INTEGER, "
+            "tbl, rows BLOB, PRIMARY KEY (version, tbl))")
+        db.execute("CREATE TABLE IF NOT EXISTS changes (tbl PRIMARY KEY)")
+        db.db.commit()
+
+    # CSV bridge
+
+    def import_csv(self, d):
+        """Replace the tables with the content of the CSV files in a
+        directory. The files are parsed and validated as in GitFireSet.
+
+        :param d: directory name
+        :type d: str
+        """
+        parsed = [(name, csv_cls(d)) for name, cls, csv_cls in TABLES]
+        with self.transaction():
+            for name, table in parsed:
+                t = self.__dict__[name]
+                t._list = list(table)
+                for item in t._list:
+                    item.row_id = t._new_row_id()
+                    item.row_version = 1
+                t._reindex()
+                t.save()
+
+    def export_csv(self, d):
+        """Write the tables as CSV files in a directory. The comments in the
+        existing files are preserved.
+
+        :param d: directory name
+        :type d: str
+        """
+        for name in self._table_names:
+            fname = "%s/%s.csv" % (d, name)
+            if not os.path.exists(fname):
+                with open(fname, 'w') as f:
+                    f.write(CSV_HEADER)
+            savecsv(name, self.__dict__[name]._rows(), d)
+
+    # edit transactions
+
+    @contextmanager
+    def transaction(self):
+        """Edit transaction: the changes are committed to the database at
+        the end. Transactions can be nested. If the outermost one fails the
+        changes are rolled back and the tables are reloaded.
+        """
+        self._db.depth += 1
+        try:
+            yield self
+        except:
+            self._db.depth -= 1
+            if self._db.depth == 0:
+                self._db.db.rollback()
+                self.reload()
+            raise
+        else:
+            self._db.depth -= 1
+            self._db.commit()
+
+    def flush(self):
+        """Nothing to do: the changes are written by each table"""
+        pass
+
+    # FireSet management
+
+    def save_needed(self):
+        """True if the tables changed since the last version"""
+        cur = self._db.execute("SELECT 1 FROM changes LIMIT 1")
+        return cur.fetchone() is not None
+
+    def save(self, msg):
+        """Create a new version storing the tables changed since the
+        previous one"""
+        if not msg:
+            msg = '(no message)'
+
+        changed = [r[0] for r in self._db.execute("SELECT tbl FROM changes")]
+        if not changed:
+            return
+
+        db = self._db
+        cur = db.execute("INSERT INTO versions (author, timestamp, msg) "
+            "VALUES (?, ?, ?)", (VERSION_AUTHOR, int(time()), msg))
+        version = cur.lastrowid
+        for name in changed:
+            rows = marshal.dumps(self.__dict__[name].dump())
+            db.execute("INSERT INTO history (version, tbl, rows) "
+                "VALUES (?, ?, ?)", (version, name, buffer(rows)))
+        db.execute("DELETE FROM changes")
+        db.commit()
+
+    def _restore(self, version):
+        """Restore the tables as they were in a version, then forget the
+        newer versions. Only the tables that changed are restored.
+        """
+        db = self._db
+        names = set(r[0] for r in db.execute("SELECT tbl FROM changes"))
+        names.update(r[0] for r in db.execute(
+            "SELECT DISTINCT tbl FROM history WHERE version > ?", (version,)))
+        for name in self._table_names:
+            if name not in names:
+                continue
+            row = db.execute("SELECT rows FROM history WHERE tbl=? AND "
+                "version <= ? ORDER BY version DESC LIMIT 1",
+                (name, version)).fetchone()
+            rows = marshal.loads(str(row[0])) if row else []
+            self.__dict__[name].restore(rows)
+
+        db.execute("DELETE FROM history WHERE version > ?", (version,))
+        db.execute("DELETE FROM versions WHERE id > ?", (version,))
+        db.execute("DELETE FROM changes")
+        db.commit()
+        log.debug("Restored %s" % ', '.join(sorted(names)))
+
+    def reload(self):
+        """Reload all the tables from the database"""
+        for name in self._table_names:
+            self.__dict__[name].reload()
+
+    def reset(self):
+        """Restore the last version"""
+        last = self._db.execute("SELECT MAX(id) FROM versions").fetchone()[0]
+        self._restore(last)
+
+    def rollback(self, n=None, commit_id=None):
+        """Rollback to n versions ago or to a specific version
+        """
+        assert n is not None or commit_id, "n or commit_id must be specified"
+        if n:
+            try:
+                n = int(n)
+            except ValueError:
+                raise Alert("rollback requires an integer")
+            row = self._db.execute("SELECT id FROM versions ORDER BY id DESC "
+                "LIMIT 1 OFFSET ?", (n,)).fetchone()
+        else:
+            try:
+                version = int(commit_id)
+            except ValueError:
+                raise Alert("Invalid commit ID: %r" % commit_id)
+            row = self._db.execute("SELECT id FROM versions WHERE id=?",
+                (version,)).fetchone()
+
+        if row is None:
+            raise Alert("Version not found")
+        self._restore(row[0])
+
+    def version_list(self, offset=0, limit=None, cursor=None):
+        """List the versions, newest first. Like in GitFireSet, the initial
+        version is not listed.
+
+        :param offset: number of versions to skip
+        :type offset: int
+        :param limit: maximum number of versions (optional)
+        :type limit: int
+        :param cursor: list the versions older than the given one (optional)
+        :type cursor: str
+        :returns: a list of lists: [ [author, date, [msg lines], version ], ... ]
+        """
+        where = "id > (SELECT MIN(id) FROM versions)"
+        args = []
+        if cursor:
+            try:
+                args.append(int(cursor))
+            except ValueError:
+                raise Alert("Unknown commit ID: %s" % cursor)
+            where += " AND id < ?"
+        args += [-1 if limit is None else limit, offset]
+        cur = self._db.execute("SELECT id, author, timestamp, msg FROM "
+            "versions WHERE %s ORDER BY id DESC LIMIT ? OFFSET ?" % where, args)
+        li = []
+        for version, author, ts, msg in cur:
+            tz_offset = -(altzone if localtime(ts).tm_isdst else timezone)
+            msg = [r.strip() for r in msg.split('\n') if r.strip()]
+            li.append([author, format_date(ts, tz_offset), msg, str(version)])
+        return li
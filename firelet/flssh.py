@@ -18,12 +18,28 @@ from datetime import datetime
 import logging
 import paramiko
 from time import time
-from threading import Thread
+from threading import Event, Thread
+
+try:
+    import json
+except ImportError: # pragma: no cover
+    import simplejson as json
 
 from .flutils import Bunch
 
 log = logging.getLogger(__name__)
 
+# Seconds before an unconfirmed ruleset is rolled back by the firewall
+ROLLBACK_TIMEOUT = 10
+
+# Seconds allowed to a two-phase commit in addition to twice the rollback
+# timeout, see SSHConnector.commit_confs
+COMMIT_TIMEOUT_MARGIN = 10
+
+# Seconds without data from a remote command before giving up, e.g. when a
+# new ruleset cuts the SSH session
+COMMAND_TIMEOUT = 60
+
 
 def timeit(method):
     """Log function call and execution time
@@ -50,13 +66,22 @@ def timeit(method):
 class Forker(object):
     """Fork a set of threads and wait for their completion
     """
-    def __init__(self, target, args_list, timeout=5, logger=log):
+    def __init__(self, target, args_list, timeout=5, logger=log,
+            cancel=None, cancel_timeout=None):
         """Setup Forker instance
 
         :param target: function
         :type target: function.
         :param args_list: argument list
         :type args_list: list.
+        :param timeout: time allowed to all the threads, in seconds
+        :type timeout: int.
+        :param cancel: event set when the threads time out; they are then
+            expected to stop and are waited for (optional)
+        :type cancel: threading.Event
+        :param cancel_timeout: seconds to wait for the cancelled threads
+            (default: until they stop)
+        :type cancel_timeout: int.
         """
         # Set up exception handling
         self.exception = None
@@ -73,13 +98,52 @@ class Forker(object):
             threads.append(thread)
             thread.setDaemon(True)
             thread.start()
+        deadline = time() + timeout
         for t in threads:
-            t.join(timeout)
-            #TODO: implement a global timeout, rather that waiting for every
-            # thread in a loop
+            t.join(max(0, deadline - time()))
         timed_out = filter(Thread.isAlive, threads)
         if timed_out:
             log.error("%s SSH connection threads timed out." % len(timed_out))
+            if cancel is not None:
+                cancel.set()
+                deadline = None if cancel_timeout is None \
+                    else time() + cancel_timeout
+                for t in timed_out:
+                    t.join(None if deadline is None
+                        else max(0, deadline - time()))
+                hung = len(filter(Thread.isAlive, timed_out))
+                if hung:
+                    log.error("%d SSH connection threads did not stop." %
+                        hung)
+        self.timed_out = len(timed_out)
+
+
+class Interface(tuple):
+    """Addresses configured on a network interface, as reported by
+    'ip addr show'.
+
+    For backward compatibility it behaves as the (ip_addr_v4, ip_addr_v6) tuple
+    of the primary addresses. Every address is available in the "ipv4" and
+    "ipv6" lists, in "<address>/<prefix length>" format.
+    """
+    def __new__(cls, name, ipv4=(), ipv6=()):
+        primary = (ipv4[0] if ipv4 else None, ipv6[0] if ipv6 else None)
+        self = tuple.__new__(cls, primary)
+        self.name = name
+        self.ipv4 = list(ipv4)
+        self.ipv6 = list(ipv6)
+        return self
+
+    def __getnewargs__(self):
+        return (self.name, self.ipv4, self.ipv6)
+
+    def addresses(self):
+        """List every address configured on the interface, without prefix
+        length
+
+        :rtype: list
+        """
+        return [a.split('/')[0] for a in self.ipv4 + self.ipv6]
 
 
 class SSHConnector(object):
@@ -88,7 +152,8 @@ class SSHConnector(object):
     """
 
     def __init__(self, targets=None, username='firelet',
-        ssh_key_autoadd=True, password=None):
+        ssh_key_autoadd=True, password=None, ifaces_cache=None,
+        ifaces_cache_ttl=300):
         """SSHConnector init
 
         :param targets: targets {hostname: [management ipaddr list ], ... }
@@ -99,6 +164,11 @@ class SSHConnector(object):
         :type ssh_key_autoadd: bool.
         :param password: SSH password, used only in assimilation (defaults to None)
         :type password: str.
+        :param ifaces_cache: dict shared between connectors to cache the
+            interfaces of each host (optional)
+        :type ifaces_cache: dict.
+        :param ifaces_cache_ttl: cached interfaces lifetime in seconds
+        :type ifaces_cache_ttl: int.
         """
 
         self._pool = {} # connections pool: {'hostname': pxssh session, ... }
@@ -107,6 +177,9 @@ class SSHConnector(object):
         assert isinstance(targets, dict), "targets must be a dict"
         self._username = username
         self._ssh_key_autoadd = ssh_key_autoadd
+        # {hostname: (timestamp, {iface: Interface, ... }), ... }
+        self._ifaces_cache = {} if ifaces_cache is None else ifaces_cache
+        self._ifaces_cache_ttl = ifaces_cache_ttl
         # limit paramiko logging verbosity
         logging.getLogger('paramiko').setLevel(logging.WARN)
 
@@ -207,7 +280,8 @@ class SSHConnector(object):
 
         if get_output:
             try:
-                stdin, stdout, stderr = c.exec_command(cmd)
+                stdin, stdout, stderr = c.exec_command(cmd,
+                    timeout=COMMAND_TIMEOUT)
                 out = stdout.readlines()
                 self._pool_status[hostname] = 'ok'
                 return map(str.rstrip, out)
@@ -217,24 +291,79 @@ class SSHConnector(object):
             return None
 
         else:
-            c.exec_command(cmd)
+            c.exec_command(cmd, timeout=COMMAND_TIMEOUT)
 
     @timeit
     def _get_conf(self, confs, hostname, username):
         """Connect to a firewall and get its configuration.
-            Save the output in a dict inside the shared dict "confs"
+            The configuration is parsed as soon as it is received, while the
+            other threads are still waiting for their firewalls.
+            Save a Bunch in the shared dict "confs", or the exception raised
+            while parsing.
         """
         log.debug("[%s] Getting conf from" % hostname)
         self._execute(hostname, 'logger -t firelet "Fetching existing configuration %s"' % hostname)
         iptables_save = self._execute(hostname, 'sudo /sbin/iptables-save')
-        log.debug("[%s] Received IPT save : %s" % (hostname, repr(iptables_save)))
-        ip_addr_show = self._execute(hostname, '/bin/ip addr show')
-        #log.debug("iptables save on %s: %s..." % (hostname, repr(iptables_save)[:130]))
-        confs[hostname] = (iptables_save, ip_addr_show)
+        if iptables_save is None:
+            return
+
+        log.debug("[%s] Received IPT save: %d lines" % (hostname,
+            len(iptables_save)))
+        try:
+            iptables_p = self.parse_iptables_save(iptables_save,
+                hostname=hostname)
+            #TODO: iptables-save can be very slow when a firewall cannot
+            # resolve localhost - add a warning?
+            ip_a_s_p = self._get_ifaces(hostname)
+        except Exception as e:
+            confs[hostname] = e
+            return
+
+        if ip_a_s_p is not None:
+            confs[hostname] = Bunch(iptables=iptables_p, ip_a_s=ip_a_s_p)
+
+    def _get_ifaces(self, hostname):
+        """Fetch the network interfaces of a firewall, unless a recent copy
+        is available in the interfaces cache.
+        'ip -j addr show' is used when supported by the remote host,
+        '/bin/ip addr show' otherwise or when its output cannot be parsed.
+
+        :returns: {iface: Interface, ... } or None
+        """
+        cached = self._ifaces_cache.get(hostname)
+        if cached and time() - cached[0] < self._ifaces_cache_ttl:
+            log.debug("[%s] Using cached interfaces" % hostname)
+            return cached[1]
+
+        ifaces = None
+        ip_addr_json = self._execute(hostname,
+            '/bin/ip -j addr show 2>/dev/null')
+        if ip_addr_json:
+            try:
+                ifaces = self.parse_ip_addr_json(ip_addr_json)
+            except Exception as e:
+                log.warn("[%s] %s, falling back to 'ip addr show'" % \
+                    (hostname, e))
+        if ifaces is None:
+            ip_addr_show = self._execute(hostname, '/bin/ip addr show')
+            if ip_addr_show is None:
+                return None
+            ifaces = self.parse_ip_addr_show(ip_addr_show)
+
+        self._ifaces_cache[hostname] = (time(), ifaces)
+        return ifaces
+
+    def invalidate_ifaces_cache(self, hostname=None):
+        """Drop the cached interfaces of one or all the firewalls
+        """
+        if hostname is None:
+            self._ifaces_cache.clear()
+        else:
+            self._ifaces_cache.pop(hostname, None)
 
     #@timeit
     def get_confs(self, keep_sessions=False, logger=log):
-        """Connects to the firewalls, get the configuration and
+        """Connects to the firewalls, get and parse the configurations
 
         :return: { hostname: Bunch of "session, ip_addr, iptables-save,
          interfaces", ... }
@@ -248,27 +377,15 @@ class SSHConnector(object):
         args = [(confs, hn, 'firelet') for hn in self._targets ]
         Forker(self._get_conf, args, logger=logger)
 
-        # parse the configurations
-        log.debug("Parsing configurations")
+        # the configurations have been parsed by the threads
         for hostname in self._targets:
-            if hostname not in confs:
+            conf = confs.get(hostname, None)
+            if conf is None:
                 raise Exception("No configuration received from %s" % \
                     hostname)
 
-            iptables_save, ip_addr_show = confs[hostname]
-            if iptables_save is None:
-                raise Exception("No configuration received from %s" % \
-                    hostname)
-
-            log.debug("iptables_save:" + repr(iptables_save))
-            iptables_p = self.parse_iptables_save(iptables_save,
-                hostname=hostname)
-            #TODO: iptables-save can be very slow when a firewall cannot
-            # resolve localhost - add a warning?
-            #log.debug("iptables_p %s" % repr(iptables_p))
-            ip_a_s_p = self.parse_ip_addr_show(ip_addr_show)
-            d = Bunch(iptables=iptables_p, ip_a_s=ip_a_s_p)
-            confs[hostname] = d
+            if isinstance(conf, Exception):
+                raise conf
 
         #FIXME: if a host returns unexpected output i.e. missing sudo it
         # should be logged
@@ -344,41 +461,65 @@ class SSHConnector(object):
         return Bunch(nat=nat, filter=f)
 
 
-    def _is_interface(self, s):
-        """Validate an interface definition from 'ip addr show'
-        """
-        try:
-            assert s
-            assert s[0] != ' '
-            n, name, info = s.split(None, 2)
-            if n[-1] == ':' and name[-1] == ':':
-                n = int(n[:-1])
-                return True
-        except:
-            return False
-        return False
-
     def parse_ip_addr_show(self, s):
         """Parse the output of 'ip addr show' and returns a dict:
 
         :param s: ip addr show output
         :type s: list.
-        :rtype: {'iface': (ip_addr_v4, ip_addr_v6)}
+        :rtype: {'iface': Interface}
         """
-        iface = ip_addr_v4 = ip_addr_v6 = None
         d = {}
+        iface = None
+        ipv4, ipv6 = [], []
         for q in s:
-            if self._is_interface(q):   # new interface definition
+            if not q:
+                continue
+            if q[0] != ' ':   # new interface definition: "2: eth0: <...> ..."
+                fields = q.split(None, 2)
+                if len(fields) < 2 or not fields[0][:-1].isdigit() \
+                        or not fields[0].endswith(':') \
+                        or not fields[1].endswith(':'):
+                    continue
                 if iface:
-                    d[iface] = (ip_addr_v4, ip_addr_v6) # save previous iface, if existing
-                iface = q.split()[1][:-1]  # second field, without trailing column
-                ip_addr_v4 = ip_addr_v6 = None
+                    d[iface] = Interface(iface, ipv4, ipv6)
+                # second field, without trailing column and "@link" suffix
+                iface = fields[1][:-1].split('@')[0]
+                ipv4, ipv6 = [], []
             elif iface and q.startswith('    inet '):
-                ip_addr_v4 = q.split()[1]
+                ipv4.append(q.split()[1])
             elif iface and q.startswith('    inet6 '):
-                ip_addr_v6 = q.split()[1]
+                ipv6.append(q.split()[1])
         if iface:
-            d[iface] = (ip_addr_v4, ip_addr_v6)
+            d[iface] = Interface(iface, ipv4, ipv6)
+        return d
+
+    def parse_ip_addr_json(self, s):
+        """Parse the output of 'ip -j addr show' and returns a dict:
+
+        :param s: ip -j addr show output
+        :type s: list or str.
+        :rtype: {'iface': Interface}
+        """
+        if isinstance(s, list):
+            s = '\n'.join(s)
+        try:
+            li = json.loads(s)
+        except ValueError as e:
+            raise Exception("Unable to parse 'ip -j addr show' output: %s" % e)
+
+        d = {}
+        for i in li:
+            if 'ifname' not in i:
+                continue
+            ipv4, ipv6 = [], []
+            for a in i.get('addr_info', ()):
+                addr = "%s/%s" % (a['local'], a['prefixlen'])
+                if a.get('family') == 'inet':
+                    ipv4.append(addr)
+                elif a.get('family') == 'inet6':
+                    ipv6.append(addr)
+            name = str(i['ifname'])
+            d[name] = Interface(name, ipv4, ipv6)
         return d
 
 
@@ -450,21 +591,28 @@ class SSHConnector(object):
         return status
 
 
-    def _setup_auto_rollback(self, status, hostname, username):
+    def _setup_auto_rollback(self, status, hostname, username,
+            timeout=ROLLBACK_TIMEOUT):
         """Run iptables-restore automatically on a firewall after a timeout.
         The previously saved conf will be loaded.
+        The status is 'ok' once the PID of the rollback script is read back.
         """
         #log.debug(" on %s..." % hostname)
-        self._execute(hostname, "rm -f rollback.pid; ("
+        out = self._execute(hostname, "rm -f rollback.pid; ("
             "logger -t firelet 'Automatic rollback enabled';"
-            "sleep 15;"
+            "sleep %d;"
             "logger -t firelet 'Rolling back configuration!';"
             "sudo /sbin/iptables-restore < iptables_previous && "
             "logger -t firelet 'Configuration rolled back!';"
             "rm -f rollback.pid;"
-            ") 2>/dev/null & echo $! > rollback.pid", get_output=False
-        )
-        log.debug("Auto rollback enabled on %s" % hostname)
+            ") >/dev/null 2>&1 & echo $! > rollback.pid; cat rollback.pid"
+            % timeout)
+        if out and len(out) == 1 and out[0].isdigit():
+            status[hostname] = 'ok'
+            log.debug("Auto rollback enabled on %s" % hostname)
+        else:
+            log.warn("Unable to enable auto rollback on %s: %s" % (hostname,
+                out))
 
     @timeit
     def setup_auto_rollbacks(self, keep_sessions=False):
@@ -545,6 +693,144 @@ class SSHConnector(object):
         return status
 
 
+    # Two-phase commit
+    #
+    # Phase one stages the new ruleset, arms an automatic rollback with a
+    # short deadline and applies the ruleset.
+    # Phase two verifies that the firewall is still reachable using a new
+    # SSH connection and then confirms the ruleset, cancelling the rollback,
+    # on the already pooled connection.
+    # Each firewall runs both phases in its own thread, without waiting for
+    # the others.
+
+    def _probe(self, hostname, timeout=5):
+        """Open a new SSH connection to a firewall to verify that it is still
+        reachable
+
+        :returns: True if reachable, False otherwise
+        """
+        for ip_addr in self._targets[hostname]:
+            c = paramiko.SSHClient()
+            c.load_system_host_keys()
+            if self._ssh_key_autoadd:
+                c.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                c.connect(hostname=ip_addr, port=22, username=self._username,
+                    timeout=timeout)
+                c.exec_command('logger -t firelet ping')
+                return True
+            except Exception as e:
+                log.info("Unable to reach %s on %s: %s" % (hostname, ip_addr,
+                    e))
+            finally:
+                c.close()
+
+        return False
+
+    def _confirm_conf(self, hostname):
+        """Cancel the automatic rollback on a firewall
+
+        :returns: True if the rollback was still pending and has been
+            cancelled, False otherwise
+        """
+        self._execute(hostname, 'logger -t firelet "Confirming configuration"')
+        out = self._execute(hostname, "kill $(cat rollback.pid) && "
+            "rm -f rollback.pid && echo confirmed")
+        return out == ['confirmed']
+
+    def _commit_conf(self, status, hostname, username, block,
+            rollback_timeout, cancel=None):
+        """Deploy a new configuration on a firewall using a two-phase commit.
+        The progress is tracked in the shared dict "status":
+        staging -> armed -> applied -> confirmed or failed
+        Once the "cancel" event is set the configuration is neither applied
+        nor confirmed.
+        """
+        cancel = cancel or Event()
+        status[hostname] = 'staging'
+        delivered, saved, tmp = {}, {}, {}
+        self._deliver_conf(delivered, hostname, username, block)
+        self._save_existing_conf(saved, hostname, username)
+        if delivered.get(hostname) != 'ok' or saved.get(hostname) != 'ok':
+            status[hostname] = 'failed: unable to stage the configuration'
+            return
+
+        self._setup_auto_rollback(tmp, hostname, username,
+            timeout=rollback_timeout)
+        deadline = time() + rollback_timeout
+        if tmp.get(hostname) != 'ok':
+            status[hostname] = 'failed: unable to arm the rollback'
+            return
+
+        status[hostname] = 'armed'
+        if cancel.is_set():
+            status[hostname] = 'failed: timed out while staging'
+            return
+
+        tmp = {}
+        self._apply_remote_conf(tmp, hostname, username)
+        if tmp.get(hostname) != 'ok':
+            status[hostname] = 'failed: iptables-restore failed, rolling back'
+            return
+
+        status[hostname] = 'applied'
+        if not self._probe(hostname, timeout=max(1, rollback_timeout / 2)):
+            status[hostname] = 'failed: unreachable, rolling back'
+            return
+
+        if cancel.is_set():
+            status[hostname] = 'failed: timed out, rolling back'
+            return
+
+        if time() >= deadline or not self._confirm_conf(hostname):
+            status[hostname] = 'failed: confirmation too late, rolled back'
+            return
+
+        status[hostname] = 'confirmed'
+        log.debug("Configuration confirmed on %s" % hostname)
+
+    @timeit
+    def commit_confs(self, newconfs_d, rollback_timeout=ROLLBACK_TIMEOUT,
+            status=None):
+        """Deploy the configurations on the firewalls using a two-phase
+        commit. Every firewall is confirmed as soon as it is verified to be
+        reachable; unconfirmed firewalls roll back to their previous
+        configuration after rollback_timeout seconds.
+
+        :arg newconfs_d: configurations: {hostname: [rule, ... ], ... }
+        :type newconfs_d: dict
+        :arg rollback_timeout: rollback deadline in seconds
+        :type rollback_timeout: int
+        :arg status: dict updated with the progress of each firewall
+            (optional)
+        :type status: dict
+        :returns: status of the targeted firewalls:
+            {hostname: 'confirmed' or 'failed: <reason>', ... }
+        :rtype: dict
+        """
+        assert isinstance(newconfs_d, dict), "Dict expected"
+        self._connect()
+        if status is None:
+            status = {}
+        # firewalls not done in time are cancelled and waited for, so that
+        # none is applied or confirmed after returning. Hung connections are
+        # given up after the rollback timeout: the firewalls roll back.
+        cancel = Event()
+        args = [(status, hn, 'firelet', newconfs_d[hn], rollback_timeout,
+            cancel) for hn in self._targets]
+        Forker(self._commit_conf, args,
+            timeout=rollback_timeout * 2 + COMMIT_TIMEOUT_MARGIN,
+            cancel=cancel,
+            cancel_timeout=rollback_timeout + COMMIT_TIMEOUT_MARGIN)
+        for hn in self._targets:
+            if status.get(hn) != 'confirmed':
+                status[hn] = status.get(hn, 'failed: no answer')
+                if not status[hn].startswith('failed'):
+                    status[hn] = 'failed: timed out while %s' % status[hn]
+
+        return dict((hn, status[hn]) for hn in self._targets)
+
+
 #TODO: fix MockSSHConnector
 
 class MockSSHConnector(SSHConnector):
@@ -558,6 +844,9 @@ class MockSSHConnector(SSHConnector):
     def _disconnect(self):
         pass
 
+    def _probe(self, hostname, timeout=5):
+        return True
+
     def _execute(self, hostname, s, get_output=True):
         """Execute remote command"""
         self._connect()
@@ -570,12 +859,24 @@ class MockSSHConnector(SSHConnector):
         elif s == '/bin/ip addr show':
             log.debug("Reading from %s/ip-addr-show-%s" % (d, h))
             return map(str.rstrip, open('%s/ip-addr-show-%s' % (d, h)))
+        elif s == '/bin/ip -j addr show 2>/dev/null':
+            # Emulate an old iproute2 unless a JSON dump is available
+            try:
+                return map(str.rstrip, open('%s/ip-j-addr-show-%s' % (d, h)))
+            except IOError:
+                return []
         # Used by _deliver_conf
         elif 'cat > .iptables' in s:
             log.debug("Writing to %s/iptables-save-%s and -x" % (d, h))
             li = s.split('\n')[1:-1]
             open('%s/iptables-save-%s' % (d, h), 'w').write('\n'.join(li)+'\n')
             open('%s/iptables-save-%s-x' % (d, h), 'w').write('\n'.join(li)+'\n')
+        # Used by _setup_auto_rollback
+        elif s.endswith('; cat rollback.pid'):
+            return ['4242']
+        # Used by _confirm_conf
+        elif s.startswith('kill $(cat rollback.pid) && '):
+            return ['confirmed']
         else:
             # Ignore other commands
             ignored = ('logger -t',
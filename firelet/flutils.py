@@ -7,16 +7,26 @@
 # (at your option) any later version.
 
 from Crypto.Cipher import AES
+from collections import OrderedDict
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
 from optparse import OptionParser
+from time import sleep, time
 from warnings import warn
 import base64
+import errno
 import hashlib
 import hmac
 import json
 import logging
 import os
+import threading
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
 
 log = logging.getLogger(__name__)
 
@@ -236,3 +246,252 @@ def decrypt_cookie(key, enc):
     # Parse JSON contents
     return json.loads(cleartext)
 
+
+
+class LRUCache(object):
+    """Bounded least-recently-used cache. Values can also be stored as JSON
+    files in a directory to survive restarts. The least recently used files
+    are deleted when there are more than disk_maxsize of them.
+    """
+
+    def __init__(self, maxsize=128, directory=None, disk_maxsize=1024):
+        """Setup the cache
+
+        :param maxsize: number of values kept in memory
+        :type maxsize: int
+        :param directory: directory used to store values on disk (optional)
+        :type directory: str
+        :param disk_maxsize: number of values kept on disk
+        :type disk_maxsize: int
+        """
+        self._maxsize = maxsize
+        self._directory = directory
+        self._disk_maxsize = disk_maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _fname(self, key):
+        h = hashlib.sha1(json.dumps(key)).hexdigest()
+        return os.path.join(self._directory, "%s.json" % h)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Get a value, looking on disk if it is not in memory.
+        Values read from disk contain lists instead of tuples.
+        """
+        with self._lock:
+            if key in self._items:
+                value = self._items.pop(key)
+                self._items[key] = value
+                return value
+
+        if not self._directory:
+            return default
+
+        fname = self._fname(key)
+        try:
+            with open(fname) as f:
+                value = json.load(f)
+            # the modification time tracks the last use, see _prune()
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            return default
+
+        self.put(key, value, write=False)
+        return value
+
+    def put(self, key, value, write=True):
+        """Store a value, evicting the least recently used one if needed"""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+        if self._directory and write:
+            fname = self._fname(key)
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(value, f)
+            os.rename(fname + '.tmp', fname)
+            self._prune()
+
+    def _prune(self):
+        """Delete the least recently used files in excess of disk_maxsize"""
+        fnames = [os.path.join(self._directory, fn)
+            for fn in os.listdir(self._directory) if fn.endswith('.json')]
+        if len(fnames) <= self._disk_maxsize:
+            return
+
+        def mtime(fname):
+            try:
+                return os.path.getmtime(fname)
+            except OSError:
+                return 0
+
+        fnames.sort(key=mtime)
+        for fname in fnames[:len(fnames) - self._disk_maxsize]:
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+
+
+class FileLock(object):
+    """Reentrant advisory lock shared between processes, based on flock.
+    Without fcntl, e.g. on Windows, it only locks between threads.
+    """
+
+    def __init__(self, fname, timeout=30):
+        """Setup the lock. The lock file is created when first acquired.
+
+        :param fname: lock file name
+        :type fname: str
+        :param timeout: seconds to wait for the lock
+        :type timeout: int
+        """
+        self._fname = fname
+        self._timeout = timeout
+        self._fd = None
+        self._depth = 0
+        self._held = False
+        self._rlock = threading.RLock()
+
+    def _flock(self, blocking):
+        """Lock the file, waiting up to timeout seconds if blocking"""
+        if fcntl is None:
+            return True
+        if self._fd is None:
+            self._fd = os.open(self._fname, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = time() + self._timeout
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if not blocking or time() > deadline:
+                return False
+            sleep(.05)
+
+    def acquire(self, blocking=True):
+        """Acquire the lock
+
+        :returns: True if acquired
+        """
+        if not self._rlock.acquire(blocking):
+            return False
+        if self._depth == 0 and not self._held and \
+                not self._flock(blocking):
+            self._rlock.release()
+            return False
+        self._depth += 1
+        return True
+
+    def release(self):
+        """Release the lock"""
+        self._depth -= 1
+        if self._depth == 0 and not self._held and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._rlock.release()
+
+    def hold(self):
+        """Keep the lock file locked until close(), excluding other
+        processes. Threads still take turns using acquire()
+
+        :returns: True if locked
+        """
+        with self._rlock:
+            if not self._held:
+                self._held = self._flock(True)
+            return self._held
+
+    def close(self):
+        """Close the lock file, releasing the lock"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._held = False
+
+    def __enter__(self):
+        if not self.acquire():
+            raise Alert("Timeout while waiting for lock %s" % self._fname)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class RWLock(object):
+    """Readers-writer lock for threads: any number of readers or a single
+    writer. Waiting writers are served before new readers. Both locks are
+    reentrant and the writer can also read, but a reader cannot become a
+    writer.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}  # thread -> depth
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is not me and me not in self._readers:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = threading.current_thread()
+        with self._cond:
+            self._readers[me] -= 1
+            if not self._readers[me]:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writer_depth += 1
+                return
+            assert me not in self._readers, \
+                "Cannot write while holding the read lock"
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
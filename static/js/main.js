@@ -4,25 +4,76 @@
 
 var selected_row = -1;
 
-// Refresh message pane
-function refresh_msg()
+// Append a log message pushed by the daemon to the message pane
+function append_msg(m)
 {
-    setTimeout("refresh_msg()",2000);
-    pos_top = $("div#msgslot").scrollTop();
-    th = $("table#msgs").height();
-    pos_bottom = th - pos_top - 100;
-    // Refresh messages if needed
-    if (pos_bottom < 10) {
-        $("table#msgs").load("/messages", function() {
-            $("div#msgslot").animate({scrollTop: '500px'}, 10);
-        });
-    }
-    $.getJSON("save_needed", function(json){
-        if (json.sn === true) $("div#savereset").show();
+    var tr = $('<tr/>');
+    tr.append($('<td class="hea"/>').append(
+        $('<img/>').attr('src', '/static/' + m[0] + '.png')));
+    tr.append($('<td class="ts"/>').text(m[1]));
+    tr.append($('<td/>').text(m[2]));
+    $("table#msgs").append(tr);
+    // Keep as many messages as the daemon buffer
+    $("table#msgs tr").slice(0, -20).remove();
+    $("div#msgslot").animate({scrollTop: '500px'}, 10);
+}
+
+// Handle a log message or save_needed update pushed by the daemon
+function handle_event(kind, data)
+{
+    if (kind == 'message') append_msg(data);
+    else if (kind == 'save_needed') {
+        if (data.sn === true) $("div#savereset").show();
         else $("div#savereset").hide();
+    }
+}
+
+// Receive events from the daemon using long polling, or polling every few
+// seconds if the daemon cannot wait for events
+function poll_events(since)
+{
+    $.ajax({
+        url: "api/1/events",
+        dataType: "json",
+        cache: false,
+        data: (since === undefined) ? {} : {since: since},
+        success: function(json) {
+            $.each(json.events, function(i, e) {
+                handle_event(e.kind, e.data);
+            });
+            setTimeout(function() { poll_events(json.last_id); },
+                json.delay * 1000);
+        },
+        error: function() {
+            setTimeout(function() { poll_events(since); }, 2000);
+        }
     });
 }
 
+// Receive events from the daemon using server-sent events, falling back to
+// long polling if the stream is refused
+function subscribe_events()
+{
+    var source = new EventSource("api/1/events/stream");
+    $.each(['message', 'save_needed'], function(i, kind) {
+        source.addEventListener(kind, function(e) {
+            handle_event(kind, JSON.parse(e.data));
+        });
+    });
+    source.onerror = function() {
+        if (source.readyState == EventSource.CLOSED) poll_events();
+    };
+}
+
+// Identify a table row in a POST request by its row ID and version, which
+// do not change when other rows are added, moved or deleted
+function row_ref(tr, data)
+{
+    data.row_id = tr.attr('row_id');
+    data.row_version = tr.attr('row_version');
+    return data;
+}
+
 //Disable shortcut key bindings
 function remove_main_keybindings() {
     $('body').unbind('keypress');
@@ -108,6 +159,16 @@ function setup_main_keybindings() {
     });
 }
 
+// Load a table tab, keeping the page and the search shown by its pager
+function load_page(url, callback) {
+    var pager = $('div.pager');
+    var query = {};
+    if (pager.length)
+        query = {offset: pager.attr('offset'), q: pager.attr('q'),
+            sort: pager.attr('sort')};
+    $('div.tabpane div').load(url + '?' + $.param(query), callback);
+}
+
 // Ran on tab change or reload
 function on_tab_load() {
     // Setup new help overlay
@@ -152,8 +213,27 @@ $(function() {
     });
     //FIXME: history not updated by shortcuts
 
-    // Start refreshing message pane
-    refresh_msg();
+    // Table pages and search
+    $('div.tabpane').delegate('div.pager a.page', 'click', function(e) {
+        var pager = $(this).closest('div.pager');
+        $('div.tabpane div').load(pager.attr('url') + '?' + $.param({
+            offset: $(this).attr('offset'), q: pager.attr('q'),
+            sort: pager.attr('sort')}));
+        e.preventDefault();
+    });
+
+    $('div.tabpane').delegate('div.pager form.search', 'submit', function(e) {
+        var pager = $(this).closest('div.pager');
+        $('div.tabpane div').load(pager.attr('url') + '?' + $.param({
+            q: $(this).find('input[name=q]').val(),
+            sort: pager.attr('sort')}));
+        e.preventDefault();
+    });
+
+    // Start refreshing message pane, using server-sent events if enabled
+    $("table#msgs").load("/messages");
+    if (event_stream && window.EventSource) subscribe_events();
+    else poll_events();
 
     setTimeout(function() {
         $("div#msgslot").scrollTop(1000);
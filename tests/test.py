@@ -14,15 +14,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from cStringIO import StringIO
 from logging import getLogger
 from mock import Mock
 from netaddr import IPNetwork
 from paramiko import SSHClient
 from pytest import raises
+import json
+import logging
 import mock
 import os
 import os.path
 import pytest
+import sqlite3
+import threading
+import time
 
 import testingutils
 
@@ -30,9 +36,17 @@ from firelet.confreader import ConfReader
 from firelet.flcore import Host, HostGroup, Network, Service, Users
 from firelet.flcore import Alert, validc
 from firelet.flcore import clean, GitFireSet, DemoGitFireSet, savejson, loadjson
-from firelet.flcore import readcsv, savecsv, Hosts
-from firelet.flmap import draw_svg_map
-from firelet.flssh import SSHConnector, MockSSHConnector
+from firelet.flcore import parsecsv, readcsv, savecsv, writecsv, Hosts
+from firelet.flcore import Rules, Services, Networks, HostGroups
+from firelet.flbulk import export_rows, import_rows
+from firelet.fldeploy import plan_waves, RollingDeployment
+from firelet.fljobs import JobQueue
+from firelet.flevents import EventBus, format_sse
+from firelet.flgit import GitRepository, DulwichRepository, parse_commit
+from firelet.flgit import dulwich_available
+from firelet.flmap import MapCache, draw_svg_map
+from firelet.flsqlite import SqliteFireSet, assign_positions
+from firelet.flssh import Forker, SSHConnector, MockSSHConnector
 from firelet.flutils import Bunch
 from firelet.mailer import Mailer
 
@@ -171,6 +185,150 @@ COMMIT""")
     assert len(ret) == 2
 
 
+def test_parse_ip_addr_show_multiple_addresses():
+    sx = MockSSHConnector(targets={'localhost':['127.0.0.1']})
+    ret = sx.parse_ip_addr_show("""1: lo: <LOOPBACK,UP,LOWER_UP> mtu 16436 qdisc noqueue state UNKNOWN
+    link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+    inet 127.0.0.1/8 scope host lo
+2: eth0: <BROADCAST,MULTICAST,UP> mtu 1500 qdisc pfifo_fast state UNKNOWN qlen 1000
+    link/ether 00:00:00:00:00:00 brd ff:ff:ff:ff:ff:ff
+    inet 10.66.1.1/24 brd 10.66.1.255 scope global eth0
+    inet 10.66.9.1/24 brd 10.66.9.255 scope global eth0
+    inet6 fe80::3939:3939:3939:3939/64 scope link
+       valid_lft forever preferred_lft forever
+3: eth0.5@eth0: <BROADCAST,MULTICAST> mtu 1500 qdisc noop state DOWN
+    link/ether 00:00:00:00:00:00 brd ff:ff:ff:ff:ff:ff""".split('\n'))
+    assert sorted(ret) == ['eth0', 'eth0.5', 'lo']
+    assert ret['eth0'] == ('10.66.1.1/24', 'fe80::3939:3939:3939:3939/64')
+    assert ret['eth0'].ipv4 == ['10.66.1.1/24', '10.66.9.1/24']
+    assert '10.66.9.1' in ret['eth0'].addresses()
+    assert ret['eth0.5'] == (None, None)
+
+def test_parse_ip_addr_json():
+    sx = MockSSHConnector(targets={'localhost':['127.0.0.1']})
+    ret = sx.parse_ip_addr_json('''[{"ifindex": 1, "ifname": "lo",
+        "addr_info": [{"family": "inet", "local": "127.0.0.1", "prefixlen": 8},
+                      {"family": "inet6", "local": "::1", "prefixlen": 128}]},
+        {"ifindex": 2, "ifname": "eth0", "addr_info": [
+            {"family": "inet", "local": "10.66.1.1", "prefixlen": 24},
+            {"family": "inet", "local": "10.66.9.1", "prefixlen": 24}]},
+        {"ifindex": 3, "ifname": "eth1", "addr_info": []}]''')
+    assert ret['lo'] == ('127.0.0.1/8', '::1/128')
+    assert ret['eth0'].ipv4 == ['10.66.1.1/24', '10.66.9.1/24']
+    assert ret['eth0'].ipv6 == []
+    assert ret['eth1'] == (None, None)
+
+def test_get_ifaces_cached(repodir):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1']}, ifaces_cache={})
+    sx.repodir = repodir
+    ifaces = sx._get_ifaces('BorderFW')
+    assert ifaces['eth1'] == ('10.66.1.1/24', 'fe80::3939:3939:3939:3939/64')
+    sx._execute = Mock()
+    assert sx._get_ifaces('BorderFW') is ifaces
+    assert not sx._execute.called
+    sx.invalidate_ifaces_cache('BorderFW')
+    assert 'BorderFW' not in sx._ifaces_cache
+
+def test_get_ifaces_bad_json(repodir):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1']}, ifaces_cache={})
+    sx.repodir = repodir
+    execute = sx._execute
+    sx._execute = lambda hn, cmd: '[{"ifname": ' if '-j' in cmd \
+        else execute(hn, cmd)
+    ifaces = sx._get_ifaces('BorderFW')
+    assert ifaces['eth1'] == ('10.66.1.1/24', 'fe80::3939:3939:3939:3939/64')
+
+
+def test_get_confs_parsed_by_workers(repodir):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1'],
+        'Smeagol': ['10.66.1.3']})
+    sx.repodir = repodir
+    confs = sx.get_confs()
+    assert sorted(confs) == ['BorderFW', 'Smeagol']
+    assert '*filter' not in confs['Smeagol'].iptables['filter']
+    assert confs['Smeagol'].ip_a_s['eth0'][0] == '10.66.1.3/24'
+
+def test_get_confs_parsing_error(repodir):
+    with open(os.path.join(repodir, 'iptables-save-Smeagol'), 'w') as f:
+        f.write('bogus\n')
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1'],
+        'Smeagol': ['10.66.1.3']})
+    sx.repodir = repodir
+    with raises(Exception) as e:
+        sx.get_confs()
+    assert 'Unable to parse iptables-save output' in str(e.value)
+
+
+def test_commit_confs(repodir):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1'],
+        'Smeagol': ['10.66.1.3']})
+    sx.repodir = repodir
+    block = ['*filter', '-A INPUT -j ACCEPT', 'COMMIT']
+    status = sx.commit_confs({'BorderFW': block, 'Smeagol': block})
+    assert status == {'BorderFW': 'confirmed', 'Smeagol': 'confirmed'}
+
+def test_commit_confs_unreachable(repodir):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1'],
+        'Smeagol': ['10.66.1.3']})
+    sx.repodir = repodir
+    sx._probe = lambda hostname, timeout: hostname != 'Smeagol'
+    sx._confirm_conf = Mock(return_value=True)
+    block = ['*filter', '-A INPUT -j ACCEPT', 'COMMIT']
+    status = sx.commit_confs({'BorderFW': block, 'Smeagol': block},
+        rollback_timeout=3)
+    assert status['BorderFW'] == 'confirmed'
+    assert status['Smeagol'].startswith('failed: unreachable')
+    sx._confirm_conf.assert_called_once_with('BorderFW')
+
+
+def test_commit_confs_timeout(repodir, monkeypatch):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1'],
+        'Smeagol': ['10.66.1.3']})
+    sx.repodir = repodir
+    monkeypatch.setattr('firelet.flssh.COMMIT_TIMEOUT_MARGIN', 0)
+    save = sx._save_existing_conf
+    def slow_save(status, hostname, username):
+        if hostname == 'Smeagol':
+            time.sleep(3)
+        save(status, hostname, username)
+    sx._save_existing_conf = slow_save
+    apply_conf = sx._apply_remote_conf
+    applied = []
+    def apply_remote_conf(status, hostname, username):
+        applied.append(hostname)
+        apply_conf(status, hostname, username)
+    sx._apply_remote_conf = apply_remote_conf
+    block = ['*filter', '-A INPUT -j ACCEPT', 'COMMIT']
+    status = sx.commit_confs({'BorderFW': block, 'Smeagol': block},
+        rollback_timeout=1)
+    assert status['BorderFW'] == 'confirmed'
+    assert status['Smeagol'] == 'failed: timed out while staging'
+    assert applied == ['BorderFW']
+
+def test_commit_confs_rollback_not_armed(repodir):
+    sx = MockSSHConnector(targets={'BorderFW':['10.66.1.1']})
+    sx.repodir = repodir
+    execute = sx._execute
+    sx._execute = lambda hn, cmd, get_output=True: [] \
+        if cmd.endswith('cat rollback.pid') else execute(hn, cmd, get_output)
+    sx._apply_remote_conf = Mock()
+    block = ['*filter', '-A INPUT -j ACCEPT', 'COMMIT']
+    status = sx.commit_confs({'BorderFW': block}, rollback_timeout=1)
+    assert status['BorderFW'] == 'failed: unable to arm the rollback'
+    assert not sx._apply_remote_conf.called
+
+def test_forker_hung_threads():
+    hang = threading.Event()
+    cancel = threading.Event()
+    t = time.time()
+    f = Forker(hang.wait, [(), ()], timeout=0.1, cancel=cancel,
+        cancel_timeout=0.1)
+    assert time.time() - t < 2
+    assert cancel.is_set()
+    assert f.timed_out == 2
+    hang.set()
+
+
 #def test_gen_iptables_restore_1(repodir):
 #    sx = SSHConnector(targets={'localhost':['127.0.0.1']})
 #    block = sx._gen_iptables_restore('localhost', [])
@@ -225,7 +383,8 @@ def test_MockSSHConnector_get_confs(repodir):
 #
 #@with_setup(setup_dummy_flssh)
 #def test_get_confs_local_dummy(repodir):
-#    from firelet.flssh import SSHConnector, MockSSHConnector
+#    from firelet.flsqlite import SqliteFireSet, assign_positions
+from firelet.flssh import SSHConnector, MockSSHConnector
 #
 #    sshconn = SSHConnector(targets={'localhost':['127.0.0.1']} )
 #    d  = sshconn.get_confs( )
@@ -364,6 +523,657 @@ def test_gitfireset_simple(gfs):
     gfs.reset()
     assert gfs.save_needed() == False
 
+@require_git
+def test_gitfireset_save_needed_without_git(gfs):
+    with mock.patch.object(gfs, '_repo') as repo:
+        assert gfs.save_needed() == False
+        gfs.rules.disable(2)
+        assert gfs.save_needed() == True
+    assert not repo.method_calls
+
+@require_git
+def test_gitfireset_save_needed_at_startup(repodir, gfs):
+    gfs.rules.disable(2)
+    gfs2 = GitFireSet(repodir=repodir)
+    assert gfs2.save_needed() == True
+    gfs2.reset()
+    assert gfs2.save_needed() == False
+
+def test_parse_commit():
+    raw = """tree 4b825dc642cb6eb9a060e54bf8d69288fbee4904
+parent 9fceb02d0ae598e95dc970b74767f19372d61af8
+author Firelet <firelet@localhost> 1273061696 -0230
+committer Firelet <firelet@localhost> 1273061696 -0230
+
+rules: n.1 deleted
+
+second line
+"""
+    author, date, msg, parents, ts = parse_commit(raw)
+    assert author == 'Firelet <firelet@localhost>'
+    assert date == '2010-05-05 09:44:56 -0230'
+    assert msg == ['rules: n.1 deleted', 'second line']
+    assert parents == ['9fceb02d0ae598e95dc970b74767f19372d61af8']
+    assert ts == 1273061696
+
+@require_git
+@pytest.mark.parametrize('repo_class', [GitRepository,
+    pytest.param(DulwichRepository, marks=pytest.mark.skipif(
+        not dulwich_available, reason='Dulwich not installed'))])
+def test_git_repository(repodir, repo_class):
+    repo = repo_class(repodir)
+    assert not repo.is_repository() or repo.toplevel() != repodir
+    GitRepository(repodir).init('created')
+    assert repo.head()
+    assert not repo.is_dirty()
+    with open(os.path.join(repodir, 'rules.csv'), 'a') as f:
+        f.write('0 new * * * * ACCEPT 0 ""\n')
+    assert repo.is_dirty()
+    repo.commit("it's a test")
+    assert not repo.is_dirty()
+    log = list(repo.log())
+    assert [c[3] for c in log] == [["it's a test"], ['created']]
+    assert log[0][4] == [log[1][0]]
+    assert log[0][1] == 'Firelet <firelet@localhost>'
+    assert list(repo.log(stop=[log[1][0]]))[0][0] == log[0][0]
+    assert len(list(repo.log(stop=[log[1][0]]))) == 1
+    assert 'new * * * * ACCEPT' in repo.diff(log[1][0])
+    repo.reset(log[1][0])
+    assert repo.head() == log[1][0]
+    repo.close()
+
+@require_git
+def test_gitfireset_version_index_incremental(gfs):
+    gfs.rules.disable(2)
+    gfs.save('first')
+    assert [v[2] for v in gfs.version_list()] == [['first']]
+    gfs.rules.enable(2)
+    with mock.patch.object(gfs._repo, 'read_commit',
+            wraps=gfs._repo.read_commit) as read_commit:
+        gfs.save('second')
+        assert [v[2] for v in gfs.version_list()] == [['second'], ['first']]
+    # only the new commit and its parent are read
+    assert read_commit.call_count == 2
+    gfs.rollback(1)
+    assert [v[2] for v in gfs.version_list()] == [['first']]
+
+@require_git
+def test_gitfireset_version_diff_cached(gfs):
+    gfs.rules.disable(2)
+    gfs.save('first')
+    gfs.rules.enable(2)
+    gfs.save('second')
+    cid = gfs.version_list()[-1][3]
+    diff = gfs.version_diff(cid)
+    assert diff
+    with mock.patch.object(gfs._repo, 'diff') as git_diff:
+        assert gfs.version_diff(cid) == diff
+    assert not git_diff.called
+
+    # unsaved changes are not cached
+    gfs.rules.disable(3)
+    assert gfs.version_diff(cid) != diff
+
+@require_git
+def test_gitfireset_version_diff_tables(gfs):
+    old_row = list(gfs._read_table_rows('rules')[2])
+    gfs.rules.disable(2)
+    gfs.save('disabled')
+    cid = gfs.version_list()[0][3]
+    gfs.networks.add(dict(name='Foo', ip_addr='10.0.0.0', masklen='8'))
+    gfs.delete('services', 0)
+    gfs.save('changed')
+    diff = gfs.version_diff_tables(cid)
+    assert sorted(diff) == ['networks', 'services']
+    assert [len(gfs.networks) - 1, ['Foo', '10.0.0.0', '8']] in \
+        diff['networks']['added']
+    assert diff['services']['removed'][0][0] == 0
+    assert gfs.version_diff_tables(cid) is diff
+
+    diff = gfs.version_diff_tables('HEAD~2')
+    assert diff['rules']['removed'] == [[2, old_row]]
+    assert diff['rules']['added'][0][1][0] == '0'
+
+@require_git
+def test_gitfireset_transaction(repodir, gfs):
+    with mock.patch('firelet.flcore.savecsv') as savecsv:
+        with gfs.transaction():
+            for n in range(5):
+                gfs.rules.movedown(n)
+            gfs.delete('services', 0)
+            assert gfs.save_needed()
+            assert os.path.exists(repodir + '/.firelet-journal')
+    assert not savecsv.called
+    assert not os.path.exists(repodir + '/.firelet-journal')
+    rules = [r.name for r in gfs.rules]
+    gfs2 = GitFireSet(repodir=repodir)
+    assert [r.name for r in gfs2.rules] == rules
+    assert len(gfs2.services) == len(gfs.services)
+    assert gfs2.save_needed()
+
+@require_git
+def test_gitfireset_transaction_failed(repodir, gfs):
+    rules = [(r.name, r.enabled) for r in gfs.rules]
+    assert not gfs.save_needed()
+    with mock.patch('firelet.flcore.writecsv') as writecsv:
+        with raises(Alert):
+            with gfs.transaction():
+                gfs.rules.movedown(0)
+                gfs.rules.disable(3)
+                raise Alert('bogus')
+    assert not writecsv.called
+    assert [(r.name, r.enabled) for r in gfs.rules] == rules
+    assert not gfs.save_needed()
+    assert not os.path.exists(repodir + '/.firelet-journal')
+    # the lock is released
+    gfs.rules.disable(3)
+    assert GitFireSet(repodir=repodir).rules[3].enabled == '0'
+
+@require_git
+def test_gitfireset_transaction_crash_recovery(repodir, gfs):
+    txn = gfs.transaction()
+    txn.__enter__()
+    gfs.rules.movedown(0)
+    gfs.rules.disable(3)
+    gfs.networks.add(dict(name='Foo', ip_addr='10.0.0.0', masklen='8'))
+    # crash: the tables are not written and the lock is released
+    gfs._shared.lock.close()
+    rules = [(r.name, r.enabled) for r in gfs.rules]
+    gfs2 = GitFireSet(repodir=repodir)
+    assert [(r.name, r.enabled) for r in gfs2.rules] == rules
+    assert gfs2.networks[-1].name == 'Foo'
+    assert not os.path.exists(repodir + '/.firelet-journal')
+    assert gfs2.save_needed()
+
+@require_git
+def test_gitfireset_interrupted_flush(repodir, gfs):
+    with mock.patch('os.rename', side_effect=OSError):
+        with raises(OSError):
+            with gfs.transaction():
+                gfs.rules.disable(3)
+    gfs2 = GitFireSet(repodir=repodir)
+    assert gfs2.rules[3].enabled == '0'
+    assert not os.path.exists(repodir + '/rules.csv.tmp')
+
+@require_git
+def test_gitfireset_write_behind(repodir):
+    gfs = GitFireSet(repodir=repodir, write_behind=True)
+    gfs.rules.disable(3)
+    assert list(readcsv('rules', repodir))[3][0] == '1'
+    gfs.save('disabled')
+    assert list(readcsv('rules', repodir))[3][0] == '0'
+    assert not gfs.save_needed()
+    gfs.rules.enable(3)
+    gfs.reset()
+    assert gfs.rules[3].enabled == '0'
+    assert not os.path.exists(repodir + '/.firelet-journal')
+
+@require_git
+def test_gitfireset_live_journal_not_replayed(repodir, gfs):
+    txn = gfs.transaction()
+    txn.__enter__()
+    gfs.rules.disable(3)
+    # the transaction is still running: the journal is left alone
+    gfs2 = GitFireSet(repodir=repodir)
+    assert gfs2.rules[3].enabled == '1'
+    assert os.path.exists(repodir + '/.firelet-journal')
+    with raises(Alert):
+        with mock.patch('firelet.flcore.LOCK_TIMEOUT', 0):
+            gfs3 = GitFireSet(repodir=repodir)
+            gfs3.rules.disable(4)
+    txn.__exit__(None, None, None)
+    assert gfs2.refresh() == ['rules']
+    assert gfs2.rules[3].enabled == '0'
+
+@require_git
+def test_gitfireset_refresh(repodir, gfs):
+    gfs2 = GitFireSet(repodir=repodir)
+    assert gfs2.refresh() == []
+    gfs.rules.disable(3)
+    with mock.patch.object(gfs2.hosts, 'reload') as reload_hosts:
+        assert gfs2.refresh() == ['rules']
+        assert not reload_hosts.called
+    assert gfs2.rules[3].enabled == '0'
+    assert gfs2.save_needed()
+    gfs.save('disabled')
+    gfs2.refresh()
+    assert not gfs2.save_needed()
+
+@require_git
+def test_gitfireset_concurrent_edit(repodir, gfs):
+    gfs2 = GitFireSet(repodir=repodir)
+    gfs.rules.disable(3)
+    # gfs2 has not refreshed its tables yet
+    with raises(Alert):
+        gfs2.rules.disable(4)
+    assert gfs2.rules[3].enabled == '0'
+    assert gfs2.rules[4].enabled == '1'
+    gfs2.rules.disable(4)
+    gfs.refresh()
+    assert gfs.rules[4].enabled == '0'
+
+@require_git
+def test_gitfireset_copy_on_write(gfs):
+    rules = list(gfs.rules)
+    it = iter(gfs.rules)
+    first = next(it)
+    gfs.rules.disable(0)
+    gfs.rules.moveup(2)
+    gfs.delete('rules', 5)
+    # the previous list and its items are unchanged
+    assert [first] + list(it) == rules
+    assert rules[0].enabled == '1'
+    assert gfs.rules[0].enabled == '0'
+    assert gfs.rules[0] is not rules[0]
+    assert gfs.rules.by_name('ssh_all') == [gfs.rules[0]]
+    assert [r.name for r in gfs.rules][1:3] == ['NoSmeagol', 'BG_https']
+
+@require_git
+def test_gitfireset_read_only_snapshot(gfs):
+    version = gfs.version
+    snap = gfs.snapshot()
+    assert snap.version == version
+    assert snap.rules.frozen() is snap.rules
+    assert gfs.snapshot().rules is snap.rules
+    compiled = snap.compile_rules()
+    gfs.rules.disable(0)
+    gfs.delete('hosts', 0)
+    assert gfs.version > version
+    assert snap.version == version
+    assert snap.rules[0].enabled == '1'
+    assert len(snap.hosts) == len(gfs.hosts) + 1
+    assert snap.hosts.by_iface('BorderFW', 'eth0')
+    assert snap.compile_rules() == compiled
+    assert gfs.snapshot().rules is not snap.rules
+    with raises(Alert):
+        snap.rules.enable(0)
+    with raises(Alert):
+        snap.delete('rules', 0)
+    assert snap.rules[0].enabled == '1'
+    gfs.reset()
+    assert gfs.snapshot().version > version
+
+@require_git
+def test_snapshot_unchanged_by_cascade(gfs):
+    snap = gfs.snapshot()
+    prepared = snap.hostgroups.prepared(), snap.hosts.prepared()
+    gfs.delete('hosts', gfs.hosts.position(
+        gfs.hosts.by_iface('BorderFW', 'eth0').row_id), on_reference='cascade')
+    gfs.delete('networks', [n.name for n in gfs.networks].index(
+        'production_net'), on_reference='cascade')
+    assert gfs.hostgroups.by_name('WebServers')[0].childs == []
+    assert gfs.hosts.by_iface('BorderFW', 'eth1').routed == []
+    assert snap.hostgroups.by_name('WebServers')[0].childs == \
+        ['BorderFW:eth0']
+    assert snap.hosts.by_iface('BorderFW', 'eth1').routed == \
+        ['production_net']
+    assert (snap.hostgroups.prepared(), snap.hosts.prepared()) == prepared
+
+@require_git
+def test_gitfireset_row_ids(repodir, gfs):
+    rule = gfs.rules[2]
+    row_id = rule.row_id
+    assert rule.row_version == 1
+    assert gfs.rules.by_id(row_id) is rule
+    assert gfs.rules.by_id(999) is None
+    gfs.rules.add({}, rid=0)
+    gfs.rules.movedown(3)
+    assert gfs.rules.position(row_id) == 4
+    gfs.rules.disable(4)
+    assert gfs.rules[4].row_id == row_id
+    assert gfs.rules[4].row_version == 2
+    assert gfs.rules.position(row_id, version=2) == 4
+    with raises(Alert):
+        gfs.rules.position(row_id, version=1)
+    # row IDs are kept across reloads from other processes
+    gfs2 = GitFireSet(repodir=repodir)
+    gfs2.rules.enable(4)
+    gfs.refresh()
+    assert gfs.rules.by_id(row_id).row_version == 3
+    assert gfs.rules.by_id(row_id).enabled == '1'
+    gfs.delete('rules', 4)
+    with raises(Alert):
+        gfs.rules.position(row_id)
+
+@require_git
+def test_bulk_import_csv(gfs):
+    n_hosts = len(gfs.hosts)
+    data = ("# hostname iface ip_addr masklen local_fw network_fw mng routed\n"
+        "Foo eth0 10.0.0.1 24 1 0 1\n"
+        "\n"
+        "Foo eth1 10.0.1.1 24 0 1 0 Internet shire\n")
+    with mock.patch.object(Hosts, 'save', autospec=True) as save:
+        n, errors = import_rows(gfs, 'hosts', StringIO(data))
+        assert save.call_count == 1
+    assert (n, errors) == (2, [])
+    assert len(gfs.hosts) == n_hosts + 2
+    host = gfs.hosts.by_iface('Foo', 'eth1')
+    assert host.routed == ['Internet', 'shire']
+    assert host.local_fw == '0'
+
+@require_git
+def test_bulk_import_errors(gfs):
+    hosts = gfs.hosts.prepared()
+    data = ("Foo eth0 10.0.0.1 24 1 0 1\n"
+        "BorderFW eth0 10.0.0.2 24 1 0 1\n"
+        "Bar eth0 10.0.0.300 24 1 0 1\n"
+        "Foo eth0 10.0.0.4 24 1 0 1\n"
+        "Baz eth0 10.0.0.5\n")
+    n, errors = import_rows(gfs, 'hosts', StringIO(data), msg='import')
+    assert n == 0
+    assert [e[0] for e in errors] == [2, 3, 4, 5]
+    assert 'already defined' in errors[0][1]
+    assert 'Missing field' in errors[3][1]
+    assert gfs.hosts.prepared() == hosts
+    assert not gfs.save_needed()
+    with raises(Alert):
+        import_rows(gfs, 'rules', StringIO(''))
+
+@require_git
+def test_bulk_import_hostgroups_checked(gfs):
+    hostgroups = gfs.hostgroups.prepared()
+    n, errors = import_rows(gfs, 'hostgroups', StringIO("LoopA LoopB\n"
+        "LoopB LoopA\nGhost NoSuchHost\nSelf Servers Self\n"), msg='import')
+    assert n == 0
+    assert [e[0] for e in errors] == [1, 2, 3, 4]
+    assert 'Loop' in errors[0][1] and 'Loop' in errors[3][1]
+    assert errors[2][1] == 'Unknown member: NoSuchHost'
+    assert gfs.hostgroups.prepared() == hostgroups
+    n, errors = import_rows(gfs, 'hostgroups', StringIO("NewB NewA shire\n"
+        "NewA BorderFW:eth0 Servers\n"), msg='import')
+    assert (n, errors) == (2, [])
+    assert gfs.compile_rules()
+
+@require_git
+def test_bulk_import_json_and_commit(gfs):
+    data = ('{"name": "dmz", "ip_addr": "10.9.0.0", "masklen": 16}\n'
+        '{"name": "lab", "ip_addr": "10.8.0.0", "masklen": "24"}\n')
+    n, errors = import_rows(gfs, 'networks', StringIO(data), fmt='json',
+        msg='new networks')
+    assert (n, errors) == (2, [])
+    assert not gfs.save_needed()
+    assert gfs.version_list()[0][2] == ['new networks']
+    assert gfs.networks.by_name('lab')[0].masklen == 24
+    n, errors = import_rows(gfs, 'networks', StringIO('[{"name": "x"}, 3]'),
+        fmt='json')
+    assert [e[0] for e in errors] == [1, 2]
+
+@require_git
+def test_bulk_export(repodir, gfs):
+    csv_out = ''.join(export_rows(gfs, 'hosts'))
+    assert csv_out.startswith('# hostname iface')
+    lines = ['# Format 0.1 - Do not edit this line'] + csv_out.splitlines()
+    assert list(parsecsv(lines, 'export')) == list(readcsv('hosts', repodir))
+    json_out = json.loads(''.join(export_rows(gfs, 'services', 'json')))
+    assert json_out[0] == dict(name=gfs.services[0].name,
+        protocol=gfs.services[0].protocol, ports=gfs.services[0].ports)
+    # round trip
+    exported = json.loads(''.join(export_rows(gfs, 'hostgroups', 'json')))
+    hgs = gfs.hostgroups.prepared()[:2]
+    gfs.delete('hostgroups', 0)
+    gfs.delete('hostgroups', 0)
+    n, errors = import_rows(gfs, 'hostgroups',
+        StringIO(json.dumps(exported[:2])), fmt='json')
+    assert (n, errors) == (2, [])
+    assert gfs.hostgroups.prepared()[-2:] == hgs
+
+@require_git
+def test_batch_cascade_rolled_back(repodir, gfs):
+    hostgroups = gfs.hostgroups.prepared()
+    border = gfs.hosts.by_iface('BorderFW', 'eth0')
+    results = gfs.batch([dict(op='delete', table='hosts',
+            row_id=border.row_id, on_reference='cascade'),
+        dict(op='delete', table='hosts', row_id=99999)])
+    assert [r['error'] for r in results][0] == 'Rolled back'
+    assert gfs.hostgroups.by_name('WebServers')[0].childs == ['BorderFW:eth0']
+    assert gfs.hostgroups.prepared() == hostgroups
+    gfs2 = GitFireSet(repodir=repodir)
+    assert gfs2.hostgroups.by_name('WebServers')[0].childs == ['BorderFW:eth0']
+
+@require_git
+def test_batch_crash_recovery(repodir):
+    gfs = GitFireSet(repodir=repodir, write_behind=True)
+    gfs.rules.add(dict(enabled='1', name='NewTop', src='*', src_serv='*',
+        dst='*', dst_serv='*', action='ACCEPT', log_level=0, desc=''), rid=0)
+    gfs.save('added')
+    results = gfs.batch([dict(op='disable', table='rules',
+        row_id=gfs.rules[0].row_id)])
+    assert results[0]['ok']
+    results = gfs.batch([dict(op='enable', table='rules',
+        row_id=gfs.rules[1].row_id), dict(op='bogus', table='rules')])
+    assert results[0]['error'] == 'Rolled back'
+    # crash before the tables are written
+    gfs._shared.lock.close()
+    gfs2 = GitFireSet(repodir=repodir)
+    assert [(r.name, r.enabled) for r in gfs2.rules] == \
+        [(r.name, r.enabled) for r in gfs.rules]
+    assert gfs2.rules[0].enabled == '0'
+    assert gfs2.rules[-1].enabled == '1'
+
+@require_git
+def test_table_query(gfs):
+    total, rows = gfs.rules.query(filters=dict(object='BorderFW:eth1'))
+    assert total == 3
+    assert [(rid, r.name) for rid, r in rows] == [(1, 'BG_https'),
+        (2, 'NoSmeagol'), (5, 'ssh_mgmt')]
+    total, rows = gfs.rules.query(filters=dict(object='BorderFW:eth1',
+        service='SSH'))
+    assert [r.name for rid, r in rows] == ['ssh_mgmt']
+    total, rows = gfs.hosts.query(search='borderfw', sort='-ip_addr',
+        offset=1, limit=1)
+    assert total == 3
+    assert [(rid, h.iface) for rid, h in rows] == [(6, 'eth2')]
+    total, rows = gfs.hosts.query(filters=dict(network='Internet'))
+    assert [h.hostname for rid, h in rows] == ['BorderFW', 'Tester']
+    snap = gfs.snapshot()
+    assert snap.rules.query(filters=dict(name='irc'))[1][0][0] == 6
+    assert snap.rules.query(filters=dict(name='nope')) == (0, [])
+    with raises(Alert):
+        gfs.services.query(filters=dict(address='10.0.0.1'))
+    with raises(Alert):
+        gfs.services.query(sort='bogus')
+
+@require_git
+def test_batch(repodir, gfs):
+    ids = [r.row_id for r in gfs.rules]
+    ops = [dict(op='move', table='rules', row_id=ids[8], to=0),
+        dict(op='disable', table='rules', row_id=ids[0]),
+        dict(op='update', table='services', row_id=gfs.services[0].row_id,
+            fields=dict(name=u'ssh', protocol=u'TCP', ports=u'2222')),
+        dict(op='add', table='rules', position=1, fields=dict(enabled='1',
+            name='new', src='*', src_serv='*', dst='*', dst_serv='*',
+            action='ACCEPT', log_level=0, desc='')),
+        dict(op='delete', table='rules', row_id=ids[6])]
+    with mock.patch('firelet.flcore.savecsv') as save:
+        with mock.patch('firelet.flcore.writecsv', wraps=writecsv) as write:
+            results = gfs.batch(ops)
+    assert write.call_count == 2 and not save.called
+    assert all(r['ok'] for r in results)
+    assert results[0] == dict(ok=True, row_id=ids[8], row_version=1)
+    assert results[1]['row_version'] == 2
+    assert [r.name for r in gfs.rules][:3] == ['ntp', 'new', 'ssh_all']
+    assert 'irc' not in [r.name for r in gfs.rules]
+    assert not gfs.rules.enabled(2)
+    assert GitFireSet(repodir=repodir).services[0].ports == '2222'
+
+@require_git
+def test_batch_atomic(repodir, gfs):
+    rules = gfs.rules.prepared()
+    ops = [dict(op='disable', table='rules', row_id=gfs.rules[0].row_id),
+        dict(op='delete', table='hosts', row_id=gfs.hosts[0].row_id),
+        dict(op='enable', table='rules', row_id=gfs.rules[1].row_id,
+            row_version=7),
+        dict(op='move', table='rules', row_id=gfs.rules[2].row_id, to=0)]
+    results = gfs.batch(ops)
+    assert [r['ok'] for r in results] == [False] * 4
+    assert [r['error'] for r in results[:2]] == ['Rolled back'] * 2
+    assert 'modified in the meantime' in results[2]['error']
+    assert results[3]['error'] == 'Skipped'
+    assert gfs.rules.prepared() == rules
+    assert not gfs.save_needed()
+    assert GitFireSet(repodir=repodir).rules.enabled(0)
+    # not atomic: the failing operation is skipped
+    results = gfs.batch(ops, atomic=False)
+    assert [r['ok'] for r in results] == [True, True, False, True]
+    assert gfs.rules[0].name == 'NoSmeagol'
+    assert not gfs.rules.enabled(1)
+    results = gfs.batch([dict(op='bogus', table='rules'),
+        dict(op='enable', table='hosts', row_id=gfs.hosts[0].row_id)],
+        atomic=False)
+    assert "Unknown operation" in results[0]['error']
+    assert "Only rules" in results[1]['error']
+
+@require_git
+def test_gitfireset_snapshot(repodir, gfs):
+    assert os.path.isfile(repodir + '/.firelet-snapshot')
+    with mock.patch('firelet.flcore.readcsv', side_effect=Exception):
+        with mock.patch.object(type(gfs._repo), 'is_dirty') as is_dirty:
+            gfs2 = GitFireSet(repodir=repodir)
+    assert not is_dirty.called
+    for t in ('rules', 'hosts', 'hostgroups', 'services', 'networks'):
+        assert repr(gfs2.__dict__[t]) == repr(gfs.__dict__[t])
+        assert type(gfs2.__dict__[t][0]) == type(gfs.__dict__[t][0])
+    assert not gfs2.save_needed()
+    assert gfs2.networks[0].ipt() == gfs.networks[0].ipt()
+
+@require_git
+def test_gitfireset_stale_snapshot(repodir, gfs):
+    gfs.rules.disable(3)
+    gfs2 = GitFireSet(repodir=repodir)
+    assert gfs2.rules[3].enabled == '0'
+    assert gfs2.save_needed()
+    # the new snapshot records the uncommitted changes
+    gfs3 = GitFireSet(repodir=repodir)
+    assert gfs3.save_needed()
+    gfs3.save('disabled')
+    gfs4 = GitFireSet(repodir=repodir)
+    assert gfs4.rules[3].enabled == '0'
+    assert not gfs4.save_needed()
+
+@require_git
+def test_gitfireset_indexes(gfs):
+    assert gfs.rules.by_name('ssh_all') == [gfs.rules[0]]
+    assert gfs.hosts.by_iface('BorderFW', 'eth1').ip_addr == '10.66.1.1'
+    assert len(gfs.hosts.by_name('BorderFW')) == 3
+    assert [h.iface for h in gfs.hosts.by_address('10.66.1.1')] == ['eth1']
+    assert gfs.networks.by_address('0.0.0.0')[0].name == 'Internet'
+    assert 'Servers' in gfs.hostgroups.index('name')
+
+    gfs.networks.add(dict(name='Foo', ip_addr='10.9.0.0', masklen='16'))
+    assert gfs.networks.index('name')['Foo'].masklen == 16
+    with raises(AssertionError):
+        gfs.networks.add(dict(name='Foo', ip_addr='10.8.0.0', masklen='16'))
+    rid = len(gfs.networks) - 1
+    gfs.networks.update(dict(name='Foo', ip_addr='10.7.0.0', masklen=16),
+        rid=rid)
+    assert gfs.networks.by_address('10.9.0.0') == []
+    assert gfs.networks.by_address('10.7.0.0')[0].name == 'Foo'
+    gfs.delete('networks', rid)
+    assert 'Foo' not in gfs.networks.index('name')
+    assert gfs.networks.by_address('10.7.0.0') == []
+
+    gfs.services.update(dict(name='SSH2', protocol='TCP', ports='2222'),
+        rid=[s.name for s in gfs.services].index('SSH'))
+    assert gfs.services.by_name('SSH') == []
+    gfs.reset()
+    assert gfs.services.by_name('SSH')[0].ports == '22'
+    assert gfs.services.by_name('SSH2') == []
+
+@require_git
+def test_gitfireset_selective_reload(gfs):
+    gfs.rules.disable(3)
+    gfs.save('disabled')
+    gfs.services.add(dict(name='Foo', protocol='TCP', ports='1234'))
+    reloaded = []
+    def track(cls):
+        orig = cls.reload
+        def reload(self):
+            reloaded.append(self._name)
+            orig(self)
+        return mock.patch.object(cls, 'reload', reload)
+
+    with track(Rules), track(Services), track(Networks), track(HostGroups), \
+            track(Hosts):
+        gfs.reset()
+        assert reloaded == ['services']
+        assert gfs.services.by_name('Foo') == []
+        del reloaded[:]
+        gfs.rollback(1)
+        assert reloaded == ['rules']
+        assert gfs.rules[3].enabled == '1'
+    assert not gfs.save_needed()
+
+def names(items):
+    return [getattr(i, 'name', None) or "%s:%s" % (i.hostname, i.iface)
+        for i in items]
+
+@require_git
+def test_gitfireset_references(gfs):
+    refs = gfs.references('Smeagol:eth0', table='hosts')
+    assert sorted(names(refs['rules'])) == ['NoSmeagol', 'imap', 'irc']
+    assert names(refs['hostgroups']) == ['SSHnodes']
+    assert refs['hosts'] == []
+    refs = gfs.references('production_net', table='networks')
+    assert names(refs['rules']) == ['ssh_mgmt']
+    assert names(refs['hosts']) == ['BorderFW:eth1']
+    refs = gfs.references('SSH', table='services')
+    assert sorted(names(refs['rules'])) == ['ssh_all', 'ssh_mgmt']
+    assert not any(gfs.references('SSH', table='networks').values())
+    # updates are tracked
+    gfs.rules.update(dict(gfs.rules[6].attr_dict(), dst='Tester:eth1'),
+        rid=6)
+    assert sorted(names(gfs.references('Smeagol:eth0')['rules'])) == \
+        ['NoSmeagol', 'imap']
+    assert 'irc' in names(gfs.references('Tester:eth1')['rules'])
+
+@require_git
+def test_gitfireset_delete_referenced(gfs):
+    n_rules = len(gfs.rules)
+    rid = [s.name for s in gfs.services].index('SSH')
+    with raises(Alert):
+        gfs.delete('services', rid, on_reference='block')
+    assert len(gfs.services) == 7
+    assert not gfs.save_needed()
+
+    # default: deleted with a warning
+    with mock.patch('firelet.flcore.log') as log:
+        gfs.delete('services', rid)
+    assert 'ssh_all' in log.warn.call_args[0][0]
+    assert 'ssh_mgmt' in log.warn.call_args[0][0]
+    assert len(gfs.rules) == n_rules
+
+    gfs.reset()
+    # the cascade replaces copies and leaves the previous items unchanged
+    border = gfs.hosts.by_iface('BorderFW', 'eth1')
+    rid = [n.name for n in gfs.networks].index('production_net')
+    gfs.delete('networks', rid, on_reference='cascade')
+    assert 'ssh_mgmt' not in names(gfs.rules)
+    assert len(gfs.rules) == n_rules - 1
+    assert gfs.hosts.by_iface('BorderFW', 'eth1').routed == []
+    assert border.routed == ['production_net']
+    assert gfs.hosts.by_iface('BorderFW', 'eth1').row_version > \
+        border.row_version
+    assert not any(gfs.references('production_net').values())
+    gfs2 = GitFireSet(repodir=gfs._git_repodir)
+    assert names(gfs2.rules) == names(gfs.rules)
+    assert gfs2.hosts.by_iface('BorderFW', 'eth1').routed == []
+
+    servers = gfs.hostgroups.by_name('Servers')[0]
+    childs = list(servers.childs)
+    rid = [h.name for h in gfs.hostgroups].index('SSHnodes')
+    gfs.delete('hostgroups', rid, on_reference='cascade')
+    assert gfs.hostgroups.by_name('Servers')[0].childs == ['WebServers']
+    assert servers.childs == childs
+    gfs.save("cascaded")
+    assert gfs.compile_rules()
+
+@require_git
+def test_gitfireset_invalid_commit_id(gfs):
+    with raises(Alert):
+        gfs.rollback(commit_id='--help')
+    with raises(Alert):
+        gfs.version_diff('HEAD; ls')
+
 @require_git
 def test_gitfireset_long(gfs):
     # Delete first item in every table
@@ -409,6 +1219,12 @@ def test_gitfireset_long(gfs):
         'del') in diff
     assert len(diff) == 52
 
+    # Paginated version list
+    assert gfs.version_list(offset=1, limit=2) == vl[1:3]
+    assert gfs.version_list(limit=2, cursor=vl[1][3]) == vl[2:4]
+    with raises(Alert):
+        gfs.version_list(cursor='0' * 40)
+
     # Rollback and check again
     gfs.rollback(2)
     assert gfs.save_needed() == False
@@ -541,6 +1357,19 @@ def test_gitfireset_check_ifaces_alert(gfs):
     with raises(Alert):
         gfs._check_ifaces(stop_on_extra_interfaces=True)
 
+def test_gitfireset_check_ifaces_alert_invalidates_cache(gfs):
+    gfs.hosts = [
+        Bunch(hostname='host1', iface='eth0', ip_addr='1.2.3.4', mng=1),
+    ]
+    gfs._remote_confs = {
+        'host1': Bunch(ip_a_s={'lo': ('127.0.0.1/8', None)},
+            iptables_p=Bunch()),
+    }
+    gfs._ifaces_cache['host1'] = (time.time(), gfs._remote_confs['host1'])
+    with raises(Alert):
+        gfs._check_ifaces()
+    assert 'host1' not in gfs._ifaces_cache
+
 
 def test_gitfireset_sibling_names(gfs):
     names = ['AllSystems', 'BorderFW:eth0', 'BorderFW:eth1', 'BorderFW:eth2', 'Clients', 'InternalFW:eth0', \
@@ -604,6 +1433,167 @@ def test_DemoGitFireSet_deployment(fs):
     assert diff == {}, repr(diff)[:400]
 
 
+# #  SqliteFireSet testing # #
+
+@pytest.fixture
+def sfs(repodir):
+    return SqliteFireSet(repodir + '/firelet.sqlite', repodir=repodir)
+
+def test_assign_positions():
+    assert assign_positions([1024, 2048, 3072]) == [1024, 2048, 3072]
+    # moving a row changes only its own position
+    assert assign_positions([2048, 1024, 3072]) == [512, 1024, 3072]
+    assert assign_positions([1024, None, 2048, None]) == \
+        [1024, 1536, 2048, 3072]
+    # no gap left
+    assert assign_positions([1, 2, None, 3]) == [1024, 2048, 3072, 4096]
+
+def test_sqlitefireset_import(repodir, sfs):
+    gfs = GitFireSet(repodir=repodir)
+    for t in ('rules', 'hosts', 'hostgroups', 'services', 'networks'):
+        assert sfs.__dict__[t].prepared() == gfs.__dict__[t].prepared()
+    assert sfs.compile_rules() == gfs.compile_rules()
+    assert not sfs.save_needed()
+    assert sfs.version_list() == []
+
+def test_sqlitefireset_lookups(sfs):
+    assert sfs.hosts.by_iface('BorderFW', 'eth0').ip_addr == '172.16.2.223'
+    assert sfs.hosts.by_iface('BorderFW', 'eth9') is None
+    assert len(sfs.hosts.by_name('BorderFW')) == 3
+    assert [h.iface for h in sfs.hosts.by_address('10.66.1.1')] == ['eth1']
+    assert sfs.networks.by_address('0.0.0.0')[0].name == 'Internet'
+    assert sfs.rules.by_name('ssh_all')[0] is sfs.rules[0]
+
+def test_sqlitefireset_save_reopen(repodir, sfs):
+    sfs.rules.movedown(0)
+    sfs.rules.disable(3)
+    sfs.hosts.add(dict(hostname='Foo', iface='eth0', ip_addr='10.0.0.1',
+        masklen='24', local_fw='1', network_fw='0', mng='1', routed=[]))
+    sfs.delete('services', 0)
+    assert sfs.save_needed()
+    sfs2 = SqliteFireSet(repodir + '/firelet.sqlite')
+    for t in ('rules', 'hosts', 'hostgroups', 'services', 'networks'):
+        assert sfs2.__dict__[t].prepared() == sfs.__dict__[t].prepared()
+    assert sfs2.save_needed()
+    sfs2.save('first')
+    assert not sfs2.save_needed()
+    assert [v[2] for v in sfs2.version_list()] == [['first']]
+
+def test_sqlitefireset_writes_changed_rows(repodir, sfs):
+    db = sfs._db.db
+    sfs.rules.disable(3)
+    before = db.total_changes
+    sfs.rules.disable(4)
+    # one row updated, the table was already in the changes
+    assert db.total_changes - before == 1
+    before = db.total_changes
+    sfs.rules.movedown(0)
+    assert db.total_changes - before == 1
+    sfs2 = SqliteFireSet(repodir + '/firelet.sqlite')
+    assert sfs2.rules.prepared() == sfs.rules.prepared()
+    indexes = [r[0] for r in db.execute("SELECT name FROM sqlite_master "
+        "WHERE type='index' AND sql IS NOT NULL")]
+    assert sorted(indexes) == ['hostgroups_pos', 'hosts_pos', 'networks_pos',
+        'rules_pos', 'services_pos']
+
+def test_sqlitefireset_delete_saves_once(repodir, sfs):
+    generation = sfs.hosts.generation
+    sfs.delete('hosts', 0)
+    assert sfs.hosts.generation == generation + 1
+    generations = [sfs.__dict__[t].generation
+        for t in ('rules', 'hostgroups', 'networks')]
+    # referenced by rules only
+    sfs.delete('networks', 0, on_reference='cascade')
+    assert [sfs.__dict__[t].generation
+        for t in ('rules', 'hostgroups', 'networks')] == \
+        [generations[0] + 1, generations[1], generations[2] + 1]
+    sfs2 = SqliteFireSet(repodir + '/firelet.sqlite')
+    for t in ('rules', 'hosts', 'hostgroups', 'networks'):
+        assert sfs2.__dict__[t].prepared() == sfs.__dict__[t].prepared()
+
+def test_sqlitefireset_row_ids(repodir, sfs):
+    row_id = sfs.hosts[3].row_id
+    sfs.delete('hosts', 0)
+    sfs.hosts.update(dict(sfs.hosts[2].attr_dict(), ip_addr='10.66.2.9'),
+        rid=2)
+    sfs.hosts.add(dict(hostname='Foo', iface='eth0', ip_addr='10.0.0.1',
+        masklen='24', local_fw='1', network_fw='0', mng='1', routed=[]))
+    assert sfs.hosts[-1].row_id > max(h.row_id for h in sfs.hosts[:-1])
+    sfs.save('first')
+    sfs2 = SqliteFireSet(repodir + '/firelet.sqlite')
+    assert [h.row_id for h in sfs2.hosts] == [h.row_id for h in sfs.hosts]
+    assert sfs2.hosts.by_id(row_id).ip_addr == '10.66.2.9'
+    sfs.rules.disable(0)
+    sfs.reset()
+    assert sfs.hosts.by_id(row_id).ip_addr == '10.66.2.9'
+    assert sfs.rules[0].row_version == 3
+
+def test_sqlitefireset_batch(repodir, sfs):
+    hosts = sfs.hosts.prepared()
+    results = sfs.batch([
+        dict(op='delete', table='hosts', row_id=sfs.hosts[0].row_id),
+        dict(op='move', table='rules', row_id=sfs.rules[0].row_id, to=99)])
+    assert results[1]['error'] == 'Cannot move item 0 to 99.'
+    assert SqliteFireSet(repodir + '/firelet.sqlite').hosts.prepared() == \
+        hosts
+
+def test_sqlitefireset_reset_rollback(sfs):
+    rules = sfs.rules.prepared()
+    services = sfs.services.prepared()
+    sfs.rules.disable(3)
+    sfs.save('first')
+    sfs.rules.moveup(2)
+    sfs.delete('services', 0)
+    sfs.reset()
+    assert not sfs.save_needed()
+    assert sfs.rules[3].enabled == '0'
+    assert sfs.services.prepared() == services
+    sfs.rules.enable(3)
+    sfs.save('second')
+    vl = sfs.version_list()
+    assert [v[2] for v in vl] == [['second'], ['first']]
+    assert sfs.version_list(cursor=vl[0][3]) == vl[1:]
+    sfs.rollback(2)
+    assert sfs.rules.prepared() == rules
+    assert sfs.version_list() == []
+    with raises(Alert):
+        sfs.rollback(commit_id='--help')
+
+def test_sqlitefireset_transaction(repodir, sfs):
+    def stored_rules():
+        db = sqlite3.connect(repodir + '/firelet.sqlite')
+        names = [r[0] for r in db.execute("SELECT name FROM rules ORDER BY pos")]
+        db.close()
+        return names
+
+    before = stored_rules()
+    with sfs.transaction():
+        for n in range(5):
+            sfs.rules.movedown(n)
+        assert stored_rules() == before
+    rules = [r.name for r in sfs.rules]
+    assert stored_rules() == rules
+    sfs.reload()
+    assert [r.name for r in sfs.rules] == rules
+
+    with raises(Alert):
+        with sfs.transaction():
+            sfs.rules.movedown(0)
+            raise Alert('bogus')
+    assert [r.name for r in sfs.rules] == rules
+    assert stored_rules() == rules
+
+def test_sqlitefireset_export(repodir, sfs):
+    sfs.rules.disable(3)
+    outdir = repodir + '/export'
+    os.mkdir(outdir)
+    sfs.export_csv(outdir)
+    sfs.export_csv(repodir)
+    for d in (outdir, repodir):
+        assert list(readcsv('rules', d))[3][0] == '0'
+        assert len(list(readcsv('hosts', d))) == len(sfs.hosts)
+
+
 # # Rule compliation and deployment testing # #
 
 @require_git
@@ -1080,6 +2070,111 @@ def test_DemoGitFireSet_deploy_then_check(repodir, fs):
     assert not fs.save_needed()
 
 
+def test_plan_waves():
+    hns = ['d', 'a', 'c', 'b', 'e']
+    assert plan_waves(hns) == [['a', 'b', 'c', 'd', 'e']]
+    assert plan_waves(hns, canary=['c']) == [['c'], ['a', 'b', 'd', 'e']]
+    assert plan_waves(hns, canary=1, batch_size=2) == \
+        [['a'], ['b', 'c'], ['d', 'e']]
+
+def test_plan_waves_unknown_canary():
+    with raises(Alert):
+        plan_waves(['a', 'b'], canary=['x'])
+
+@require_git
+def test_DemoGitFireSet_rolling_deploy(repodir, fs):
+    rd = RollingDeployment(fs, canary=1, batch_size=2)
+    p = rd.run()
+    assert p.state == 'completed', p.error
+    assert p.done()
+    assert set(p.hosts.values()) == set(['deployed'])
+    assert sum(len(w) for w in p.waves) == len(p.hosts)
+
+def test_rolling_deploy_stops_on_failing_wave():
+    fs = Mock()
+    fs.save_needed.return_value = False
+    fs._get_firewalls.return_value = [Bunch(hostname=hn)
+        for hn in ('a', 'b', 'c')]
+    fs._deploy.side_effect = [{}, {'b': 'diff'}]
+    rd = RollingDeployment(fs, canary=['a'], batch_size=1)
+    p = rd.run()
+    assert fs._deploy.call_count == 2
+    assert p.state == 'failed'
+    assert p.current_wave == 1
+    assert p.hosts == {'a': 'deployed', 'b': 'failed: running rules differ',
+        'c': 'skipped'}
+    assert p.to_dict()['state'] == 'failed'
+
+
+# # Background jobs # #
+
+def test_job_queue():
+    q = JobQueue()
+    # the log handler is added when the worker starts, not on import
+    assert q._log_handler not in logging.getLogger().handlers
+    def f(job):
+        log.warning('working')
+        job.hosts['a'] = 'done'
+        return 42
+    job = q.submit('check', f)
+    assert job.wait(5)
+    assert job.state == 'completed'
+    assert job.result == 42
+    d = job.to_dict()
+    assert d['hosts'] == {'a': 'done'}
+    assert d['duration'] >= 0
+    assert ('warning', d['logs'][0][1], 'working') in d['logs']
+    assert q.get(job.id) is job
+    assert q.list() == [job]
+
+def test_job_queue_failure():
+    q = JobQueue()
+    def f(job):
+        raise Alert('boom')
+    job = q.submit('deploy', f)
+    assert job.wait(5)
+    assert job.state == 'failed'
+    assert job.error == 'boom'
+
+def test_job_queue_dedupe():
+    q = JobQueue()
+    import threading
+    ev = threading.Event()
+    blocker = q.submit('check', lambda job: ev.wait(5), key='check')
+    dup = q.submit('check', lambda job: None, key='check')
+    assert dup is blocker
+    ev.set()
+    assert blocker.wait(5)
+    other = q.submit('check', lambda job: None, key='check')
+    assert other is not blocker
+    assert other.wait(5)
+
+def test_job_queue_on_change():
+    seen = []
+    q = JobQueue(on_change=lambda job: seen.append((job.state,
+        dict(job.hosts))))
+    def f(job):
+        job.hosts['a'] = 'deployed'
+    job = q.submit('deploy', f)
+    assert job.wait(5)
+    assert seen == [('running', {}), ('running', {'a': 'deployed'}),
+        ('completed', {'a': 'deployed'})]
+
+# # Event bus # #
+
+def test_event_bus():
+    bus = EventBus(size=3)
+    assert bus.last_id == 0
+    assert bus.wait(0, 0.01) == []
+    for n in range(5):
+        bus.publish('message', n)
+    assert bus.last_id == 5
+    assert bus.since(0) == [(3, 'message', 2), (4, 'message', 3),
+        (5, 'message', 4)]
+    assert bus.wait(4, 0.01) == [(5, 'message', 4)]
+    assert format_sse((5, 'job', {'a': 1})) == \
+        'id: 5\nevent: job\ndata: {"a": 1}\n\n'
+
 
 #def test_GitFireSet_deployment(fs):
 #    fs = GitFireSet(repodir=repodir)
@@ -1096,7 +2191,8 @@ def test_DemoGitFireSet_deploy_then_check(repodir, fs):
 #
 
 #def test_get_confs_local_dummy(fs):
-#    from firelet.flssh import SSHConnector, MockSSHConnector
+#    from firelet.flsqlite import SqliteFireSet, assign_positions
+from firelet.flssh import SSHConnector, MockSSHConnector
 #
 #    sshconn = SSHConnector(targets={'localhost':['127.0.0.1']} )
 #    d  = sshconn.get_confs( )
@@ -1414,6 +2510,39 @@ def test_svg_map(repodir):
     assert 'rivendell' in svg, "No rivendell in the map"
 
 
+@require_git
+def test_networks_containing(gfs):
+    gfs.networks.add(dict(name='wide', ip_addr='10.0.0.0', masklen='8'))
+    for h in gfs.hosts:
+        expected = set(n.name for n in gfs.networks if h in n)
+        assert set(n.name for n in gfs.networks.containing(h.ip_addr)) == \
+            expected
+    names = [n.name for n in gfs.networks.containing('10.66.2.2')]
+    assert names == ['production_net', 'wide']
+
+@require_git
+def test_map_cache(gfs):
+    layouts = []
+    def drawmap(fs):
+        layouts.append(fs)
+        return Mock(draw=lambda format: format)
+
+    cache = MapCache()
+    with mock.patch('firelet.flmap._drawmap', side_effect=drawmap):
+        assert cache.get(gfs.snapshot(), 'svg') == 'svg'
+        assert cache.get(gfs.snapshot(), 'png') == 'png'
+        key = cache.key(gfs)
+        gfs.rules.disable(0)
+        assert cache.key(gfs) == key
+        gfs.hosts.add(dict(hostname='Foo', iface='eth0', ip_addr='10.0.0.1',
+            masklen='24', local_fw='1', network_fw='0', mng='1', routed=[]))
+        cache.refresh(gfs.snapshot()).join()
+        assert cache.key(gfs) != key
+        cache.get(gfs, 'png')
+        cache.refresh(gfs.snapshot()).join()
+    assert len(layouts) == 2
+
+
 # #  Test JSON lib  # #
 
 def test_json_files(repodir):
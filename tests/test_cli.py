@@ -147,6 +147,11 @@ class TestCLI(object):
         assert len(cli.say.output_history) == 3
         assert cli.say.output_history[0].endswith('| test3 |'), cli.say.hist()
 
+        # paginated list
+        self.run(repodir, 'version', 'list', '1', '1', '-q')
+        assert len(cli.say.output_history) == 1
+        assert cli.say.output_history[0].endswith('| test2 |'), cli.say.hist()
+
         # rollback by number
         self.run(repodir, 'version', 'rollback', '1', '-q')
 
@@ -221,6 +226,17 @@ class TestCLI(object):
         out = self.run(repodir, '-q', 'rule', 'list')
         assert out == out1, "Rule enable/disable not idempotent"
 
+    def test_rule_enable_disable_by_name(self, repodir):
+        self.run(repodir, '-q', 'rule', 'disable', 'BG_https')
+        assert cli.say.last == 'Rule 1 disabled.'
+        out = self.run(repodir, '-q', 'rule', 'list')
+        assert out[2].split('|')[5].strip() == '0',  "First rule should be disabled"
+        before = self.run(repodir, '-q', 'host', 'list')
+        self.run(repodir, '-q', 'host', 'del', 'BorderFW:eth2')
+        after = self.run(repodir, '-q', 'host', 'list')
+        assert len(after) == len(before) - 1
+        assert 'eth2' not in ''.join(after[1:])
+
     def test_multiple_list_and_deletion(self, repodir):
         for name in ('rule', 'host', 'hostgroup', 'network', 'service'):
             before = self.run(repodir, '-q', name, 'list')
@@ -228,3 +244,18 @@ class TestCLI(object):
             after = self.run(repodir, '-q', name, 'list')
             assert len(after) == len(before) - 1, "%s not deleted %s" % \
                 (name, cli.say.hist())
+
+    def test_bulk_import_export(self, repodir):
+        fn = os.path.join(repodir, 'new_networks.csv')
+        with open(fn, 'w') as f:
+            f.write("dmz 10.9.0.0 16\nlab 10.8.0.0 24\n")
+        self.run(repodir, '-q', 'network', 'import', fn, 'New networks')
+        assert cli.say.last == '2 networks imported.'
+        out = self.run(repodir, '-q', 'network', 'export')
+        assert out[0] == '# name ip_addr masklen'
+        assert out[-2:] == ['dmz 10.9.0.0 16', 'lab 10.8.0.0 24']
+        self.run(repodir, 'save_needed', '-q')
+        assert cli.say.last == 'No'
+        self.run(repodir, '-q', 'network', 'import', fn)
+        assert cli.say.output_history[-1] == 'Nothing imported.'
+        assert cli.say.output_history[0].startswith('Line 1: ')
@@ -4,11 +4,15 @@ from pytest import raises
 import hmac
 import os
 import pytest
+import threading
 
 from firelet.flutils import Bunch
 from firelet.flutils import encrypt_cookie, decrypt_cookie
 from firelet.flutils import flag
 from firelet.flutils import get_rss_channels
+from firelet.flutils import FileLock
+from firelet.flutils import LRUCache
+from firelet.flutils import RWLock
 
 # Disabled: a fallback function is put in place when compare_digest is missing
 #def test_check_for_compare_digest():
@@ -126,3 +130,80 @@ def test_encrypt_then_decrypt_multi(mocked_os_urandom, key):
         dec = decrypt_cookie(key, enc)
         assert d == dec
 
+
+
+# LRU cache
+
+def test_lru_cache_eviction():
+    c = LRUCache(maxsize=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    assert c.get('c') == 3
+    assert len(c) == 2
+
+def test_lru_cache_on_disk(tmpdir):
+    d = str(tmpdir.join('cache'))
+    c = LRUCache(maxsize=1, directory=d)
+    c.put(('text', 'a', 'b'), [('x', 'add')])
+    c.put(('text', 'b', 'c'), [])
+    assert c.get(('text', 'a', 'b')) == [['x', 'add']]
+    c2 = LRUCache(directory=d)
+    assert c2.get(('text', 'b', 'c')) == []
+    assert c2.get(('text', 'c', 'd')) is None
+
+def test_lru_cache_on_disk_pruned(tmpdir):
+    d = tmpdir.join('cache')
+    c = LRUCache(maxsize=1, directory=str(d), disk_maxsize=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    # make "b" the least recently used file
+    os.utime(c._fname('b'), (0, 0))
+    c.put('c', 3)
+    assert len(d.listdir()) == 2
+    c2 = LRUCache(directory=str(d))
+    assert c2.get('a') == 1
+    assert c2.get('b') is None
+    assert c2.get('c') == 3
+
+def test_file_lock(tmpdir):
+    fn = str(tmpdir.join('lock'))
+    a = FileLock(fn)
+    b = FileLock(fn, timeout=0)
+    with a:
+        with a:
+            assert not b.acquire()
+        assert not b.acquire()
+    assert b.acquire()
+    b.release()
+    assert a.hold()
+    with a:
+        pass
+    assert not b.acquire()
+    a.close()
+    assert b.acquire(blocking=False)
+
+def test_rwlock():
+    lock = RWLock()
+    done = []
+    def write():
+        with lock.writing():
+            done.append('write')
+    with lock.reading():
+        with lock.reading():
+            t = threading.Thread(target=write)
+            t.start()
+            t.join(.1)
+            assert done == []
+        with raises(AssertionError):
+            lock.acquire_write()
+    t.join()
+    assert done == ['write']
+    with lock.writing():
+        with lock.writing():
+            with lock.reading():
+                pass
+    assert lock._writer is None and not lock._readers
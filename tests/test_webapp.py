@@ -17,11 +17,13 @@
 from pytest import raises
 from webtest import TestApp, AppError
 import bottle
+import json
 import logging
 import pytest
+import time
 
 from firelet import fireletd
-from firelet.flcore import GitFireSet, DemoGitFireSet, Users
+from firelet.flcore import GitFireSet, DemoGitFireSet, FireSetSnapshot, Users
 from firelet.flssh import MockSSHConnector
 from firelet.mailer import Mailer
 import firelet.flssh
@@ -34,6 +36,10 @@ skip = pytest.mark.skipif("True")
 class Conf(object):
     public_url = 'http://localhost'
     stop_on_extra_interfaces = False
+    rollback_timeout = 10
+    deploy_canary = ''
+    deploy_batch_size = 0
+    event_stream = False
 
 @pytest.fixture
 def mailer(monkeypatch):
@@ -136,6 +142,17 @@ def test_ruleset(webapp):
     rules = out.pyquery('table#items tr')
     assert len(rules) == 11 # 10 rules plus header
 
+def test_ruleset_page(webapp):
+    out = webapp.get('/ruleset?offset=1&limit=3&q=ssh')
+    assert out.pyquery('table#items tr td:nth-child(3)').text() == 'ssh_mgmt'
+    assert 'Rows 2-2 of 2' in out.text
+    assert 'Previous' in out.text and 'Next' not in out.text
+    out = webapp.get('/hosts?limit=2')
+    assert [tr.get('id') for tr in out.pyquery('table#items tr[id]')] == \
+        ['0', '1']
+    assert 'Next' in out.text
+    webapp.get('/networks?offset=-1', status=400)
+
 def test_ruleset_post_delete(webapp):
     out = webapp.post('/ruleset', dict(
         action='delete',
@@ -213,6 +230,28 @@ def test_ruleset_post_newabove(webapp):
     rules = out.pyquery('table#items tr')
     assert len(rules) == 12
 
+def test_ruleset_rows_by_row_id(webapp):
+    rows = webapp.get('/ruleset').pyquery('table#items tr[row_id]')
+    tr = rows.eq(3)
+    row_id, row_version = tr.attr('row_id'), tr.attr('row_version')
+    name = fireletd.fs.rules.by_id(int(row_id)).name
+    # another client inserts a rule: the rows shift
+    out = webapp.post('/ruleset', dict(action='newabove',
+        row_id=rows.eq(0).attr('row_id')))
+    assert out.json['row_id'] == fireletd.fs.rules[0].row_id
+    webapp.post('/ruleset', dict(action='disable', row_id=row_id,
+        row_version=row_version))
+    assert fireletd.fs.rules[4].name == name
+    assert fireletd.fs.rules[4].enabled == '0'
+    out = webapp.post('/ruleset_form', dict(row_id=row_id))
+    assert out.pyquery('input[name=row_version]').val() == \
+        str(int(row_version) + 1)
+    # stale version
+    webapp.post('/ruleset', dict(action='enable', row_id=row_id,
+        row_version=row_version), status=409)
+    rows = webapp.get('/hosts').pyquery('table#items tr[row_id]')
+    assert rows.eq(0).attr('row_id') == str(fireletd.fs.hosts[0].row_id)
+
 def test_ruleset_post_newbelow(webapp):
     out = webapp.get('/ruleset')
     rules = out.pyquery('table#items tr')
@@ -279,7 +318,20 @@ def test_hostgroups_post_fetch(webapp):
         action='fetch',
         rid=1,
     ))
-    assert out.json == {u'token': u'd74e8fce', u'childs': [u'Smeagol:eth0'], u'name': u'SSHnodes'}
+    assert out.json == {u'token': u'd74e8fce', u'childs': [u'Smeagol:eth0'], u'name': u'SSHnodes',
+        u'row_id': 2, u'row_version': 1}
+
+def test_hostgroups_post_by_row_id(webapp):
+    out = webapp.post('/hostgroups', dict(action='fetch', row_id=2))
+    assert out.json['name'] == 'SSHnodes'
+    fireletd.fs.delete('hostgroups', 0)
+    webapp.post('/hostgroups', dict(action='save', row_id=2, row_version=1,
+        name='SSHnodes', siblings='Smeagol:eth0,Tester:eth1'))
+    assert sorted(fireletd.fs.hostgroups[0].childs) == ['Smeagol:eth0',
+        'Tester:eth1']
+    webapp.post('/hostgroups', dict(action='save', row_id=2, row_version=1,
+        name='SSHnodes', siblings='Smeagol:eth0'), status=409)
+    webapp.post('/hostgroups', dict(action='delete', row_id=99), status=409)
 
 def test_hostgroups_post_unknown_action(webapp):
     with raises(Exception):
@@ -343,7 +395,8 @@ def test_hosts_post_fetch(webapp):
         action='fetch',
         rid=1,
     ))
-    assert out.json == {u'masklen': u'24', u'iface': u'eth1', u'ip_addr': u'10.66.2.1', u'hostname': u'InternalFW', u'routed': [], u'local_fw': 1, u'token': u'db9018c1', u'network_fw': 1, u'mng': 1}
+    assert out.json == {u'masklen': u'24', u'iface': u'eth1', u'ip_addr': u'10.66.2.1', u'hostname': u'InternalFW', u'routed': [], u'local_fw': 1, u'token': u'db9018c1', u'network_fw': 1, u'mng': 1,
+        u'row_id': 2, u'row_version': 1}
 
 def test_hosts_post_unknown_action(webapp):
     with raises(Exception):
@@ -408,7 +461,8 @@ def test_networks_post_fetch(webapp):
         action='fetch',
         rid=1,
     ))
-    assert out.json == {u'masklen': 24, u'ip_addr': u'10.66.2.0', u'name': u'production_net', u'token': u'657ed9ec'}
+    assert out.json == {u'masklen': 24, u'ip_addr': u'10.66.2.0', u'name': u'production_net', u'token': u'657ed9ec',
+        u'row_id': 2, u'row_version': 1}
 
 def test_networks_post_unknown_action(webapp):
     with raises(Exception):
@@ -500,7 +554,8 @@ def test_services_post_fetch(webapp):
         action='fetch',
         rid=1,
     ))
-    assert out.json == {u'token': u'89a7c78e', u'protocol': u'TCP', u'ports': u'80', u'name': u'HTTP'}
+    assert out.json == {u'token': u'89a7c78e', u'protocol': u'TCP', u'ports': u'80', u'name': u'HTTP',
+        u'row_id': 2, u'row_version': 1}
 
 def test_services_post_unknown_action(webapp):
     with raises(Exception):
@@ -525,6 +580,225 @@ def test_reset_post(webapp):
     out = webapp.post('/reset')
     assert out.json['ok'] == True
 
+def test_check_job(webapp, monkeypatch):
+    monkeypatch.setattr(FireSetSnapshot, 'check',
+        lambda self, **kw: {'BorderFW': (['added rule'], [])})
+    out = webapp.post('/api/1/check')
+    assert out.json['ok'] == True
+    job = fireletd.jobs.get(out.json['job_id'])
+    assert job.wait(5)
+    out = webapp.get('/api/1/jobs/%d' % job.id)
+    assert out.json['state'] == 'completed'
+    assert out.json['hosts']['BorderFW'] == 'differs'
+    assert out.json['hosts']['Smeagol'] == 'up to date'
+    out = webapp.get('/api/1/jobs/%d/diff' % job.id)
+    assert 'added rule' in out
+    out = webapp.get('/api/1/jobs')
+    assert job.id in [j['id'] for j in out.json['jobs']]
+
+def test_missing_job(webapp):
+    webapp.get('/api/1/jobs/999999', status=404)
+
+@pytest.fixture
+def web_log_handler():
+    logging.getLogger().addHandler(fireletd.web_log_handler)
+    yield fireletd.web_log_handler
+    logging.getLogger().removeHandler(fireletd.web_log_handler)
+
+def test_events_long_polling(webapp, web_log_handler):
+    since = fireletd.events.last_id
+    fireletd.log.error('something happened')
+    out = webapp.get('/api/1/events', dict(since=since, timeout=0))
+    assert out.json['last_id'] > since
+    assert ['alert', 'something happened'] == \
+        [e['data'] for e in out.json['events']
+            if e['kind'] == 'message'][-1][::2]
+
+def test_events_polling_not_concurrent(webapp, monkeypatch):
+    monkeypatch.setattr(fireletd, 'concurrent_server', False)
+    t = time.time()
+    out = webapp.get('/api/1/events', dict(timeout=10))
+    assert time.time() - t < 5
+    assert out.json['delay'] == fireletd.EVENT_POLL_DELAY
+    monkeypatch.setattr(fireletd, 'concurrent_server', True)
+    out = webapp.get('/api/1/events', dict(timeout=0))
+    assert out.json['delay'] == 0
+
+def test_is_concurrent_server(monkeypatch):
+    assert fireletd.is_concurrent_server('paste')
+    assert not fireletd.is_concurrent_server('wsgiref')
+    monkeypatch.setattr(fireletd, 'AUTO_SERVERS', ())
+    assert not fireletd.is_concurrent_server('auto')
+    monkeypatch.setattr(fireletd, 'AUTO_SERVERS', ('bogus',))
+    monkeypatch.setitem(fireletd.CONCURRENT_SERVERS, 'bogus', 'os')
+    assert fireletd.is_concurrent_server('auto')
+
+def test_events_stream(webapp, web_log_handler, monkeypatch):
+    monkeypatch.setattr(fireletd, 'concurrent_server', True)
+    monkeypatch.setattr(fireletd.conf, 'event_stream', True)
+    monkeypatch.setattr(fireletd, 'EVENT_STREAM_DURATION', 0.2)
+    since = fireletd.events.last_id
+    fireletd.log.error('streamed message')
+    out = webapp.get('/api/1/events/stream',
+        headers={'Last-Event-ID': str(since)})
+    assert out.content_type == 'text/event-stream'
+    assert 'id: %d\nevent: message\n' % (since + 1) in out
+    assert 'streamed message' in out
+    assert fireletd._event_streams == 0
+
+def test_events_stream_disabled(webapp):
+    webapp.get('/api/1/events/stream', status=404)
+    assert 'var event_stream = false;' in webapp.get('/')
+
+def test_events_stream_limit(webapp, monkeypatch):
+    monkeypatch.setattr(fireletd, 'concurrent_server', True)
+    monkeypatch.setattr(fireletd.conf, 'event_stream', True)
+    monkeypatch.setattr(fireletd, '_event_streams', fireletd.EVENT_STREAMS_MAX)
+    webapp.get('/api/1/events/stream', status=503)
+
+def test_events_save_needed(webapp):
+    fireletd._last_save_needed = None
+    since = fireletd.events.last_id
+    webapp.post('/ruleset', dict(action='disable', rid=1))
+    kinds = [k for i, k, d in fireletd.events.since(since)]
+    assert 'save_needed' in kinds
+
+def test_version_list_pages(webapp, monkeypatch):
+    for n in range(3):
+        fireletd.fs.rules.movedown(1)
+        fireletd.fs.save('save %d' % n)
+    monkeypatch.setattr(fireletd, 'VERSION_LIST_PAGE_SIZE', 2)
+    out = webapp.get('/api/1/version_list')
+    assert 'save 2' in out and 'save 1' in out and 'save 0' not in out
+    cursor = out.pyquery('a.more_versions').attr('id')
+    assert cursor
+    out = webapp.get('/api/1/version_list', dict(cursor=cursor))
+    assert 'save 0' in out and 'save 1' not in out
+    assert 'more_versions' not in out
+    assert 'max-age' in out.headers['Cache-Control']
+
+def test_etag(webapp, monkeypatch):
+    for url in ('/api/1/get_compiled_rules', '/api/1/version_list'):
+        etag = webapp.get(url).headers['ETag']
+        webapp.get(url, headers={'If-None-Match': etag}, status=304)
+
+    out = webapp.get('/ruleset')
+    etag = out.headers['ETag']
+    webapp.get('/ruleset', headers={'If-None-Match': etag}, status=304)
+    webapp.get('/hosts', headers={'If-None-Match': etag}, status=200)
+    etag = webapp.get('/api/1/table/rules?limit=2').headers['ETag']
+    webapp.get('/api/1/table/rules?limit=2',
+        headers={'If-None-Match': etag}, status=304)
+    webapp.get('/api/1/table/rules?limit=2&offset=2',
+        headers={'If-None-Match': etag}, status=200)
+    etag = webapp.get('/ruleset').headers['ETag']
+    webapp.post('/ruleset', dict(action='disable', rid=1))
+    out = webapp.get('/ruleset', headers={'If-None-Match': etag})
+    assert out.status_int == 200 and out.headers['ETag'] != etag
+
+    drawn = []
+    monkeypatch.setattr(fireletd, 'draw_svg_map', lambda fs: drawn.append(1))
+    etag = webapp.get('/svgmap').headers['ETag']
+    webapp.get('/svgmap', headers={'If-None-Match': etag}, status=304)
+    webapp.post('/ruleset', dict(action='enable', rid=1))
+    webapp.get('/svgmap', headers={'If-None-Match': etag}, status=304)
+    assert len(drawn) == 1
+    fireletd.fs.networks.add(dict(name='lab', ip_addr='10.8.0.0',
+        masklen='24'))
+    webapp.get('/svgmap', headers={'If-None-Match': etag}, status=200)
+    assert len(drawn) == 2
+
+def test_version_diff_tables(webapp):
+    fireletd.fs.rules.movedown(1)
+    fireletd.fs.save('moved')
+    out = webapp.post('/api/1/version_diff_tables', dict(commit_id='HEAD~1'))
+    assert out.json['ok'] == True
+    assert out.json['tables'].keys() == ['rules']
+
+def test_references(webapp):
+    out = webapp.get('/api/1/references/production_net')
+    assert out.json == {u'name': u'production_net', u'rules': [u'ssh_mgmt'],
+        u'hostgroups': [], u'hosts': [u'BorderFW:eth1']}
+    out = webapp.get('/api/1/references/SSHnodes')
+    assert out.json['hostgroups'] == [u'Servers']
+    out = webapp.get('/api/1/references/SSH?table=networks')
+    assert out.json['rules'] == []
+    out = webapp.get('/api/1/references/SSH?table=bogus')
+    assert out.json == {u'ok': False}
+
+def test_refresh_on_request(webapp, repodir):
+    cli_fs = GitFireSet(repodir)
+    cli_fs.rules.disable(1)
+    assert fireletd.fs.rules[1].enabled == '1'
+    webapp.get('/ruleset')
+    assert fireletd.fs.rules[1].enabled == '0'
+
+def test_bulk_import_export(webapp):
+    data = ('[{"hostname": "Foo", "iface": "eth0", "ip_addr": "10.0.0.1", '
+        '"masklen": 24, "local_fw": true, "network_fw": false, "mng": 1, '
+        '"routed": []}]')
+    out = webapp.post('/api/1/import/hosts?msg=import', data,
+        content_type='application/json')
+    assert out.json == {u'ok': True, u'imported': 1, u'errors': []}
+    assert not fireletd.fs.save_needed()
+    out = webapp.post('/api/1/import/hosts', 'Bar eth0 10.0.0.2 24 1 0 1\n'
+        'Foo eth0 10.0.0.3 24 1 0 1\n', content_type='text/csv')
+    assert out.json['ok'] == False
+    assert [e['line'] for e in out.json['errors']] == [2]
+    out = webapp.get('/api/1/export/hosts')
+    assert out.content_type == 'text/csv'
+    assert 'Foo eth0 10.0.0.1 24 1 0 1' in out
+    assert 'Bar' not in out
+    out = webapp.get('/api/1/export/rules?format=json')
+    assert out.json[0]['name'] == 'ssh_all'
+    webapp.get('/api/1/export/bogus', status=404)
+
+def test_batch(webapp):
+    fs = fireletd.fs
+    ops = [dict(op='disable', table='rules', row_id=fs.rules[0].row_id),
+        dict(op='move', table='rules', row_id=fs.rules[0].row_id, to=2)]
+    out = webapp.post('/api/1/batch', json.dumps(dict(ops=ops)),
+        content_type='application/json')
+    assert out.json['ok'] == True
+    assert out.json['results'][1] == dict(ok=True, row_id=1, row_version=2)
+    assert fs.rules[2].name == 'ssh_all'
+    assert not fs.rules.enabled(2)
+    ops = [dict(op='update', table='hosts', row_id=999, fields={})]
+    out = webapp.post('/api/1/batch', json.dumps(dict(ops=ops)),
+        content_type='application/json')
+    assert out.json['ok'] == False
+    webapp.post('/api/1/batch', 'bogus', status=400)
+
+def test_table_api(webapp):
+    out = webapp.get('/api/1/table/rules?service=SSH&sort=-name&limit=1')
+    assert out.json['total'] == 2
+    assert [r['name'] for r in out.json['rows']] == ['ssh_mgmt']
+    out = webapp.get('/api/1/table/rules?service=SSH&sort=-name')
+    rows = out.json['rows']
+    assert [(r['rid'], r['name']) for r in rows] == [(5, 'ssh_mgmt'),
+        (0, 'ssh_all')]
+    assert rows[0]['row_id'] == 6 and rows[0]['row_version'] == 1
+    out = webapp.get('/api/1/table/hosts?address=10.66.1.1')
+    assert [r['hostname'] for r in out.json['rows']] == ['BorderFW']
+    assert isinstance(out.json['rows'][0]['routed'], list)
+    out = webapp.get('/api/1/table/networks?sort=ip_addr&q=net')
+    assert [r['name'] for r in out.json['rows']] == ['Internet',
+        'production_net']
+    webapp.get('/api/1/table/hosts?sort=bogus', status=400)
+    webapp.get('/api/1/table/bogus', status=404)
+
+def test_snapshot_routes_unlocked(webapp, monkeypatch):
+    held = []
+    def draw(fs):
+        held.append(bool(fireletd.fs._rwlock._readers))
+        return ''
+    monkeypatch.setattr(fireletd, 'draw_svg_map', draw)
+    webapp.get('/svgmap')
+    assert held == [False]
+
+def test_version_diff_invalid_commit(webapp):
+    webapp.post('/api/1/version_diff', dict(commit_id='--help'), status=400)
+
 @skip
 def test_check_post(webapp):
     out = webapp.post('/api/1/check')
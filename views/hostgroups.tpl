@@ -17,16 +17,17 @@
         </tr>
     </thead>
 % for rid, hg in hostgroups:
-    <tr id="{{rid}}">
+    <tr id="{{rid}}" row_id="{{hg.row_id}}" row_version="{{hg.row_version}}">
     <td class="hea">
-        <img src="/static/edit.png" title="Edit host group" id="{{rid}}" rel="#editing_form" class="edit">
-        <img src="/static/delete.png" title="Delete host group" id="{{rid}}" class="delete">
+        <img src="/static/edit.png" title="Edit host group" rel="#editing_form" class="edit">
+        <img src="/static/delete.png" title="Delete host group" class="delete">
     </td>
     <td>{{hg.name}}</td>
     <td>{{' '.join(hg.childs)}}</td>
     </tr>
 % end
 </table>
+% include('pager', page=page, url='hostgroups')
 
 <p><img src="static/new.png" rel="#editing_form" class="new"> New hostgroup</p>
 
@@ -52,7 +53,8 @@
           <button type="submit">Submit</button>
           <button type="reset">Reset</button>
           <input type="hidden" name="action" value="save" />
-          <input type="hidden" name="rid" value="" />
+          <input type="hidden" name="row_id" value="" />
+          <input type="hidden" name="row_version" value="" />
           <input type="hidden" name="token" value="" />
        </fieldset>
     </form>
@@ -66,10 +68,9 @@ $(function() {
     on_tab_load();
 
     $('img.delete').click(function() {
-        td = this.parentElement.parentElement;
-        $.post("hostgroups", { action: 'delete', rid: td.id},
+        $.post("hostgroups", row_ref($(this).closest('tr'), {action: 'delete'}),
             function(data){
-                $('div.tabpane div').load('/hostgroups');
+                load_page('/hostgroups');
             });
     });
 
@@ -123,13 +124,14 @@ $(function() {
             // disable shortcuts while typing in the form
             remove_main_keybindings();
             reset_form();
-            rid = this.getTrigger()[0].id;
-            $("form#editing_form input[name=rid]").get(0).value = rid;
-            $.post("hostgroups",{'action':'fetch','rid':rid}, function(json){
+            tr = this.getTrigger().closest('tr');
+            $("form#editing_form input[name=row_id]").get(0).value = tr.attr('row_id');
+            $.post("hostgroups", row_ref(tr, {'action':'fetch'}), function(json){
                 $("form#editing_form input[type=text]").each(function(n,f) {
                     f.value = json[f.name];
                 });
                 $("form#editing_form input[name=token]").get(0).value = json['token'];
+                $("form#editing_form input[name=row_version]").get(0).value = json['row_version'];
                 ds = $("div#selected").text('');
                 for (i in json.childs)
                     ds.append('<p>'+json.childs[i]+'</p>');
@@ -173,7 +175,7 @@ $(function() {
                 $("img[rel]").each(function() {
                     $(this).overlay().close();
                 });
-                $('div.tabpane div').load('/hostgroups');
+                load_page('/hostgroups');
             } else {
                 form.data("validator").invalidate(json);
             }
@@ -24,10 +24,10 @@
 		</tr>
     </thead>
 % for rid, h in hosts:
-    <tr id="{{rid}}">
+    <tr id="{{rid}}" row_id="{{h.row_id}}" row_version="{{h.row_version}}">
     <td class="hea">
-        <img src="/static/edit.png" title="Edit host" id="{{rid}}" rel="#editing_form" class="edit">
-        <img src="/static/delete.png" title="Delete host" id="{{rid}}" class="delete">
+        <img src="/static/edit.png" title="Edit host" rel="#editing_form" class="edit">
+        <img src="/static/delete.png" title="Delete host" class="delete">
     </td>
     <td>{{h.hostname}}</td>
     <td>{{h.iface}}</td>
@@ -52,6 +52,7 @@
     </tr>
 % end
 </table>
+% include('pager', page=page, url='hosts')
 
 <p><img src="static/new.png" rel="#editing_form" class="new"> New host</p>
 
@@ -103,7 +104,8 @@
           <button type="submit">Submit</button>
           <button type="reset">Reset</button>
           <input type="hidden" name="action" value="save" />
-          <input type="hidden" name="rid" value="" />
+          <input type="hidden" name="row_id" value="" />
+          <input type="hidden" name="row_version" value="" />
           <input type="hidden" name="token" value="" />
        </fieldset>
     </form>
@@ -116,9 +118,9 @@ $(function() {
     on_tab_load();
 
     $('img.delete').click(function() {
-        $.post("hosts", { action: 'delete', rid: this.id},
+        $.post("hosts", row_ref($(this).closest('tr'), {action: 'delete'}),
             function(data){
-                $('div.tabpane div').load('/hosts');
+                load_page('/hosts');
             });
     });
 
@@ -168,9 +170,9 @@ $(function() {
         mask: { loadSpeed: 200, opacity: 0.9 },
         onBeforeLoad: function(event, tabIndex) {
             reset_form();
-            rid = this.getTrigger()[0].id;
-            $("form#editing_form input[name=rid]").get(0).value = rid;
-            $.post("hosts",{'action':'fetch','rid':rid}, function(json){
+            tr = this.getTrigger().closest('tr');
+            $("form#editing_form input[name=row_id]").get(0).value = tr.attr('row_id');
+            $.post("hosts", row_ref(tr, {'action':'fetch'}), function(json){
                 $("form#editing_form input[type=text]").each(function(n,f) {
                     f.value = json[f.name];
                 });
@@ -178,6 +180,7 @@ $(function() {
                     f.checked = Boolean(json[f.name]);
                 });
                 $("form#editing_form input[name=token]").get(0).value = json['token'];
+                $("form#editing_form input[name=row_version]").get(0).value = json['row_version'];
                 ds = $("div#selected").text('');
                 for (i in json.routed)
                     ds.append('<p>'+json.routed[i]+'</p>');
@@ -218,7 +221,7 @@ $(function() {
                 $("img[rel]").each(function() {
                     $(this).overlay().close();
                 });
-                $('div.tabpane div').load('/hosts');
+                load_page('/hosts');
             } else {
                 form.data("validator").invalidate(json);
             }
@@ -105,6 +105,9 @@ input:hover { background: #fefefe}
     <br />
 </div>
 
+<script type="text/javascript">
+var event_stream = {{"true" if event_stream else "false"}};
+</script>
 <script type="text/javascript" src="static/js/main.js"></script>
 
 </body>
@@ -162,6 +162,16 @@ div#diff_table {
 </style>
 
 <script>
+// Poll a background job until it is completed or failed
+function wait_job(job_id, on_done) {
+    $.getJSON("api/1/jobs/" + job_id, function(job) {
+        if (job.state == 'completed' || job.state == 'failed')
+            on_done(job);
+        else
+            setTimeout(function() { wait_job(job_id, on_done); }, 1000);
+    });
+}
+
 $(function() {
 
     on_tab_load();
@@ -198,18 +208,27 @@ $(function() {
     // Version list pane
     $('div#version_list table').load('api/1/version_list', function() {
 
-        $('img.rollback').click(function() {  // Setup rollback trigger
-            cid = this.id;
+        $('div#version_list').delegate('img.rollback', 'click', function() {
+            cid = this.id;  // Setup rollback trigger
             $.post("api/1/rollback", {commit_id: cid},
                 function(data){
                     $('div#version_list table').load('api/1/version_list');
                 });
         });
 
-        $('img.view_ver_diff').click(function() {
+        $('div#version_list').delegate('img.view_ver_diff', 'click', function() {
             $('div#version_list').load('api/1/version_diff', {commit_id: this.id});
         });
 
+        // Append the next page of older versions
+        $('div#version_list').delegate('a.more_versions', 'click', function(e) {
+            var tr = $(this).closest('tr');
+            $.get('api/1/version_list', {cursor: this.id}, function(html) {
+                tr.replaceWith($('<table>' + html + '</table>').find('tr').not(':has(th)'));
+            });
+            e.preventDefault();
+        });
+
         /*
         $("img.view_ver_diff[rel]").overlay({  // Setup commit diff trigger
             mask: {
@@ -238,8 +257,12 @@ $(function() {
             onLoad: function () {
             dt = $('div#diff_table');
             dt.html('<p>Check in progress...</p><p id="spinner"><img src="static/spinner_big.gif" /></p>')
-                // When loaded, run the check command using POST and display the output
-                dt.load("api/1/check", {});
+                // When loaded, queue a check job and display its output
+                $.post("api/1/check", function(json) {
+                    wait_job(json.job_id, function(job) {
+                        dt.load("api/1/jobs/" + job.id + "/diff");
+                    });
+                }, "json");
             }
         },
         closeOnClick: false,
@@ -13,10 +13,10 @@
         <tr><th></th><th>Name</th><th>Network</th><th>Netmask</th></tr>
     </thead>
 % for rid, network in networks:
-    <tr id="{{rid}}">
+    <tr id="{{rid}}" row_id="{{network.row_id}}" row_version="{{network.row_version}}">
     <td class="hea">
-        <img src="/static/edit.png" title="Edit network" id="{{rid}}" rel="#editing_form" class="edit">
-        <img src="/static/delete.png" title="Delete network" id="{{rid}}" class="delete">
+        <img src="/static/edit.png" title="Edit network" rel="#editing_form" class="edit">
+        <img src="/static/delete.png" title="Delete network" class="delete">
     </td>
     <td>{{network.name}}</td>
     <td>{{network.ip_addr}}</td>
@@ -24,6 +24,7 @@
     </tr>
 % end
 </table>
+% include('pager', page=page, url='networks')
 
 
 <style>
@@ -69,7 +70,8 @@ div#help_ovr {
           <button type="submit">Submit</button>
           <button type="reset">Reset</button>
           <input type="hidden" name="action" value="save" />
-          <input type="hidden" name="rid" value="" />
+          <input type="hidden" name="row_id" value="" />
+          <input type="hidden" name="row_version" value="" />
           <input type="hidden" name="token" value="" />
        </fieldset>
     </form>
@@ -83,10 +85,9 @@ $(function() {
     on_tab_load();
 
     $('img.delete').click(function() {
-        td = this.parentElement.parentElement;
-        $.post("networks", { action: 'delete', rid: td.id},
+        $.post("networks", row_ref($(this).closest('tr'), {action: 'delete'}),
             function(data){
-                $('div.tabpane div').load('/networks');
+                load_page('/networks');
             });
     });
 
@@ -118,13 +119,14 @@ $(function() {
         mask: { loadSpeed: 200, opacity: 0.9 },
         onBeforeLoad: function(event, tabIndex) {
             reset_form();
-            rid = this.getTrigger()[0].id;
-            $("form#editing_form input[name=rid]").get(0).value = rid;
-            $.post("networks",{'action':'fetch','rid':rid}, function(json){
+            tr = this.getTrigger().closest('tr');
+            $("form#editing_form input[name=row_id]").get(0).value = tr.attr('row_id');
+            $.post("networks", row_ref(tr, {'action':'fetch'}), function(json){
                 $("form#editing_form input[type=text]").each(function(n,f) {
                     f.value = json[f.name];
                 });
                 $("form#editing_form input[name=token]").get(0).value = json['token'];
+                $("form#editing_form input[name=row_version]").get(0).value = json['row_version'];
                 set_form_trig();
             }, "json");
         },
@@ -146,7 +148,7 @@ $(function() {
                     $("img[rel]").each(function() {
                         $(this).overlay().close();
                     });
-                    $('div.tabpane div').load('/networks');
+                    load_page('/networks');
                 } else {
                     form.data("validator").invalidate(json);
                 }
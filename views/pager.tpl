@@ -0,0 +1,16 @@
+<div class="pager" url="{{url}}" offset="{{page.offset}}" q="{{page.q}}" sort="{{page.sort}}">
+    <form class="search">
+        <input type="text" name="q" value="{{page.q}}" placeholder="Search" />
+    </form>
+    % if page.offset > 0:
+    <a href="#" class="page" offset="{{max(0, page.offset - page.limit)}}">&laquo; Previous</a>
+    % end
+    % if page.total:
+    Rows {{page.offset + 1}}-{{min(page.offset + page.limit, page.total)}} of {{page.total}}
+    % else:
+    No rows
+    % end
+    % if page.offset + page.limit < page.total:
+    <a href="#" class="page" offset="{{page.offset + page.limit}}">Next &raquo;</a>
+    % end
+</div>
@@ -16,7 +16,7 @@
         </tr>
     </thead>
     % for rid, rule in rules:
-    <tr id="{{rid}}">
+    <tr id="{{rid}}" row_id="{{rule.row_id}}" row_version="{{rule.row_version}}">
         <td class="hea">
             <img class="action" src="/static/new_above.png" title="New rule above" action="newabove">
             <img class="action" src="/static/new_below.png" title="New rule below" action="newbelow">
@@ -45,6 +45,7 @@
     </tr>
     % end
 </table>
+% include('pager', page=page, url='ruleset')
 
 
 
@@ -54,31 +55,20 @@ $(function() {
     on_tab_load();
 
     function run_action(tr, action) {
-        rid = tr.attr('id');
-        token = tr.children().eq(10).innerText;
         $('.tooltip').hide();
-        $.post("ruleset", { action: action, token: token, rid: rid}, function(data){
-            $('div.tabpane div').load('/ruleset', function() {
+        $.post("ruleset", row_ref(tr, {action: action}), function(json){
+            load_page('/ruleset', function() {
                 if (action == "newabove") {
-                    tr.load('ruleset_form', {rid: rid});
+                    // edit the new rule
+                    $('table#items tr[row_id=' + json.row_id + ']').load(
+                        'ruleset_form', {row_id: json.row_id});
                 }
             });
-        });
+        }, "json");
     }
 
     $('img.action').click(function() {
-        action = $(this).attr('action');
-        tr = $(this).parents('tr');
-        rid = tr.attr('id');
-        token = tr.children().eq(10).innerText;
-        $('.tooltip').hide();
-        $.post("ruleset", { action: action, token: token, rid: rid}, function(data){
-            $('div.tabpane div').load('/ruleset', function() {
-                if (action == "newabove") {
-                    tr.load('ruleset_form', {rid: rid});
-                }
-            });
-        });
+        run_action($(this).parents('tr'), $(this).attr('action'));
     });
 
 
@@ -95,9 +85,8 @@ $(function() {
     /// Editing form ///
 
     $("table#items tr td").dblclick(function() {
-        rid = $(this).parent().attr('id');
-        $(this).parent().load('ruleset_form', {rid: rid}, function() {
-        });
+        tr = $(this).parent();
+        tr.load('ruleset_form', row_ref(tr, {}));
     })
 
     function set_form_trig() {
@@ -63,7 +63,8 @@
 <td><input type="text" name="desc" value="{{rule.desc}}" /></td>
 <input type="hidden" value="{{rule._token()}}" />
 <input type="hidden" name="action" value="save" />
-<input type="hidden" name="rid" value="{{rid}}" />
+<input type="hidden" name="row_id" value="{{rule.row_id}}" />
+<input type="hidden" name="row_version" value="{{rule.row_version}}" />
 
 
 
@@ -76,34 +77,27 @@ $(function() {
     $('img#formsave').click(function() {
         tr = $(this).parents('tr');
         ff = tr.find('input,select').serializeArray();
-        rid = $(this).parent().attr('id');
-        ff.rid = rid;
         $('.tooltip').hide();
         $.post("ruleset", ff,
             function(data){
                 setup_main_keybindings();
-                $('div.tabpane div').load('/ruleset');
+                load_page('/ruleset');
             });
     });
 
     // Perform an action on table row and refresh the table
-    function run_action(tr, action, data) {
-        rid = tr.attr('id');
-        token = tr.children().eq(10).innerText;
+    function run_action(tr, action) {
         $('.tooltip').hide();
-        $.post("ruleset", { action: action, token: token, rid: rid}, function(data){
-            $('div.tabpane div').load('/ruleset', function() {
+        $.post("ruleset", row_ref(tr, {action: action}), function(data){
+            load_page('/ruleset', function() {
                 setup_main_keybindings();
-                if (action == "newabove") {
-                    tr.load('ruleset_form', {rid: rid});
-                }
             });
         });
     }
 
     $('img#formback').click(function() {
         setup_main_keybindings();
-        $('div.tabpane div').load('/ruleset');
+        load_page('/ruleset');
     });
 
     $('img#formdel').click(function() {
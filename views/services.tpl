@@ -19,10 +19,10 @@
         </tr>
     </thead>
 % for rid, service in services:
-    <tr id="{{rid}}">
+    <tr id="{{rid}}" row_id="{{service.row_id}}" row_version="{{service.row_version}}">
     <td class="hea">
-        <img src="/static/edit.png" title="Edit service" id="{{rid}}" rel="#editing_form" class="edit">
-        <img src="/static/delete.png" title="Delete service" id="{{rid}}" class="delete">
+        <img src="/static/edit.png" title="Edit service" rel="#editing_form" class="edit">
+        <img src="/static/delete.png" title="Delete service" class="delete">
     </td>
     <td>{{service.name}}</td>
     <td>{{service.protocol}}</td>
@@ -30,6 +30,7 @@
     </tr>
 % end
 </table>
+% include('pager', page=page, url='services')
 
 <p><img src="static/new.png" rel="#editing_form" class="new"> New service</p>
 
@@ -81,7 +82,8 @@
           <button type="submit">Submit</button>
           <button type="reset">Reset</button>
           <input type="hidden" name="action" value="save" />
-          <input type="hidden" name="rid" value="" />
+          <input type="hidden" name="row_id" value="" />
+          <input type="hidden" name="row_version" value="" />
           <input type="hidden" name="token" value="" />
        </fieldset>
     </form>
@@ -96,10 +98,9 @@ $(function() {
     on_tab_load();
 
     $('img.delete').click(function() {
-        td = this.parentElement.parentElement;
-        $.post("services", { action: 'delete', rid: td.id},
+        $.post("services", row_ref($(this).closest('tr'), {action: 'delete'}),
             function(data){
-                $('div.tabpane div').load('/services');
+                load_page('/services');
             });
     });
 
@@ -136,9 +137,9 @@ $(function() {
                 // disable shortcuts while typing in the form
                 remove_main_keybindings();
             reset_form();
-            rid = this.getTrigger()[0].id;
-            $("form#editing_form input[name=rid]").get(0).value = rid;
-            $.post("services",{'action':'fetch','rid':rid}, function(json){
+            tr = this.getTrigger().closest('tr');
+            $("form#editing_form input[name=row_id]").get(0).value = tr.attr('row_id');
+            $.post("services", row_ref(tr, {'action':'fetch'}), function(json){
                 $("form#editing_form input[type=text]").each(function(n,f) {
                     f.value = json[f.name];
                 });
@@ -146,6 +147,7 @@ $(function() {
                 if (json.protocol === 'ICMP')
                     $("form#editing_form select[name=icmp_type]").get(0).value = json.ports;
                 $("form#editing_form input[name=token]").get(0).value = json['token'];
+                $("form#editing_form input[name=row_version]").get(0).value = json['row_version'];
                  $("form#editing_form select[name=protocol]").change();
                 set_form_trig();
             }, "json");
@@ -187,7 +189,7 @@ $(function() {
                     $("img[rel]").each(function() {
                         $(this).overlay().close();
                     });
-                    $('div.tabpane div').load('/services');
+                    load_page('/services');
                 } else {
                     form.data("validator").invalidate(json);
                 }
@@ -15,3 +15,6 @@
     </td>
 </tr>
 % end
+% if next_cursor:
+<tr><td colspan="4"><a href="#" class="more_versions" id="{{next_cursor}}">Older versions...</a></td></tr>
+% end